@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import gpt_api_calls
+import plan_library
+from checkpoint import Checkpoint
+from enums import SystemMessage
+from execution_context import ExecutionContext
+from governor import ExecutionGovernor, ExecutionAborted
+from memoization import SubtaskMemo
+from tasks import PlanningTask
+from tracing import Tracer
+
+"""
+Solves a batch of problems (e.g. an eval set) in a single process and a single event loop.
+
+Usage: python batch_runner.py problems.jsonl results.jsonl [--max-concurrent-problems 8] [--max-calls N] [--max-tokens N] [--max-wall-clock-seconds N]
+
+Every line of the problems file is a JSON object with:
+- "state": the problem statement (a string), or the initial state history (a list of {key: value} steps). Required.
+- "id": identifies the problem in the results. Defaults to its line number.
+- "goal", "description", "rules" and "expectedOutputJSONSchema": the inputs of the root task, with the same defaults as playground.py.
+Every line of the results file is the result of a problem, written as soon as the problem is done, in the order the problems finish.
+Problems that already have a finished result in the results file are skipped, so an interrupted batch can be run again to complete it.
+"""
+
+# How many problems run at the same time.
+BATCH_MAX_CONCURRENT_PROBLEMS = int(os.environ.get('BATCH_MAX_CONCURRENT_PROBLEMS', 8))
+# Budgets shared by all the problems of a batch. Every problem also has the per-run budgets of the governor (GOVERNOR_MAX_*).
+BATCH_MAX_CALLS = float(os.environ.get('BATCH_MAX_CALLS', 'inf'))
+BATCH_MAX_TOKENS = float(os.environ.get('BATCH_MAX_TOKENS', 'inf'))
+BATCH_MAX_WALL_CLOCK_SECONDS = float(os.environ.get('BATCH_MAX_WALL_CLOCK_SECONDS', 'inf'))
+
+DEFAULT_GOAL = 'Solve the problem correctly.'
+ROOT_TASK_NAME = 'CREATE MAIN PLAN ALGORITHM GRAPH'
+
+
+def finishedProblemIDs(resultsPath):
+    finishedIDs = set()
+    if not os.path.exists(resultsPath):
+        return finishedIDs
+
+    with open(resultsPath) as resultsFile:
+        for line in resultsFile:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('status') == 'finished':
+                finishedIDs.add(str(record.get('id')))
+
+    return finishedIDs
+
+
+# Reads the problems lazily, so a large eval set is never held in memory at once.
+# A line that is not a JSON object is a problem of its own (whose id is its line number), which fails with its loadError.
+def loadProblems(problemsPath, skippedIDs=frozenset()):
+    with open(problemsPath) as problemsFile:
+        for lineNumber, line in enumerate(problemsFile, start=1):
+            if not line.strip():
+                continue
+            try:
+                problem = json.loads(line)
+            except json.JSONDecodeError as error:
+                problem = {'loadError': f'JSONDecodeError: {error}'}
+            if not isinstance(problem, dict):
+                problem = {'loadError': f'the line is not a JSON object: {line.strip()[:100]}'}
+            problem['id'] = str(problem.get('id', lineNumber))
+            if 'loadError' in problem:
+                print(f'~~ Problem {problem["id"]} (line {lineNumber}) can\'t be loaded: {problem["loadError"]}')
+            if problem['id'] not in skippedIDs:
+                yield problem
+
+
+def createRootTask(problem, executionContext):
+    state = problem['state']
+    if isinstance(state, str):
+        state = [{state: 'RUNNING'}]
+
+    inputTuple = (
+        problem.get('rules', []),
+        state,
+        problem.get('goal', DEFAULT_GOAL),
+        problem.get('expectedOutputJSONSchema', ['output']),
+        problem.get('description', ''),
+        '',
+        None,
+    )
+
+    return PlanningTask(ROOT_TASK_NAME, SystemMessage.PLANNER, inputTuple, executionContext=executionContext)
+
+
+"""
+This class runs the problems of a batch concurrently, with up to maxConcurrentProblems recursion trees in flight.
+- The problems share the process's LLM backend (and its connection pool), dispatcher and response cache, and a SubtaskMemo.
+The memo's fingerprints hold the problem statement (and every other input a subtask sees), so only the problems with the same
+statement (e.g. duplicates, or the same problem asked with different goals) share subtask results. They also share the plan library (see plan_library.py),
+so a plan that worked for one problem is reused for the similar ones.
+- Every problem has its own governor, and the budgets of the batch are enforced by their shared parent governor.
+Once a batch budget is spent, the running problems are aborted with their partial state, and the remaining ones are skipped.
+- Every problem is its own tenant of the dispatcher, whose semaphores hand out the LLM call slots to the problems in turn,
+so a deep recursion with many calls waiting can't starve the other problems.
+- The result of every problem is appended to the results file as soon as it is done.
+"""
+class BatchRunner:
+    def __init__(self, resultsPath, maxConcurrentProblems=BATCH_MAX_CONCURRENT_PROBLEMS, governor=None, taskCache=None):
+        self.resultsPath = resultsPath
+        self.maxConcurrentProblems = maxConcurrentProblems
+        self.governor = governor if governor is not None else ExecutionGovernor(maxCalls=BATCH_MAX_CALLS, maxTokens=BATCH_MAX_TOKENS, maxWallClockSeconds=BATCH_MAX_WALL_CLOCK_SECONDS)
+        self.taskCache = taskCache if taskCache is not None else SubtaskMemo()
+        self.resultsFile = None
+        self.statusCounts = dict()
+
+    async def run(self, problems):
+        problemIterator = iter(problems)
+        with open(self.resultsPath, 'a') as self.resultsFile:
+            # Every worker takes the next problem as soon as its current one is done.
+            workers = [asyncio.ensure_future(self.worker(problemIterator)) for _ in range(self.maxConcurrentProblems)]
+            await asyncio.gather(*workers)
+        self.resultsFile = None
+
+        return self.stats()
+
+    async def worker(self, problemIterator):
+        for problem in problemIterator:
+            self.writeResult(await self.solve(problem))
+
+    async def solve(self, problem):
+        if 'loadError' in problem:
+            return {'id': problem['id'], 'status': 'failed', 'error': problem['loadError']}
+
+        try:
+            self.governor.checkBudgets()
+        except ExecutionAborted as error:
+            return {'id': problem['id'], 'status': 'skipped', 'reason': error.reason, 'details': error.details}
+
+        # Problems are not checkpointed or traced, since their records and spans would all end up mixed in the same files.
+        executionContext = ExecutionContext(
+            taskCache=self.taskCache,
+            governor=ExecutionGovernor(parentGovernor=self.governor),
+            checkpoint=Checkpoint(path=None),
+            tracer=Tracer(enabled=False),
+            runID=problem['id'],
+        )
+        startedAt = time.monotonic()
+        record = {'id': problem['id']}
+        try:
+            rootTask = createRootTask(problem, executionContext)
+            await rootTask.run()
+        except Exception as error:
+            record.update(status='failed', error=f'{type(error).__name__}: {error}')
+        else:
+            if rootTask.abortResult is not None:
+                record.update(status='aborted', reason=rootTask.abortResult['reason'], details=rootTask.abortResult['details'])
+            else:
+                record.update(status='finished')
+            record.update(result=rootTask.result, state=rootTask.state.toList())
+
+        governorStats = executionContext.governor.stats()
+        record.update(seconds=round(time.monotonic() - startedAt, 3), calls=governorStats['calls'], tokens=governorStats['tokens'])
+
+        return record
+
+    def writeResult(self, record):
+        self.statusCounts[record['status']] = self.statusCounts.get(record['status'], 0) + 1
+        self.resultsFile.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        self.resultsFile.flush()
+
+    def stats(self):
+        return {
+            'problems': dict(self.statusCounts),
+            'governor': self.governor.stats(),
+            'taskCache': self.taskCache.stats(),
+            'planLibrary': plan_library.planLibrary.stats(),
+        }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Solves a batch of problems from a JSON lines file.')
+    parser.add_argument('problemsPath', help='The problems, one JSON object per line.')
+    parser.add_argument('resultsPath', help='The results are appended to this file, one JSON object per line.')
+    parser.add_argument('--max-concurrent-problems', type=int, default=BATCH_MAX_CONCURRENT_PROBLEMS, help='How many problems run at the same time.')
+    parser.add_argument('--max-calls', type=float, default=BATCH_MAX_CALLS, help='LLM call budget of the whole batch.')
+    parser.add_argument('--max-tokens', type=float, default=BATCH_MAX_TOKENS, help='Token budget of the whole batch.')
+    parser.add_argument('--max-wall-clock-seconds', type=float, default=BATCH_MAX_WALL_CLOCK_SECONDS, help='Wall-clock budget of the whole batch.')
+    arguments = parser.parse_args()
+
+    governor = ExecutionGovernor(maxCalls=arguments.max_calls, maxTokens=arguments.max_tokens, maxWallClockSeconds=arguments.max_wall_clock_seconds)
+    runner = BatchRunner(arguments.resultsPath, arguments.max_concurrent_problems, governor)
+    problems = loadProblems(arguments.problemsPath, finishedProblemIDs(arguments.resultsPath))
+    try:
+        print(f'~~ BATCH STATS: {await runner.run(problems)}')
+        print(f'~~ LLM CALLS: {gpt_api_calls.dispatcher.stats()}')
+        print(f'~~ RESPONSE CACHE: {gpt_api_calls.responseCache.stats()}')
+    finally:
+        await gpt_api_calls.closeClient()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,142 @@
+import asyncio
+import os
+
+from enums import GPTOutputType
+from gpt_api_calls import gpt
+from prompts import BATCH_PROMPT
+
+# When enabled, type I tasks that become ready at about the same time, with the same context, are answered by a single LLM call.
+BATCH_TYPE_I_TASKS = os.environ.get('BATCH_TYPE_I_TASKS', '0') == '1'
+BATCH_WINDOW_SECONDS = float(os.environ.get('BATCH_WINDOW_MS', 50)) / 1000
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 8))
+
+
+"""
+This class micro-batches type I tasks.
+A type I task that is ready to call the LLM submits itself with its (already formatted) state history. Tasks with the same model,
+system message and state history that are submitted within windowSeconds of each other (up to maxBatchSize of them) are sent as
+one request that asks for a separate answer per goal. Every task gets back its own {"reasoning", "answer"} object, exactly like
+its own call would have returned, and goes on evaluating it as usual.
+If the batched response can't be parsed, or an item is missing its answer, the affected tasks fall back to their own calls.
+The batches that are sent are kept in runningBatches until they are done, since the event loop only keeps weak references to its tasks.
+When the run is over, cancelPendingBatches() cancels whatever is left.
+"""
+class TypeIBatcher:
+    def __init__(self, enabled=BATCH_TYPE_I_TASKS, windowSeconds=BATCH_WINDOW_SECONDS, maxBatchSize=BATCH_MAX_SIZE):
+        self.enabled = enabled
+        self.windowSeconds = windowSeconds
+        self.maxBatchSize = maxBatchSize
+        self.pendingBatches = dict()
+        self.flushTimers = dict()
+        self.runningBatches = set()
+        self.batches = 0
+        self.batchedTasks = 0
+        self.fallbackTasks = 0
+
+    async def submit(self, task, formattedState):
+        loop = asyncio.get_running_loop()
+        batchKey = (task.gptModel, task.systemMessage, formattedState, id(task.executionContext))
+        future = loop.create_future()
+
+        batch = self.pendingBatches.setdefault(batchKey, [])
+        batch.append((task, future))
+        if len(batch) >= self.maxBatchSize:
+            self.flush(batchKey)
+        elif len(batch) == 1:
+            self.flushTimers[batchKey] = loop.call_later(self.windowSeconds, self.flush, batchKey)
+
+        return await future
+
+    def flush(self, batchKey):
+        flushTimer = self.flushTimers.pop(batchKey, None)
+        if flushTimer is not None:
+            flushTimer.cancel()
+
+        batch = self.pendingBatches.pop(batchKey, None)
+        if batch:
+            runningBatch = asyncio.ensure_future(self.runBatch(batchKey[2], batch))
+            self.runningBatches.add(runningBatch)
+            runningBatch.add_done_callback(self.runningBatches.discard)
+
+    # Called by the root task once the run is over (e.g. it was aborted or cancelled): the tasks that are still waiting for a batch
+    # are not coming back for their answers.
+    def cancelPendingBatches(self):
+        for flushTimer in self.flushTimers.values():
+            flushTimer.cancel()
+        self.flushTimers.clear()
+        for batch in self.pendingBatches.values():
+            for _, future in batch:
+                future.cancel()
+        self.pendingBatches.clear()
+        for runningBatch in list(self.runningBatches):
+            runningBatch.cancel()
+
+    async def runBatch(self, formattedState, batch):
+        # Tasks that were cancelled while waiting (e.g. a speculative branch that lost) are dropped from the batch.
+        batch = [(task, future) for task, future in batch if not future.done()]
+        if not batch:
+            return
+
+        try:
+            outputJSONs = await self.answerBatch(formattedState, [task for task, _ in batch])
+            for (_, future), outputJSON in zip(batch, outputJSONs):
+                if not future.done():
+                    future.set_result(outputJSON)
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+
+    async def answerBatch(self, formattedState, tasks):
+        if len(tasks) == 1:
+            return [await self.answerSingleTask(tasks[0])]
+
+        firstTask = tasks[0]
+        prompt = self.assembleBatchPrompt(formattedState, tasks)
+        outputJSON, _ = await gpt(firstTask.gptModel, firstTask.systemMessage, prompt, outputType=GPTOutputType.JSON, executionContext=firstTask.executionContext)
+        self.batches += 1
+        self.batchedTasks += len(tasks)
+
+        answers = outputJSON.get('answers') if isinstance(outputJSON, dict) else None
+        outputJSONs = []
+        for goalNumber in range(1, len(tasks) + 1):
+            answer = answers.get(str(goalNumber)) if isinstance(answers, dict) else None
+            outputJSONs.append(answer if isinstance(answer, dict) and 'answer' in answer else None)
+
+        missingIndexes = [index for index, answer in enumerate(outputJSONs) if answer is None]
+        if missingIndexes:
+            firstTask.executionContext.tracer.log(f'~~ Batched response is missing {len(missingIndexes)} of {len(tasks)} answers. Falling back to single calls for them.')
+            self.fallbackTasks += len(missingIndexes)
+            fallbackOutputJSONs = await asyncio.gather(*[self.answerSingleTask(tasks[index]) for index in missingIndexes])
+            for index, fallbackOutputJSON in zip(missingIndexes, fallbackOutputJSONs):
+                outputJSONs[index] = fallbackOutputJSON
+
+        return outputJSONs
+
+    @staticmethod
+    async def answerSingleTask(task):
+        outputJSON, _ = await gpt(task.gptModel, task.systemMessage, task.prompt, outputType=GPTOutputType.JSON, executionContext=task.executionContext)
+
+        return outputJSON
+
+    @staticmethod
+    def assembleBatchPrompt(formattedState, tasks):
+        formattedGoalsList = []
+        for goalNumber, task in enumerate(tasks, 1):
+            formattedGoalsList.append(f'''Goal #{goalNumber}:\n\tGoal: {task.goal}\n\tGoal Description: {task.description}''')
+        formattedGoals = '\n'.join(formattedGoalsList)
+
+        return BATCH_PROMPT.render(state=formattedState, goals=formattedGoals)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'batchedTasks': self.batchedTasks,
+            'fallbackTasks': self.fallbackTasks,
+            # Every task in a batch would have been its own call, and every fallback is an extra call.
+            'callsSaved': self.batchedTasks - self.batches - self.fallbackTasks,
+        }
@@ -0,0 +1,306 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import re
+import statistics
+import time
+import tracemalloc
+
+import gpt_api_calls
+from enums import CacheMode, SystemMessage
+from execution_context import ExecutionContext
+from deadlines import DeadlinePolicy
+from governor import ExecutionGovernor
+from llm_backends import SimulatedBackend
+from plan_library import PlanLibrary
+from tasks import PlanningTask
+from tracing import latencyPercentiles
+
+"""
+Offline benchmarks of the executor (AlgorithmGraph and PlanningTask), run against the SimulatedBackend.
+Every benchmark is a synthetic plan shape whose plans and answers are scripted, so a run doesn't depend on the network or on a model.
+With the default latency of 0, the wall time is the executor's own cost: scheduling, state rendering, prompt building and recursion.
+With a latency, it also shows how well the executor overlaps independent calls. With a long-tailed latency
+(--latency-distribution lognormal --latency-sigma 1), the tail of the LLM calls shows the effect of hedging (--hedge) and of node deadlines (--node-timeout-ms).
+
+Usage: python benchmarks.py [--latency-ms 0] [--jitter-ms 0] [--latency-distribution fixed] [--latency-sigma 0.5] [--failure-rate 0] [--uncached-token-us 0] [--problem-tokens 0]
+       [--hedge] [--node-timeout-ms 0] [--graph-timeout-ms 0] [--scale 1] [--repeat 3] [--only fan-out] [--json results.json]
+"""
+
+ROOT_GOAL = 'Solve the benchmark problem.'
+
+
+def goalOf(prompt):
+    goalMatch = re.search(r'\nGOAL\n(.*?)\n', prompt)
+
+    return goalMatch.group(1) if goalMatch else None
+
+
+def answer(value):
+    return {'reasoning': 'Scripted reasoning.', 'answer': value}
+
+
+"""
+This class scripts the plans of a benchmark. plans maps a goal to the (nodes, edges) of its plan, where a node is (id, type)
+or (id, type, isConditional) and an edge is (source, target) or (source, target, condition). Goals without a plan get an answer
+from answers, or a generic one.
+"""
+class PlanShape:
+    def __init__(self, name, plans, answers=None):
+        self.name = name
+        self.plans = plans
+        self.answers = answers or dict()
+        self.nodeCount = sum(len(nodes) for nodes, _ in plans.values())
+
+    def respond(self, prompt, requestArgs):
+        if '"next_task_name"' in prompt or requestArgs.get('response_format') is None:
+            return SimulatedBackend.defaultResponder(prompt, requestArgs)
+
+        goal = goalOf(prompt)
+        if goal in self.plans:
+            nodes, edges = self.plans[goal]
+            return {
+                'nodes': [self.formatNode(node) for node in nodes],
+                'edges': [self.formatEdge(edge) for edge in edges],
+            }
+
+        return answer(self.answers.get(goal, f'Result of {goal}'))
+
+    @staticmethod
+    def formatNode(node):
+        nodeID, reasoningType = node[0], node[1]
+        formattedNode = {'id': nodeID, 'description': f'Do {nodeID}.', 'type': reasoningType}
+        if len(node) > 2 and node[2]:
+            formattedNode['conditional'] = True
+
+        return formattedNode
+
+    @staticmethod
+    def formatEdge(edge):
+        formattedEdge = {'source': edge[0], 'target': edge[1]}
+        if len(edge) > 2:
+            formattedEdge['condition'] = edge[2]
+
+        return formattedEdge
+
+
+# One plan with `width` independent type I nodes that all lead to END.
+def fanOutShape(width):
+    itemIDs = [f'compute item {index}' for index in range(width)]
+    nodes = [(itemID, 'type I') for itemID in itemIDs] + [('END', 'type I')]
+    edges = [(itemID, 'END') for itemID in itemIDs]
+
+    return PlanShape('fan-out', {ROOT_GOAL: (nodes, edges)})
+
+
+# A chain of `depth` type II tasks, each of which plans the next one.
+def deepRecursionShape(depth):
+    plans = dict()
+    goal = ROOT_GOAL
+    for level in range(1, depth + 1):
+        nextGoal = f'solve level {level}'
+        plans[goal] = ([(nextGoal, 'type II'), ('END', 'type I')], [(nextGoal, 'END')])
+        goal = nextGoal
+
+    return PlanShape('deep-recursion', plans)
+
+
+# `count` diamonds in a row: split -> (left, right) -> join -> next split.
+def diamondsShape(count):
+    nodes = []
+    edges = []
+    previousJoin = None
+    for index in range(count):
+        split, left, right, join = f'split {index}', f'left {index}', f'right {index}', f'join {index}'
+        nodes += [(split, 'type I'), (left, 'type I'), (right, 'type I'), (join, 'type I')]
+        edges += [(split, left), (split, right), (left, join), (right, join)]
+        if previousJoin is not None:
+            edges.append((previousJoin, split))
+        previousJoin = join
+    nodes.append(('END', 'type I'))
+    edges.append((previousJoin, 'END'))
+
+    return PlanShape('diamonds', {ROOT_GOAL: (nodes, edges)})
+
+
+# `length` conditional nodes in a row. Every check goes on to the next check, or stops the plan "otherwise".
+# The checks answer 1, so every condition is decided locally and the plan runs to the last check.
+def conditionalChainShape(length):
+    nodes = []
+    edges = []
+    answers = dict()
+    for index in range(length):
+        check, stop = f'check {index}', f'stop {index}'
+        nodes += [(check, 'type I', True), (stop, 'type I')]
+        nextNode = f'check {index + 1}' if index + 1 < length else 'END'
+        edges += [(check, nextNode, f'{check} > 0'), (check, stop, 'otherwise'), (stop, 'END')]
+        answers[check] = '1'
+    nodes.append(('END', 'type I'))
+
+    return PlanShape('conditional-chain', {ROOT_GOAL: (nodes, edges)}, answers)
+
+
+# A recursion tree `depth` levels deep. Every level has `width` type I facts, and a type II task that needs them and plans the next level.
+# The memory it peaks at shows what a node costs while the tree is deep: the ancestors of the running level are all alive,
+# and so are the finished siblings at every level.
+def deepTreeShape(depth, width):
+    plans = dict()
+    goal = ROOT_GOAL
+    for level in range(1, depth + 1):
+        factIDs = [f'fact {level}.{index}' for index in range(width)]
+        nextGoal = f'solve level {level}'
+        nodes = [(factID, 'type I') for factID in factIDs] + [(nextGoal, 'type II'), ('END', 'type I')]
+        edges = [(factID, nextGoal) for factID in factIDs] + [(nextGoal, 'END')]
+        plans[goal] = (nodes, edges)
+        goal = nextGoal
+
+    return PlanShape('deep-tree', plans)
+
+
+def createShapes(scale):
+    return [
+        fanOutShape(32 * scale),
+        deepRecursionShape(6 * scale),
+        diamondsShape(8 * scale),
+        conditionalChainShape(8 * scale),
+        deepTreeShape(12 * scale, 4),
+    ]
+
+
+async def runShape(shape, backend, arguments):
+    gpt_api_calls.configureBackend(backend)
+    # Every run has its own event loop, so it also needs its own semaphores.
+    gpt_api_calls.configureDispatcher(hedgeRequests=arguments.hedge)
+    # Deep shapes are deeper than the default limit, and the benchmarks must never be cut short by a budget.
+    governor = ExecutionGovernor(maxDepth=10 ** 6, maxCalls=10 ** 9, maxTokens=10 ** 12, maxWallClockSeconds=10 ** 9)
+    # Every shape scripts different plans for the same goals, so plans must not be reused from one shape (or run) to the next.
+    deadlines = DeadlinePolicy(nodeTimeoutSeconds=arguments.node_timeout_ms / 1000, graphTimeoutSeconds=arguments.graph_timeout_ms / 1000)
+    executionContext = ExecutionContext(governor=governor, planLibrary=PlanLibrary(path=None), deadlines=deadlines)
+    # Real problem statements are long, and they are the part of the state history that every prompt of a run shares.
+    problemStatement = 'Benchmark problem.' + ' Some context.' * (arguments.problem_tokens // 3)
+    inputTuple = ([], [{problemStatement: 'RUNNING'}], ROOT_GOAL, ['output'], '', '', None)
+    rootTask = PlanningTask('BENCHMARK ROOT', SystemMessage.PLANNER, inputTuple, executionContext=executionContext)
+
+    startedAt = time.perf_counter()
+    await rootTask.run()
+    wallSeconds = time.perf_counter() - startedAt
+    if rootTask.abortResult is not None:
+        raise RuntimeError(f'Benchmark {shape.name} was aborted: {rootTask.abortResult}')
+
+    return (wallSeconds, deadlines)
+
+
+def createSimulatedBackend(shape, arguments, **backendOptions):
+    options = dict(
+        latencySeconds=arguments.latency_ms / 1000,
+        # For the lognormal distribution, the jitter is the sigma of the log of the latency.
+        latencyJitterSeconds=arguments.latency_sigma if arguments.latency_distribution == 'lognormal' else arguments.jitter_ms / 1000,
+        latencyDistribution=arguments.latency_distribution or ('uniform' if arguments.jitter_ms else 'fixed'),
+        failureRate=arguments.failure_rate,
+        uncachedTokenSeconds=arguments.uncached_token_us / 10 ** 6,
+    )
+    options.update(backendOptions)
+
+    return SimulatedBackend(shape.respond, **options)
+
+
+def runQuietly(shape, backend, arguments):
+    # In verbose mode (TRACE_VERBOSE=1), the tasks print every prompt and response, which would drown the results.
+    with open(os.devnull, 'w') as devNull, contextlib.redirect_stdout(devNull):
+        return asyncio.run(runShape(shape, backend, arguments))
+
+
+# Runs the shape once more under tracemalloc, and returns the peak of the traced memory.
+# tracemalloc slows a run down many times, so the wall times and the latencies come from the untraced runs, and this run is only measured for memory.
+# Its simulated backend doesn't count the attempts of its requests or cache prompt prefixes (and no call fails, since a retry would
+# draw the same failure again), so what is traced is the executor's own memory: the task tree, its state histories and its graphs.
+def measurePeakMemory(shape, arguments):
+    backend = createSimulatedBackend(shape, arguments, failureRate=0.0, trackedRequests=0, promptCaching=False)
+    tracemalloc.start()
+    try:
+        runQuietly(shape, backend, arguments)
+
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def runBenchmark(shape, arguments):
+    wallTimes = []
+    backend = createSimulatedBackend(shape, arguments)
+    deadlines = None
+    for _ in range(arguments.repeat):
+        # Every run starts cold, with the same draws: the statistics that are reported are those of the last run.
+        backend.reset()
+        wallSeconds, deadlines = runQuietly(shape, backend, arguments)
+        wallTimes.append(wallSeconds)
+
+    wallSeconds = statistics.median(wallTimes)
+    # The latencies of the LLM calls of the last run, retries and hedges included.
+    dispatcher = gpt_api_calls.dispatcher
+    callLatencies = latencyPercentiles([seconds for latencies in dispatcher.callLatencies.latencies.values() for seconds in latencies])
+    hedgedCalls = dispatcher.hedgedCalls
+    peakMemoryBytes = measurePeakMemory(shape, arguments)
+
+    return {
+        'benchmark': shape.name,
+        'nodes': shape.nodeCount,
+        'calls': backend.calls,
+        'callsPerNode': round(backend.calls / shape.nodeCount, 2),
+        'failures': backend.failures,
+        'wallSeconds': round(wallSeconds, 4),
+        'nodesPerSecond': round(shape.nodeCount / wallSeconds, 1) if wallSeconds else None,
+        'simulatedLatencySeconds': round(backend.simulatedLatencySeconds, 3),
+        'cachedPromptShare': round(backend.cachedPromptTokens / backend.promptTokens, 3) if backend.promptTokens else 0.0,
+        'callP50Seconds': callLatencies['p50Seconds'],
+        'callP95Seconds': callLatencies['p95Seconds'],
+        'callP99Seconds': callLatencies['p99Seconds'],
+        'hedgedCalls': hedgedCalls,
+        'timedOutTasks': deadlines.timedOutTasks,
+        'peakMemoryMB': round(peakMemoryBytes / (1024 * 1024), 2),
+        'bytesPerNode': round(peakMemoryBytes / shape.nodeCount),
+    }
+
+
+def printTable(results):
+    columns = list(results[0].keys())
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    print('  '.join('-' * width for width in widths))
+    for result in results:
+        print('  '.join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the plan executor.')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Simulated latency of every LLM call.')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Uniform jitter around the simulated latency.')
+    parser.add_argument('--latency-distribution', choices=['fixed', 'uniform', 'lognormal'], help='How the latency is drawn (uniform if there is a jitter, fixed otherwise).')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='The sigma of the log of the lognormal latency. The median is --latency-ms.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of the LLM calls that fail (and are retried).')
+    parser.add_argument('--uncached-token-us', type=float, default=0.0, help='Simulated latency of every prompt token that is not served from the prompt prefix cache, in microseconds.')
+    parser.add_argument('--problem-tokens', type=int, default=0, help='Pads the problem statement to about this many tokens.')
+    parser.add_argument('--hedge', action='store_true', help='Hedge the LLM calls that are slower than the p95 latency of their model.')
+    parser.add_argument('--node-timeout-ms', type=float, default=0.0, help='Deadline of every type I node (0 for none).')
+    parser.add_argument('--graph-timeout-ms', type=float, default=0.0, help='Deadline of every graph (0 for none).')
+    parser.add_argument('--scale', type=int, default=1, help='Multiplies the size of every plan shape.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark. The median wall time is reported.')
+    parser.add_argument('--only', action='append', help='Only run the benchmarks with these names.')
+    parser.add_argument('--json', help='Also write the results to this JSON file.')
+    arguments = parser.parse_args()
+
+    gpt_api_calls.configureResponseCache(mode=CacheMode.OFF)
+
+    shapes = [shape for shape in createShapes(arguments.scale) if not arguments.only or shape.name in arguments.only]
+    results = [runBenchmark(shape, arguments) for shape in shapes]
+    printTable(results)
+
+    if arguments.json:
+        with open(arguments.json, 'w') as resultsFile:
+            json.dump(results, resultsFile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import json
+import os
+import time
+
+# When set, runs are checkpointed to this file, and can be resumed from it.
+CHECKPOINT_PATH = os.environ.get('CHECKPOINT_PATH')
+
+
+"""
+This class checkpoints a run to an append-only JSON lines file, so a run that crashes (or is aborted) can be resumed.
+Every task is identified by its path in the recursion tree (e.g. "root/Compute the area/END"), which is the same from one run to the next,
+because a resumed run replays the recorded LLM outputs and so rebuilds the same plans. The file holds one record per line:
+- run: the inputs of the root task, written once, when the run starts.
+- output: the LLM output of a task (its answer, or its plan).
+- task: a finished task of a plan graph, with its result and the state history steps it added.
+- pick: the successor that the LLM picked after a conditional task.
+- finished: the root task is done.
+A resumed run uses the recorded outputs instead of calling the LLM, adds the recorded steps of the finished tasks instead of running them,
+and only runs the tasks that were still pending (the frontier).
+Records are buffered, and written every flushEveryRecords records or flushEverySeconds seconds, whichever comes first.
+"""
+class Checkpoint:
+    def __init__(self, path=CHECKPOINT_PATH, resume=False, flushEveryRecords=20, flushEverySeconds=2.0):
+        self.path = path
+        self.enabled = path is not None
+        self.resume = resume
+        self.flushEveryRecords = flushEveryRecords
+        self.flushEverySeconds = flushEverySeconds
+        self.pendingLines = []
+        self.lastFlushedAt = time.monotonic()
+        self.checkpointFile = None
+        self.runRecord = None
+        self.recordedOutputs = dict()
+        self.finishedTasks = dict()
+        self.recordedPicks = dict()
+        self.restoredOutputs = 0
+        self.restoredTasks = 0
+        self.restoredPicks = 0
+        self.writtenRecords = 0
+
+        if self.enabled and resume:
+            self.load()
+
+    def load(self):
+        with open(self.path) as checkpointFile:
+            for line in checkpointFile:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line can be cut short if the process died while writing it.
+                    continue
+
+                recordType = record.get('type')
+                if recordType == 'run':
+                    self.runRecord = record
+                elif recordType == 'output':
+                    self.recordedOutputs.setdefault(record['task'], []).append(record['output'])
+                elif recordType == 'task':
+                    self.finishedTasks[record['task']] = record
+                elif recordType == 'pick':
+                    self.recordedPicks.setdefault(record['task'], []).append(record['picked'])
+
+    @staticmethod
+    def taskPath(task):
+        if task.parentTask is None:
+            return 'root'
+
+        return f'{task.parentTask.path}/{task.humanReadableName}'
+
+    def write(self, record):
+        if not self.enabled:
+            return
+
+        self.pendingLines.append(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str))
+        if len(self.pendingLines) >= self.flushEveryRecords or time.monotonic() - self.lastFlushedAt >= self.flushEverySeconds:
+            self.flush()
+
+    def flush(self):
+        if not self.pendingLines:
+            return
+
+        if self.checkpointFile is None:
+            self.checkpointFile = open(self.path, 'a')
+        self.checkpointFile.write('\n'.join(self.pendingLines) + '\n')
+        self.checkpointFile.flush()
+        self.writtenRecords += len(self.pendingLines)
+        self.pendingLines = []
+        self.lastFlushedAt = time.monotonic()
+
+    def close(self):
+        self.flush()
+        if self.checkpointFile is not None:
+            self.checkpointFile.close()
+            self.checkpointFile = None
+
+    # Called by the root task when it starts, so its state history only holds the initial state.
+    def recordRun(self, rootTask):
+        if self.resume:
+            return
+
+        self.write({
+            'type': 'run',
+            'humanReadableName': rootTask.humanReadableName,
+            'systemMessage': rootTask.systemMessage.name,
+            'rulesList': rootTask.rulesList,
+            'state': rootTask.state.toList(),
+            'goal': rootTask.goal,
+            'expectedOutputJSONSchema': rootTask.expectedOutputJSONSchema,
+            'description': rootTask.description,
+            'reasoningType': rootTask.reasoningType,
+        })
+        self.flush()
+
+    # The outputs of a task are replayed in the order they were recorded, since a task can ask the LLM more than once
+    # (e.g. when it was forced to answer after a repeated plan).
+    def restoredOutput(self, task):
+        recordedOutputs = self.recordedOutputs.get(task.path)
+        if not recordedOutputs:
+            return None
+        self.restoredOutputs += 1
+
+        return recordedOutputs.pop(0)
+
+    def recordOutput(self, task, outputJSON):
+        if outputJSON is not None:
+            self.write({'type': 'output', 'task': task.path, 'output': outputJSON})
+
+    # Returns the record of a task that already finished before the run was resumed, or None if it still has to run.
+    def restoredTask(self, task):
+        finishedTask = self.finishedTasks.pop(task.path, None)
+        if finishedTask is not None:
+            self.restoredTasks += 1
+
+        return finishedTask
+
+    def recordTaskFinished(self, task, newSteps):
+        self.write({'type': 'task', 'task': task.path, 'result': task.result, 'answer': task.answer, 'steps': newSteps})
+
+    def restoredPick(self, task):
+        recordedPicks = self.recordedPicks.get(task.path)
+        if not recordedPicks:
+            return None
+        self.restoredPicks += 1
+
+        return recordedPicks.pop(0)
+
+    def recordPick(self, task, pickedTask):
+        self.write({'type': 'pick', 'task': task.path, 'picked': pickedTask.humanReadableName})
+
+    def recordFinished(self, rootTask):
+        self.write({'type': 'finished', 'result': rootTask.result})
+        self.flush()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'resumed': self.resume,
+            'restoredOutputs': self.restoredOutputs,
+            'restoredTasks': self.restoredTasks,
+            'restoredPicks': self.restoredPicks,
+            'writtenRecords': self.writtenRecords + len(self.pendingLines),
+        }
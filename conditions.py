@@ -0,0 +1,231 @@
+import os
+import re
+
+# When enabled, the likely successors of a conditional task start running while the LLM is still picking one of them.
+SPECULATIVE_BRANCHES = os.environ.get('SPECULATIVE_BRANCHES', '0') == '1'
+
+# Only the most recent steps of the state history are searched for the values that conditions refer to.
+RECENT_STEPS_TO_SEARCH = 20
+
+ELSE_CONDITIONS = ('else', 'otherwise', 'default', 'all other cases', 'none of the above')
+TRUE_WORDS = ('true', 'yes', 'valid', 'correct', 'success', 'successful', 'found', 'exists')
+FALSE_WORDS = ('false', 'no', 'invalid', 'incorrect', 'failure', 'failed', 'not found', 'none')
+
+# The longer phrases come first, so "is greater than or equal to" is not read as "is greater than".
+COMPARISON_OPERATORS = [
+    ('is greater than or equal to', '>='),
+    ('is less than or equal to', '<='),
+    ('is greater than', '>'),
+    ('is less than', '<'),
+    ('is more than', '>'),
+    ('is at least', '>='),
+    ('is at most', '<='),
+    ('is not equal to', '!='),
+    ('is equal to', '=='),
+    ('equals', '=='),
+    ('is not', '!='),
+    ('>=', '>='),
+    ('<=', '<='),
+    ('!=', '!='),
+    ('==', '=='),
+    ('>', '>'),
+    ('<', '<'),
+    ('=', '=='),
+    ('is', '=='),
+]
+
+NUMBER_PATTERN = re.compile(r'-?\d+(?:\.\d+)?(?:e-?\d+)?')
+
+
+"""
+This class evaluates the conditions of conditional edges locally, without an LLM call, whenever it can.
+It understands simple comparisons ("discriminant > 0", "x is at least 10"), boolean checks ("is_valid", "not found", "x is true"),
+"and"/"or" combinations of them, and "else"/"otherwise" branches. The values are pulled from the most recent steps of the state history
+whose ids mention the condition's variable.
+Every condition evaluates to True, False or None (unknown). A successor is picked locally only when the answer is unambiguous;
+otherwise the graph falls back to the LLM. It also keeps the statistics of local decisions, LLM decisions and speculative branches.
+"""
+class ConditionEngine:
+    def __init__(self, speculate=SPECULATIVE_BRANCHES, speculationWidth=2):
+        self.speculate = speculate
+        self.speculationWidth = speculationWidth
+        self.localDecisions = 0
+        self.llmDecisions = 0
+        self.llmDecisionSeconds = 0.0
+        self.speculativeRuns = 0
+        self.speculativeWins = 0
+        self.speculativeCancellations = 0
+        self.speculativeHeadStartSeconds = 0.0
+
+    @staticmethod
+    def normalizeText(text):
+        return ' '.join(re.sub(r'[^\w\s.<>=!-]', ' ', str(text).lower().replace('_', ' ')).split())
+
+    # Returns the successor whose condition holds, or None if the conditions can't be decided locally.
+    # Also returns the verdict (True, False or None) of every successor, so the caller knows which ones are still possible.
+    def pickSuccessor(self, successors, state):
+        verdicts = dict()
+        elseSuccessors = []
+
+        for successor in successors:
+            condition = self.normalizeText(successor.condition or '').removeprefix('if ').strip(' .')
+            if condition in ELSE_CONDITIONS:
+                elseSuccessors.append(successor)
+                verdicts[successor] = None
+            else:
+                verdicts[successor] = self.evaluate(condition, state) if condition else None
+
+        trueSuccessors = [successor for successor, verdict in verdicts.items() if verdict is True]
+        unknownSuccessors = [successor for successor, verdict in verdicts.items() if verdict is None and successor not in elseSuccessors]
+
+        pickedSuccessor = None
+        if len(trueSuccessors) == 1 and not unknownSuccessors:
+            pickedSuccessor = trueSuccessors[0]
+        elif not trueSuccessors and not unknownSuccessors and len(elseSuccessors) == 1:
+            pickedSuccessor = elseSuccessors[0]
+            verdicts[pickedSuccessor] = True
+
+        if pickedSuccessor is not None:
+            self.localDecisions += 1
+
+        return (pickedSuccessor, verdicts)
+
+    # The successor to take when the conditions can't be evaluated at all (e.g. the conditional task timed out, so there is no result,
+    # or neither model picked one of the successors):
+    # the "else"/"otherwise" branch if there is exactly one, or else the first successor of the plan.
+    def defaultSuccessor(self, successors):
+        elseSuccessors = [successor for successor in successors if self.normalizeText(successor.condition or '').removeprefix('if ').strip(' .') in ELSE_CONDITIONS]
+
+        return elseSuccessors[0] if len(elseSuccessors) == 1 else successors[0]
+
+    def evaluate(self, condition, state):
+        if ' or ' in condition:
+            verdicts = [self.evaluate(part, state) for part in condition.split(' or ')]
+            if True in verdicts:
+                return True
+            return False if all(verdict is False for verdict in verdicts) else None
+
+        if ' and ' in condition:
+            verdicts = [self.evaluate(part, state) for part in condition.split(' and ')]
+            if False in verdicts:
+                return False
+            return True if all(verdict is True for verdict in verdicts) else None
+
+        for phrase, operator in COMPARISON_OPERATORS:
+            separator = phrase if not phrase.isalpha() and ' ' not in phrase else f' {phrase} '
+            if separator in condition:
+                leftText, rightText = condition.split(separator, 1)
+                return self.compare(self.resolveOperand(leftText, state), operator, self.resolveOperand(rightText, state))
+
+        if condition.startswith('not '):
+            value = self.asBoolean(self.lookUp(condition[4:], state))
+            return None if value is None else not value
+
+        return self.asBoolean(self.lookUp(condition, state))
+
+    @staticmethod
+    def compare(leftValue, operator, rightValue):
+        if leftValue is None or rightValue is None:
+            return None
+
+        if isinstance(leftValue, float) and isinstance(rightValue, float):
+            if operator == '>':
+                return leftValue > rightValue
+            elif operator == '<':
+                return leftValue < rightValue
+            elif operator == '>=':
+                return leftValue >= rightValue
+            elif operator == '<=':
+                return leftValue <= rightValue
+            elif operator == '==':
+                return abs(leftValue - rightValue) <= 1e-9 * max(1.0, abs(leftValue), abs(rightValue))
+            elif operator == '!=':
+                return abs(leftValue - rightValue) > 1e-9 * max(1.0, abs(leftValue), abs(rightValue))
+
+        if operator == '==':
+            return leftValue == rightValue
+        elif operator == '!=':
+            return leftValue != rightValue
+
+        return None
+
+    # An operand is either a literal (number, boolean, or quoted word) or a variable from the state history.
+    def resolveOperand(self, operandText, state):
+        operandText = operandText.strip(' .?')
+        if not operandText:
+            return None
+        if NUMBER_PATTERN.fullmatch(operandText):
+            return float(operandText)
+        if operandText in TRUE_WORDS or operandText in FALSE_WORDS:
+            return operandText in TRUE_WORDS
+
+        value = self.lookUp(operandText, state)
+        if value is None:
+            return None
+
+        return self.asNumber(value) if self.asNumber(value) is not None else self.asBoolean(value)
+
+    # Returns the value of the most recent step whose id mentions the variable, or None if there is no such step.
+    def lookUp(self, variableName, state):
+        variableWords = set(variableName.split())
+        if not variableWords:
+            return None
+
+        firstStepId = max(len(state) - RECENT_STEPS_TO_SEARCH, 0)
+        for stepId in range(len(state) - 1, firstStepId - 1, -1):
+            for key, value in state[stepId].items():
+                if variableWords <= set(self.normalizeText(key).split()) and value not in ('RUNNING', 'DONE'):
+                    return value
+
+        return None
+
+    @staticmethod
+    def asNumber(value):
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+
+        # A value like "The discriminant is 16" is read as 16, but only if it contains a single number.
+        numbers = NUMBER_PATTERN.findall(str(value).replace(',', ''))
+        if len(numbers) == 1:
+            return float(numbers[0])
+
+        return None
+
+    @classmethod
+    def asBoolean(cls, value):
+        if isinstance(value, bool):
+            return value
+        if value is None:
+            return None
+
+        normalizedValue = cls.normalizeText(value).strip(' .')
+        if normalizedValue in TRUE_WORDS:
+            return True
+        if normalizedValue in FALSE_WORDS:
+            return False
+
+        return None
+
+    def recordLLMDecision(self, seconds):
+        self.llmDecisions += 1
+        self.llmDecisionSeconds += seconds
+
+    def averageLLMDecisionSeconds(self):
+        return self.llmDecisionSeconds / self.llmDecisions if self.llmDecisions else 0.0
+
+    def stats(self):
+        decisions = self.localDecisions + self.llmDecisions
+
+        return {
+            'localDecisions': self.localDecisions,
+            'llmDecisions': self.llmDecisions,
+            'localHitRate': self.localDecisions / decisions if decisions else 0.0,
+            'averageLLMDecisionSeconds': round(self.averageLLMDecisionSeconds(), 3),
+            # Every local decision saves one LLM decision, and every speculative win saves the time its branch ran before the decision.
+            'estimatedSecondsSaved': round(self.localDecisions * self.averageLLMDecisionSeconds() + self.speculativeHeadStartSeconds, 3),
+            'speculativeRuns': self.speculativeRuns,
+            'speculativeWins': self.speculativeWins,
+            'speculativeCancellations': self.speculativeCancellations,
+        }
@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import os
+
+from enums import GPT, GPTOutputType, SystemMessage
+from gpt_api_calls import gpt
+from prompts import SUMMARY_PROMPT
+from state_history import StateHistory
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# The maximum number of tokens of state history that go into a single prompt. 0 disables compaction.
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 6000))
+
+if tiktoken is not None:
+    tokenEncoding = tiktoken.get_encoding('o200k_base')
+else:
+    tokenEncoding = None
+
+
+# Counts tokens locally. Without tiktoken, this falls back to the usual estimate of ~4 characters per token.
+def countTokens(text):
+    if not text:
+        return 0
+    if tokenEncoding is not None:
+        return len(tokenEncoding.encode(text, disallowed_special=()))
+
+    return len(text) // 4 + 1
+
+
+"""
+This class decides how much of the state history (STATE HISTORY) goes into a prompt.
+If the rendered history fits in the token budget, it is sent as is. Otherwise, the problem statement (step #0) and the most recent
+steps that fit are always kept, and the older steps are handled with the cheapest of the following strategies:
+1-) Summary: If a summary of the older steps was already produced, it is reused (no LLM call).
+2-) Window: If only a few steps don't fit, they are simply dropped (no LLM call).
+3-) Relevance: If the whole history is small enough to be filtered in one call, selectRelevantState keeps only the relevant steps.
+4-) Summary: Otherwise, the older steps are summarized. Summaries are built chunk by chunk, each one extending the previous one,
+and they are keyed by the content they summarize, so every later call (and every branch that shares the same steps) reuses them.
+Every call reports how many tokens it saved compared to sending the full history.
+"""
+class ContextManager:
+    def __init__(self, tokenBudget=DEFAULT_CONTEXT_TOKEN_BUDGET, windowSlackSteps=2, summaryChunkSteps=8, summaryTokenReserve=0.25, relevanceFilterMaxTokens=None, summaryModel=GPT.GPT4OMNIMINI):
+        self.tokenBudget = tokenBudget
+        self.windowSlackSteps = windowSlackSteps
+        self.summaryChunkSteps = summaryChunkSteps
+        self.summaryTokenReserve = int(tokenBudget * summaryTokenReserve)
+        self.relevanceFilterMaxTokens = relevanceFilterMaxTokens if relevanceFilterMaxTokens is not None else tokenBudget * 3
+        self.summaryModel = summaryModel
+        self.summaries = dict()
+        self.calls = 0
+        self.tokensSent = 0
+        self.tokensSaved = 0
+        self.strategyCounts = dict()
+
+    # Returns the formatted state history for the task's next prompt, along with a report of what was done.
+    async def buildContext(self, task):
+        history = task.state
+        fullText = history.render()
+        fullTokens = countTokens(fullText)
+
+        if not self.tokenBudget or fullTokens <= self.tokenBudget:
+            return self.report('full', fullText, fullTokens, fullTokens)
+
+        problemStatement = StateHistory.formatStep(0, history[0])
+        availableTokens = self.tokenBudget - countTokens(problemStatement) - self.summaryTokenReserve
+        windowStart = self.findWindowStart(history, availableTokens)
+        summaryBoundary = self.summaryBoundaryFor(history, windowStart, availableTokens + self.summaryTokenReserve // 2)
+        summaryKey = self.summaryKey(history, summaryBoundary)
+
+        if summaryKey in self.summaries and self.summaries[summaryKey].done() and not self.summaries[summaryKey].exception():
+            summary = self.summaries[summaryKey].result()
+            contextText = self.joinContext(problemStatement, summary, history.renderRange(summaryBoundary))
+            return self.report('cached summary', contextText, fullTokens)
+
+        if windowStart - 1 <= self.windowSlackSteps:
+            contextText = self.joinContext(problemStatement, None, history.renderRange(windowStart))
+            return self.report('window', contextText, fullTokens)
+
+        if fullTokens <= self.relevanceFilterMaxTokens:
+            filteredStateHistory = await task.selectRelevantState()
+            contextText = self.renderFilteredState(filteredStateHistory)
+            if contextText and countTokens(contextText) <= self.tokenBudget:
+                return self.report('relevance', contextText, fullTokens)
+
+        summary = await self.summarize(history, summaryBoundary, task.executionContext)
+        contextText = self.joinContext(problemStatement, summary, history.renderRange(summaryBoundary))
+
+        return self.report('summary', contextText, fullTokens)
+
+    # Walks back from the latest step, and returns the id of the oldest step that still fits in the available tokens.
+    # Step #0 (the problem statement) is always kept separately.
+    @staticmethod
+    def findWindowStart(history, availableTokens):
+        windowStart = len(history)
+        usedTokens = 0
+        while windowStart > 1:
+            stepTokens = countTokens(StateHistory.formatStep(windowStart - 1, history[windowStart - 1]))
+            if usedTokens + stepTokens > availableTokens:
+                break
+            usedTokens += stepTokens
+            windowStart -= 1
+
+        return windowStart
+
+    # Summaries always end on a chunk boundary (steps 1 + k * summaryChunkSteps), so the same summaries get reused by later calls.
+    # The boundary right before the window is preferred, as long as the few extra steps it keeps still fit.
+    def summaryBoundaryFor(self, history, windowStart, maxWindowTokens):
+        boundaryBefore = 1 + ((windowStart - 1) // self.summaryChunkSteps) * self.summaryChunkSteps
+        if boundaryBefore == windowStart or countTokens(history.renderRange(boundaryBefore)) <= maxWindowTokens:
+            return boundaryBefore
+
+        return min(boundaryBefore + self.summaryChunkSteps, len(history))
+
+    def previousSummaryBoundary(self, boundary):
+        return 1 + ((boundary - 2) // self.summaryChunkSteps) * self.summaryChunkSteps
+
+    # Summaries are keyed by the content they summarize, so branches that share the same steps share the same summaries.
+    @staticmethod
+    def summaryKey(history, boundary):
+        return hashlib.sha256(history.render(boundary).encode('utf-8')).hexdigest()
+
+    # Returns a summary of steps [1, boundary). Concurrent requests for the same summary share one LLM call.
+    async def summarize(self, history, boundary, executionContext):
+        if boundary <= 1:
+            return ''
+
+        summaryKey = self.summaryKey(history, boundary)
+        if summaryKey not in self.summaries:
+            self.summaries[summaryKey] = asyncio.ensure_future(self.createSummary(history, boundary, executionContext))
+
+        try:
+            return await asyncio.shield(self.summaries[summaryKey])
+        except Exception:
+            self.summaries.pop(summaryKey, None)
+            raise
+
+    async def createSummary(self, history, boundary, executionContext):
+        previousBoundary = self.previousSummaryBoundary(boundary)
+        previousSummary = await self.summarize(history, previousBoundary, executionContext)
+        newSteps = history.renderRange(previousBoundary, boundary)
+
+        prompt = SUMMARY_PROMPT.render(previousSummary=previousSummary or 'There are no earlier steps.', newSteps=newSteps)
+        summary, _ = await gpt(self.summaryModel, SystemMessage.PLANNER, prompt, outputType=GPTOutputType.TEXT, executionContext=executionContext)
+
+        return summary.strip()
+
+    @staticmethod
+    def joinContext(problemStatement, summary, windowText):
+        contextParts = [problemStatement]
+        if summary:
+            contextParts.append(f'Summary of the earlier steps:\n\t{summary}')
+        if windowText:
+            contextParts.append(windowText)
+
+        return '\n'.join(contextParts)
+
+    @staticmethod
+    def renderFilteredState(filteredStateHistory):
+        if isinstance(filteredStateHistory, dict):
+            filteredStateHistory = [{key: value} for key, value in filteredStateHistory.items()]
+        if not isinstance(filteredStateHistory, list):
+            return None
+
+        steps = [step for step in filteredStateHistory if isinstance(step, dict)]
+
+        return StateHistory(steps).render()
+
+    def report(self, strategy, contextText, fullTokens, contextTokens=None):
+        if contextTokens is None:
+            contextTokens = countTokens(contextText)
+        savedTokens = max(fullTokens - contextTokens, 0)
+
+        self.calls += 1
+        self.tokensSent += contextTokens
+        self.tokensSaved += savedTokens
+        self.strategyCounts[strategy] = self.strategyCounts.get(strategy, 0) + 1
+
+        return (contextText, {'strategy': strategy, 'fullTokens': fullTokens, 'contextTokens': contextTokens, 'savedTokens': savedTokens})
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'tokensSent': self.tokensSent,
+            'tokensSaved': self.tokensSaved,
+            'strategies': dict(self.strategyCounts),
+            'storedSummaries': len(self.summaries),
+        }
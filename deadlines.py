@@ -0,0 +1,61 @@
+import math
+import os
+import time
+
+# How long a type I node, and a whole graph (a plan and everything under it), may run. 0 turns a deadline off.
+NODE_TIMEOUT_SECONDS = float(os.environ.get('NODE_TIMEOUT_SECONDS', 0))
+GRAPH_TIMEOUT_SECONDS = float(os.environ.get('GRAPH_TIMEOUT_SECONDS', 0))
+
+# The state history value of a task that was stopped by its deadline.
+TIMED_OUT = 'TIMED OUT'
+
+
+"""
+This class holds the deadlines of the graphs and nodes of a run.
+Deadlines are absolute (time.monotonic()), and they only get shorter down the recursion tree: a graph must finish before the deadline
+of the task that it resolves, and a node must finish before the deadline of its graph. So a sub-plan gives up (and reports what it has)
+before the graph above it has to cut it off, and the deadline goes along with the sub-plans that are sent to workers.
+- A type I node that is still running at its deadline is cancelled, and its step in the state history is TIMED_OUT.
+Its successors still run. If it is conditional, there is no result to decide on, so only its default successor runs:
+its "else"/"otherwise" branch, or else its first successor (see ConditionEngine.defaultSuccessor).
+Planning nodes have no deadline of their own, since they run a whole sub-plan: the deadline of their graph bounds them.
+- A graph that is still running at its deadline cancels its running tasks (and everything under them), skips the tasks that didn't start,
+and hands what it has to its parent task.
+Once the END node of a graph ran, the tasks of the graph that are still running can't change its result anymore, so they are cancelled too.
+"""
+class DeadlinePolicy:
+    def __init__(self, nodeTimeoutSeconds=NODE_TIMEOUT_SECONDS, graphTimeoutSeconds=GRAPH_TIMEOUT_SECONDS):
+        self.nodeTimeoutSeconds = nodeTimeoutSeconds
+        self.graphTimeoutSeconds = graphTimeoutSeconds
+        self.timedOutTasks = 0
+        self.timedOutGraphs = 0
+        self.obsoleteTasks = 0
+
+    def graphDeadline(self, parentDeadline):
+        if self.graphTimeoutSeconds <= 0:
+            return parentDeadline
+
+        return min(parentDeadline, time.monotonic() + self.graphTimeoutSeconds)
+
+    def nodeDeadline(self, task, graphDeadline):
+        if self.nodeTimeoutSeconds <= 0 or not task.isTypeI() or task.humanReadableName in ('END', 'DONE'):
+            return graphDeadline
+
+        return min(graphDeadline, time.monotonic() + self.nodeTimeoutSeconds)
+
+    # Returns how long is left until the deadline, or None if there is no deadline.
+    @staticmethod
+    def remainingSeconds(deadline):
+        if math.isinf(deadline):
+            return None
+
+        return max(deadline - time.monotonic(), 0.0)
+
+    def stats(self):
+        return {
+            'nodeTimeoutSeconds': self.nodeTimeoutSeconds,
+            'graphTimeoutSeconds': self.graphTimeoutSeconds,
+            'timedOutTasks': self.timedOutTasks,
+            'timedOutGraphs': self.timedOutGraphs,
+            'obsoleteTasks': self.obsoleteTasks,
+        }
@@ -11,4 +11,13 @@ class GPTOutputType(Enum):
 
 class SystemMessage(Enum):
     PLANNER = 'You are an expert on the following topics: Planning, Algorithms, Diagrams, Logic, Problem Solving, High-Level Thinking.'
-    EMPTY = ''
\ No newline at end of file
+    EMPTY = ''
+
+class CacheMode(Enum):
+    OFF = 'off'
+    READ_WRITE = 'readwrite'
+    REPLAY = 'replay'
+
+class RepeatedPlanAction(Enum):
+    FORCE_ANSWER = 'force-answer'
+    ABORT = 'abort'
@@ -0,0 +1,65 @@
+import os
+
+import plan_library
+from batching import TypeIBatcher
+from checkpoint import Checkpoint
+from conditions import ConditionEngine
+from context_manager import ContextManager
+from deadlines import DeadlinePolicy
+from governor import ExecutionGovernor
+from memoization import SubtaskMemo
+from routing import ModelRouter
+from tracing import Tracer
+from work_queue import SubplanOffloader
+
+# When enabled, planning responses are streamed, and plan nodes start running before the whole plan has arrived.
+STREAM_PLANS = os.environ.get('STREAM_PLANS', '0') == '1'
+# When enabled (CODE_EXECUTION=1), plans can mark type I nodes as computations, and these are answered by running a short program
+# that the LLM wrote in a sandbox (see sandbox.py). It is off by default, since the sandbox is not a security boundary.
+CODE_EXECUTION = os.environ.get('CODE_EXECUTION', '0') == '1'
+
+"""
+This class holds everything that is shared by all the tasks of a single run (the whole recursion tree).
+The root task creates it, and every task of every sub-plan inherits it from its parent task.
+"""
+class ExecutionContext:
+    def __init__(self, taskCache=None, contextManager=None, governor=None, conditionEngine=None, batcher=None, tracer=None, checkpoint=None, router=None, streamPlans=STREAM_PLANS, runID=None, offloader=None, codeExecution=CODE_EXECUTION, planLibrary=None, deadlines=None):
+        # Identifies the run when several runs share the process (see batch_runner.py), so their LLM calls are scheduled fairly.
+        self.runID = runID
+        self.streamPlans = streamPlans
+        self.codeExecution = codeExecution
+        self.offloader = offloader if offloader is not None else SubplanOffloader()
+        # The plan library is shared by all the runs of the process (see plan_library.py).
+        self.planLibrary = planLibrary if planLibrary is not None else plan_library.planLibrary
+        self.batcher = batcher if batcher is not None else TypeIBatcher()
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.checkpoint = checkpoint if checkpoint is not None else Checkpoint()
+        self.router = router if router is not None else ModelRouter()
+        self.conditionEngine = conditionEngine if conditionEngine is not None else ConditionEngine()
+        self.taskCache = taskCache if taskCache is not None else SubtaskMemo()
+        self.contextManager = contextManager if contextManager is not None else ContextManager()
+        self.governor = governor if governor is not None else ExecutionGovernor()
+        self.deadlines = deadlines if deadlines is not None else DeadlinePolicy()
+
+    # Called by gpt() before every LLM call that is not served from the response cache.
+    def beforeLLMCall(self):
+        self.governor.checkBudgets()
+
+    # Called by gpt() after every LLM call that is not served from the response cache.
+    def recordLLMCall(self, modelName, usage):
+        totalTokens = getattr(usage, 'total_tokens', 0) if usage is not None else 0
+        self.governor.recordCall(totalTokens)
+
+    def stats(self):
+        return {
+            'taskCache': self.taskCache.stats(),
+            'context': self.contextManager.stats(),
+            'governor': self.governor.stats(),
+            'conditions': self.conditionEngine.stats(),
+            'batching': self.batcher.stats(),
+            'checkpoint': self.checkpoint.stats(),
+            'routing': self.router.stats(),
+            'offloading': self.offloader.stats(),
+            'planLibrary': self.planLibrary.stats(),
+            'deadlines': self.deadlines.stats(),
+        }
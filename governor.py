@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+from enums import RepeatedPlanAction
+
+DEFAULT_MAX_DEPTH = int(os.environ.get('GOVERNOR_MAX_DEPTH', 8))
+DEFAULT_MAX_CALLS = int(os.environ.get('GOVERNOR_MAX_CALLS', 500))
+DEFAULT_MAX_TOKENS = int(os.environ.get('GOVERNOR_MAX_TOKENS', 2000000))
+DEFAULT_MAX_WALL_CLOCK_SECONDS = float(os.environ.get('GOVERNOR_MAX_WALL_CLOCK_SECONDS', 1800))
+
+
+class ExecutionAborted(Exception):
+    def __init__(self, reason, details):
+        super().__init__(f'Execution aborted ({reason}): {details}')
+        self.reason = reason
+        self.details = details
+        self.partialState = None
+
+    # The deepest task that sees the error attaches its state history, since it holds the most complete view of the run.
+    def attachState(self, state):
+        if self.partialState is None:
+            self.partialState = state.toList()
+
+    def result(self):
+        return {
+            'status': 'aborted',
+            'reason': self.reason,
+            'details': self.details,
+            'partialState': self.partialState,
+        }
+
+
+"""
+This class guards a run against runaway recursion.
+Every task of the recursion tree reports to it: every LLM call is checked against the call, token and wall-clock budgets,
+and a run that goes over one of them is aborted with ExecutionAborted, which carries the partial state history.
+It also catches the two ways a plan can loop forever:
+- A task deeper than maxDepth, or whose goal already appears in its ancestry chain, is not allowed to plan again.
+- A generated plan is fingerprinted (normalized node ids, edges and goal). If the same plan was already generated in the ancestry chain,
+the task is either forced to answer directly (type I), or the run is aborted, depending on onRepeatedPlan.
+When several runs share budgets (e.g. the problems of a batch), every run has its own governor with a shared parentGovernor,
+which checks and records the calls of all the runs too.
+"""
+class ExecutionGovernor:
+    def __init__(self, maxDepth=DEFAULT_MAX_DEPTH, maxCalls=DEFAULT_MAX_CALLS, maxTokens=DEFAULT_MAX_TOKENS, maxWallClockSeconds=DEFAULT_MAX_WALL_CLOCK_SECONDS, onRepeatedPlan=RepeatedPlanAction.FORCE_ANSWER, parentGovernor=None):
+        self.maxDepth = maxDepth
+        self.maxCalls = maxCalls
+        self.maxTokens = maxTokens
+        self.maxWallClockSeconds = maxWallClockSeconds
+        self.onRepeatedPlan = onRepeatedPlan
+        self.parentGovernor = parentGovernor
+        self.startedAt = time.monotonic()
+        self.calls = 0
+        self.tokens = 0
+        self.deepestDepth = 0
+        self.repeatedPlans = 0
+        self.forcedAnswers = 0
+
+    def elapsedSeconds(self):
+        return time.monotonic() - self.startedAt
+
+    def checkBudgets(self):
+        if self.calls >= self.maxCalls:
+            raise ExecutionAborted('call-budget', f'{self.calls} LLM calls were made (the limit is {self.maxCalls})')
+        if self.tokens >= self.maxTokens:
+            raise ExecutionAborted('token-budget', f'{self.tokens} tokens were used (the limit is {self.maxTokens})')
+        if self.elapsedSeconds() >= self.maxWallClockSeconds:
+            raise ExecutionAborted('wall-clock-budget', f'The run took {self.elapsedSeconds():.1f}s (the limit is {self.maxWallClockSeconds}s)')
+        if self.parentGovernor is not None:
+            self.parentGovernor.checkBudgets()
+
+    def recordCall(self, totalTokens):
+        self.calls += 1
+        self.tokens += totalTokens or 0
+        if self.parentGovernor is not None:
+            self.parentGovernor.recordCall(totalTokens)
+
+    # Adds the calls and tokens that a worker spent on a sub-plan of this run (see work_queue.py).
+    def recordRemoteCalls(self, calls, tokens):
+        self.calls += calls
+        self.tokens += tokens
+        if self.parentGovernor is not None:
+            self.parentGovernor.recordRemoteCalls(calls, tokens)
+
+    def recordDepth(self, depth):
+        self.deepestDepth = max(self.deepestDepth, depth)
+
+    @staticmethod
+    def normalizeText(text):
+        return ' '.join(re.sub(r'[^\w\s]', ' ', str(text or '').lower()).split())
+
+    @classmethod
+    def planFingerprint(cls, goal, nodes, edges):
+        normalizedNodes = sorted(cls.normalizeText(node.get('id')) for node in nodes if isinstance(node, dict))
+        normalizedEdges = sorted([cls.normalizeText(edge.get('source')), cls.normalizeText(edge.get('target'))] for edge in edges if isinstance(edge, dict))
+        keyMaterial = json.dumps([cls.normalizeText(goal), normalizedNodes, normalizedEdges])
+
+        return hashlib.sha256(keyMaterial.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def ancestors(task):
+        ancestor = task.parentTask
+        while ancestor is not None:
+            yield ancestor
+            ancestor = ancestor.parentTask
+
+    # Returns the reason why the task should not create a plan, or None if it may plan.
+    def findPlanningLoop(self, task):
+        if task.depth >= self.maxDepth:
+            return f'the recursion depth {task.depth} reached the limit of {self.maxDepth}'
+
+        normalizedGoal = self.normalizeText(task.goal)
+        for ancestor in self.ancestors(task):
+            if ancestor.planFingerprint is not None and self.normalizeText(ancestor.goal) == normalizedGoal:
+                return f'the goal "{task.goal}" is already being planned by an ancestor task'
+
+        return None
+
+    # Returns the reason why the plan is a repeat, or None if the plan is new in the task's ancestry chain.
+    def findRepeatedPlan(self, task, planFingerprint):
+        for ancestor in self.ancestors(task):
+            if ancestor.planFingerprint == planFingerprint:
+                self.repeatedPlans += 1
+                return f'the plan for "{task.goal}" repeats the plan of the ancestor task "{ancestor.humanReadableName}"'
+
+        return None
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'tokens': self.tokens,
+            'elapsedSeconds': round(self.elapsedSeconds(), 3),
+            'deepestDepth': self.deepestDepth,
+            'repeatedPlans': self.repeatedPlans,
+            'forcedAnswers': self.forcedAnswers,
+        }
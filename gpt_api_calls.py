@@ -1,74 +1,550 @@
+import asyncio
+import contextlib
+import json
 import os
+import time
+from collections import OrderedDict, deque
 
-from openai import OpenAI
+from enums import GPT, GPTOutputType, CacheMode, SystemMessage
+from llm_backends import LLMUsage, createBackend
+from prompts import JSON_REPAIR_PROMPT
+from rate_limits import RateLimiter, backoffSeconds, MAX_RETRIES
+from response_cache import ResponseCache
+from text_helpers import extractJSONSubstring, extractPythonCodeSubstring, repairJSONSubstring
+from tracing import NULL_SPAN, latencyPercentiles, percentileOf
 
-from enums import GPTOutputType
-from text_helpers import extractJSONSubstring, extractPythonCodeSubstring
+# Upper bounds on the number of LLM calls that can be in flight at the same time.
+MAX_CONCURRENT_CALLS = int(os.environ.get('GPT_MAX_CONCURRENT_CALLS', 16))
+MAX_CONCURRENT_CALLS_PER_MODEL = {
+    GPT.GPT4OMNI: int(os.environ.get('GPT_MAX_CONCURRENT_CALLS_GPT4OMNI', 8)),
+    GPT.GPT4OMNIMINI: int(os.environ.get('GPT_MAX_CONCURRENT_CALLS_GPT4OMNIMINI', 16)),
+}
 
-openAIAPIKey = os.environ['OPENAI_KEY_SECRET']
-client = OpenAI(api_key=openAIAPIKey) 
+# Responses are cached on disk, keyed by a hash of the request. GPT_CACHE_MODE can be 'readwrite', 'replay' or 'off'.
+RESPONSE_CACHE_PATH = os.environ.get('GPT_CACHE_PATH', '.gpt_cache.sqlite3')
+RESPONSE_CACHE_MODE = CacheMode(os.environ.get('GPT_CACHE_MODE', CacheMode.READ_WRITE.value))
+# Only calls at temperature 0 are cached, unless this is enabled.
+RESPONSE_CACHE_SAMPLED = os.environ.get('GPT_CACHE_SAMPLED', '0') == '1'
+# The temperature of the calls that don't set one (e.g. CODE calls).
+API_DEFAULT_TEMPERATURE = 1.0
 
+# When enabled, a call that is still running after the GPT_HEDGE_PERCENTILE latency of its model gets a duplicate (a hedge),
+# and the first valid response wins. Calls are only hedged once GPT_HEDGE_MIN_SAMPLES latencies of their model were observed.
+HEDGE_REQUESTS = os.environ.get('GPT_HEDGE_REQUESTS', '0') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('GPT_HEDGE_PERCENTILE', 0.95))
+HEDGE_MIN_SAMPLES = int(os.environ.get('GPT_HEDGE_MIN_SAMPLES', 20))
+# How many of the latest latencies of every model are kept.
+LATENCY_WINDOW = 500
 
-async def gpt(modelName, systemMessage, prompt, outputType):
+# JSON responses that can't be parsed, even after a local repair, are sent to this model to be fixed.
+JSON_REPAIR_MODEL = GPT.GPT4OMNIMINI
 
-    if outputType == GPTOutputType.TEXT:
-        response = client.chat.completions.create(
-        messages=[
-            {
-                "role": 'system',
-                "content": systemMessage.value
-            },
-                            {
-                "role": 'user',
-                "content": prompt,
-            }
-        ],
-        model=modelName.value,
-        temperature=1.0,
-        )
-        outputJSON = response.choices[0].message.content
+# The backend that gpt() and gptStream() send their requests to (see llm_backends.py). LLM_BACKEND picks it.
+backend = createBackend()
 
-        return (outputJSON, None)
 
-    elif outputType == GPTOutputType.JSON:
+# Replaces the module-level backend, e.g. with a SimulatedBackend for offline runs and benchmarks.
+def configureBackend(newBackend):
+    global backend
+    backend = newBackend
+
+    return backend
+
+
+# Roughly 4 characters per token. The rate limiter only needs an estimate, and corrects it with the actual usage.
+def estimateTokens(requestArgs):
+    return sum(len(message['content']) for message in requestArgs['messages']) // 4 + 1
+
+
+"""
+This class is a semaphore that is fair across tenants (e.g. the problems of a batch run).
+Every tenant has its own queue of waiting calls, and free slots go to the tenants in turn (round robin),
+so a tenant with many waiting calls (e.g. a deep recursion) can't starve the others. With a single tenant, it is a FIFO semaphore.
+"""
+class FairSemaphore:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.available = capacity
+        self.waitingCalls = OrderedDict()
+
+    async def acquire(self, tenant=None):
+        if self.available > 0 and not self.waitingCalls:
+            self.available -= 1
+            return
+
+        grant = asyncio.get_running_loop().create_future()
+        self.waitingCalls.setdefault(tenant, deque()).append(grant)
+        try:
+            await grant
+        except asyncio.CancelledError:
+            # A call that was cancelled after it got its slot gives the slot back.
+            if grant.done() and not grant.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.available += 1
+        while self.available > 0 and self.waitingCalls:
+            tenant, tenantCalls = self.waitingCalls.popitem(last=False)
+            grant = tenantCalls.popleft()
+            # The tenant goes to the back of the line.
+            if tenantCalls:
+                self.waitingCalls[tenant] = tenantCalls
+            if grant.done():
+                continue
+            self.available -= 1
+            grant.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, tenant=None):
+        await self.acquire(tenant)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+"""
+This class keeps the latencies of the latest calls of every model (a sliding window), and their percentiles.
+"""
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.latencies = dict()
+
+    def record(self, modelName, seconds):
+        if modelName not in self.latencies:
+            self.latencies[modelName] = deque(maxlen=self.window)
+        self.latencies[modelName].append(seconds)
+
+    # Returns None until the model has minSamples latencies.
+    def percentile(self, modelName, fraction, minSamples=1):
+        latencies = self.latencies.get(modelName)
+        if latencies is None or len(latencies) < minSamples:
+            return None
+
+        return percentileOf(sorted(latencies), fraction)
+
+    def stats(self):
+        return {modelName.value: latencyPercentiles(latencies) for modelName, latencies in self.latencies.items()}
+
+
+"""
+This class schedules the LLM calls.
+- Every call has to hold a slot in the global semaphore and a slot in the semaphore of its model. These semaphores are fair
+across tenants (see FairSemaphore). Calls that don't get a slot wait on the event loop, so independent plan branches
+still overlap their network latency without flooding the API.
+- Once it has its slots, a call waits until the rate limiter has room for it under the RPM and TPM limits of its model,
+so calls are queued instead of being rejected by the API, in the fair order of the semaphores.
+- Calls that fail with a transient error (a rate limit, a timeout, a connection or server error) are retried up to maxRetries times,
+with a jittered exponential backoff. A rate limit error also pauses the other calls of the model.
+- With hedging, a request that is slower than the hedgePercentile latency of its model is sent a second time, and the first valid
+response wins (see send). A hedge is only sent when a global slot is free, so hedges never queue in front of first requests,
+and only the slowest requests (about 1 - hedgePercentile of them) get one.
+"""
+class GPTDispatcher:
+    def __init__(self, maxConcurrentCalls, maxConcurrentCallsPerModel=None, rateLimiter=None, maxRetries=MAX_RETRIES, hedgeRequests=HEDGE_REQUESTS, hedgePercentile=HEDGE_PERCENTILE, hedgeMinSamples=HEDGE_MIN_SAMPLES):
+        self.maxConcurrentCalls = maxConcurrentCalls
+        self.maxConcurrentCallsPerModel = dict(maxConcurrentCallsPerModel or {})
+        self.globalSemaphore = FairSemaphore(maxConcurrentCalls)
+        self.modelSemaphores = dict()
+        self.rateLimiter = rateLimiter if rateLimiter is not None else RateLimiter()
+        self.maxRetries = maxRetries
+        self.inFlightCalls = 0
+        self.peakInFlightCalls = 0
+        self.retries = dict()
+        self.failedCalls = 0
+        self.promptTokens = 0
+        self.cachedPromptTokens = 0
+        self.hedgeRequests = hedgeRequests
+        self.hedgePercentile = hedgePercentile
+        self.hedgeMinSamples = hedgeMinSamples
+        self.hedgedCalls = 0
+        self.hedgeWins = 0
+        # The latency of every request (from which the hedges are timed), and of every call, retries and hedges included.
+        self.requestLatencies = LatencyTracker()
+        self.callLatencies = LatencyTracker()
+
+    # Models without an explicit limit are only bounded by the global limit.
+    def modelSemaphore(self, modelName):
+        if modelName not in self.modelSemaphores:
+            limit = self.maxConcurrentCallsPerModel.get(modelName, self.maxConcurrentCalls)
+            self.modelSemaphores[modelName] = FairSemaphore(limit)
+
+        return self.modelSemaphores[modelName]
+
+    # Holds a global slot and a slot of the model for as long as the call (or the stream) is running.
+    @contextlib.asynccontextmanager
+    async def slot(self, modelName, tenant=None, estimatedTokens=0):
+        async with self.globalSemaphore.hold(tenant):
+            async with self.modelSemaphore(modelName).hold(tenant):
+                await self.rateLimiter.acquire(modelName, estimatedTokens)
+                self.inFlightCalls += 1
+                self.peakInFlightCalls = max(self.peakInFlightCalls, self.inFlightCalls)
+                try:
+                    yield
+                finally:
+                    self.inFlightCalls -= 1
+
+    # Returns how long to wait before retrying the failed attempt, or None if the error must be raised.
+    def retryDelay(self, llmBackend, modelName, error, attempt):
+        reason = llmBackend.retryableError(error)
+        if reason is None or attempt >= self.maxRetries:
+            self.failedCalls += 1
+            return None
+
+        self.retries[reason] = self.retries.get(reason, 0) + 1
+        delay = backoffSeconds(attempt, llmBackend.retryAfterSeconds(error))
+        if reason == 'rate-limit':
+            self.rateLimiter.pause(modelName, delay)
+
+        return delay
+
+    # Sends the request, and returns (content, usage). The number of retries is set on the span of the call.
+    # recordUnusedCall(usage) is called for every other request that was sent for the call, but whose response was not used (see send).
+    async def dispatch(self, llmBackend, modelName, requestArgs, span=NULL_SPAN, tenant=None, recordUnusedCall=None):
+        estimatedTokens = estimateTokens(requestArgs)
+        startedAt = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                content, usage, headers = await self.send(llmBackend, modelName, requestArgs, span, tenant, estimatedTokens, recordUnusedCall)
+            except Exception as error:
+                delay = self.retryDelay(llmBackend, modelName, error, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                span.set(retries=attempt, retryError=type(error).__name__)
+                await asyncio.sleep(delay)
+                continue
+
+            self.recordUsage(modelName, estimatedTokens, usage, headers)
+            self.callLatencies.record(modelName, time.monotonic() - startedAt)
+
+            return (content, usage)
+
+    # Returns how long a request of the model can run before it is hedged, or None if it is not hedged.
+    def hedgeAfterSeconds(self, modelName):
+        if not self.hedgeRequests:
+            return None
+
+        return self.requestLatencies.percentile(modelName, self.hedgePercentile, self.hedgeMinSamples)
+
+    # A JSON response that can't be parsed loses to one that can.
+    @staticmethod
+    def isValidResponse(requestArgs, content):
+        if requestArgs.get('response_format') is not None:
+            return extractJSONSubstring(content) is not None
+
+        return bool(content)
+
+    # The request is added to sentRequests once it got its slot, i.e. once the provider starts to bill it.
+    async def request(self, llmBackend, modelName, requestArgs, tenant, estimatedTokens, sentRequests=None):
+        startedAt = time.monotonic()
+        async with self.slot(modelName, tenant, estimatedTokens):
+            if sentRequests is not None:
+                sentRequests.add(asyncio.current_task())
+            response = await llmBackend.complete(requestArgs)
+        self.requestLatencies.record(modelName, time.monotonic() - startedAt)
+
+        return response
+
+    # Sends the request, with a hedge if it is slow. Returns the first valid response, or else the first response, and cancels the other request.
+    # It only fails if every request failed.
+    # The request whose response is not used was still billed: a response that arrived is recorded with its usage,
+    # and a request that was cancelled after it was sent is recorded with its estimated prompt tokens.
+    # Both are counted by the rate limiter, and passed to recordUnusedCall (e.g. to charge them to the run's governor).
+    async def send(self, llmBackend, modelName, requestArgs, span, tenant, estimatedTokens, recordUnusedCall=None):
+        hedgeAfterSeconds = self.hedgeAfterSeconds(modelName)
+        if hedgeAfterSeconds is None:
+            return await self.request(llmBackend, modelName, requestArgs, tenant, estimatedTokens)
+
+        sentAt = time.monotonic()
+        sentRequests = set()
+        usedRequest = None
+        requests = [asyncio.ensure_future(self.request(llmBackend, modelName, requestArgs, tenant, estimatedTokens, sentRequests))]
+        try:
+            await asyncio.wait(requests, timeout=hedgeAfterSeconds)
+            if not requests[0].done() and self.globalSemaphore.available > 0:
+                self.hedgedCalls += 1
+                span.set(hedged=True)
+                requests.append(asyncio.ensure_future(self.request(llmBackend, modelName, requestArgs, tenant, estimatedTokens, sentRequests)))
+
+            pendingRequests = set(requests)
+            firstRequest = None
+            lastError = None
+            while pendingRequests:
+                doneRequests, pendingRequests = await asyncio.wait(pendingRequests, return_when=asyncio.FIRST_COMPLETED)
+                for doneRequest in doneRequests:
+                    if doneRequest.exception() is not None:
+                        lastError = doneRequest.exception()
+                        continue
+                    response = doneRequest.result()
+                    if self.isValidResponse(requestArgs, response[0]):
+                        if doneRequest is not requests[0]:
+                            self.hedgeWins += 1
+                            span.set(hedgeWon=True)
+                            # The first request is cancelled, but its latency still counts (at least this long), or the percentile
+                            # would only see the fast hedges, and drift down.
+                            if not requests[0].done():
+                                self.requestLatencies.record(modelName, time.monotonic() - sentAt)
+                        usedRequest = doneRequest
+                        return response
+                    if firstRequest is None:
+                        firstRequest = doneRequest
+
+            if firstRequest is not None:
+                usedRequest = firstRequest
+                return firstRequest.result()
+            raise lastError
+        finally:
+            for request in requests:
+                if request is usedRequest:
+                    continue
+                if not request.done():
+                    request.cancel()
+                    if request in sentRequests:
+                        self.recordUnusedRequest(modelName, estimatedTokens, LLMUsage(estimatedTokens, 0), None, recordUnusedCall)
+                # The error of a request that lost doesn't matter, but it is retrieved, so asyncio doesn't report it.
+                elif not request.cancelled() and request.exception() is None:
+                    _, usage, headers = request.result()
+                    self.recordUnusedRequest(modelName, estimatedTokens, usage, headers, recordUnusedCall)
+
+    def recordUnusedRequest(self, modelName, estimatedTokens, usage, headers, recordUnusedCall):
+        self.recordUsage(modelName, estimatedTokens, usage, headers)
+        if recordUnusedCall is not None:
+            recordUnusedCall(usage)
+
+    # Called after every call that reached the API, whether it was streamed or not.
+    def recordUsage(self, modelName, estimatedTokens, usage, headers):
+        self.rateLimiter.record(modelName, estimatedTokens, usage, headers)
+        self.promptTokens += getattr(usage, 'prompt_tokens', 0) or 0
+        self.cachedPromptTokens += cachedPromptTokens(usage)
+
+    def stats(self):
+        return {
+            'peakInFlightCalls': self.peakInFlightCalls,
+            'retries': dict(self.retries),
+            'failedCalls': self.failedCalls,
+            'promptTokens': self.promptTokens,
+            'cachedPromptTokens': self.cachedPromptTokens,
+            'promptCacheHitRate': round(self.cachedPromptTokens / self.promptTokens, 3) if self.promptTokens else 0.0,
+            'hedgedCalls': self.hedgedCalls,
+            'hedgeWins': self.hedgeWins,
+            'latency': self.callLatencies.stats(),
+            'rateLimits': self.rateLimiter.stats(),
+        }
+
+
+dispatcher = GPTDispatcher(MAX_CONCURRENT_CALLS, MAX_CONCURRENT_CALLS_PER_MODEL)
+
+
+# Replaces the module-level dispatcher. Call this before starting a run, not while calls are in flight.
+def configureDispatcher(maxConcurrentCalls=MAX_CONCURRENT_CALLS, maxConcurrentCallsPerModel=None, rateLimiter=None, maxRetries=MAX_RETRIES, hedgeRequests=HEDGE_REQUESTS):
+    global dispatcher
+    if maxConcurrentCallsPerModel is None:
+        maxConcurrentCallsPerModel = MAX_CONCURRENT_CALLS_PER_MODEL
+    dispatcher = GPTDispatcher(maxConcurrentCalls, maxConcurrentCallsPerModel, rateLimiter, maxRetries, hedgeRequests)
+
+    return dispatcher
+
 
-        response = client.chat.completions.create(
-        messages=[
+responseCache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MODE, cacheSampledResponses=RESPONSE_CACHE_SAMPLED)
+
+
+# Replaces the module-level response cache. Use CacheMode.REPLAY to make runs fail on any request that is not cached.
+def configureResponseCache(path=RESPONSE_CACHE_PATH, mode=RESPONSE_CACHE_MODE, cacheSampledResponses=RESPONSE_CACHE_SAMPLED, **cacheOptions):
+    global responseCache
+    responseCache.close()
+    responseCache = ResponseCache(path, mode, cacheSampledResponses=cacheSampledResponses, **cacheOptions)
+
+    return responseCache
+
+
+async def closeClient():
+    await backend.close()
+    responseCache.close()
+
+
+def buildRequestArgs(modelName, systemMessage, prompt, outputType):
+    requestArgs = {
+        'messages': [
             {
                 "role": 'system',
                 "content": systemMessage.value
             },
-                            {
+            {
                 "role": 'user',
                 "content": prompt,
             }
         ],
-        response_format={ "type": "json_object" },
-        model=modelName.value,
-        temperature=0.0,
-        )
+        'model': modelName.value,
+    }
+
+    if outputType == GPTOutputType.TEXT:
+        requestArgs['temperature'] = 1.0
+    elif outputType == GPTOutputType.JSON:
+        requestArgs['response_format'] = { "type": "json_object" }
+        requestArgs['temperature'] = 0.0
+
+    return requestArgs
+
+
+def cacheKeyFor(modelName, systemMessage, prompt, outputType, requestArgs):
+    return responseCache.keyFor(modelName.value, systemMessage.value, prompt, outputType.value, requestArgs.get('temperature'))
+
+
+# The calls of a run are scheduled fairly with the calls of the other runs of the same process (see FairSemaphore).
+def tenantOf(executionContext):
+    return executionContext.runID if executionContext is not None else None
+
+
+# Calls without an execution context are not traced.
+def traceLLMCall(executionContext, modelName, outputType, activate=True):
+    if executionContext is None:
+        return NULL_SPAN
+
+    return executionContext.tracer.span(f'{modelName.value} {outputType.value}', 'llm', activate=activate, model=modelName.value, retries=0)
+
+
+# The prompt tokens that the provider served from its prompt prefix cache. They are processed faster, and billed at a discount.
+def cachedPromptTokens(usage):
+    promptTokensDetails = getattr(usage, 'prompt_tokens_details', None)
+
+    return getattr(promptTokensDetails, 'cached_tokens', 0) or 0
+
+
+def usageAttributes(usage):
+    promptTokens = getattr(usage, 'prompt_tokens', 0) or 0
+    cachedTokens = cachedPromptTokens(usage)
+
+    return {
+        'promptTokens': promptTokens,
+        'cachedPromptTokens': cachedTokens,
+        'uncachedPromptTokens': promptTokens - cachedTokens,
+        'completionTokens': getattr(usage, 'completion_tokens', 0) or 0,
+    }
+
+
+# Repairs a JSON response that can't be parsed. The usual problems are fixed locally, and only what is left is sent to
+# JSON_REPAIR_MODEL, with nothing but the broken text, which costs far less than asking the whole question again.
+# Returns the parsed JSON, or None if it can't be repaired.
+async def repairJSONResponse(brokenResponse, executionContext, span):
+    outputJSON = repairJSONSubstring(brokenResponse)
+    if outputJSON is not None:
+        span.set(jsonRepair='local')
+        return outputJSON
+
+    if not brokenResponse or not brokenResponse.strip():
+        span.set(jsonRepair='failed')
+        return None
 
-        outputJSON = response.choices[0].message.content
-        outputJSON = extractJSONSubstring(outputJSON)
+    prompt = JSON_REPAIR_PROMPT.render(text=brokenResponse)
+    outputJSON, _ = await gpt(JSON_REPAIR_MODEL, SystemMessage.EMPTY, prompt, GPTOutputType.JSON, executionContext, repairJSON=False)
+    span.set(jsonRepair='llm' if outputJSON is not None else 'failed')
 
+    return outputJSON
+
+
+# When an execution context is given, the call is checked against the run's budgets, its token usage is recorded, and it is traced.
+# JSON responses that can't be parsed are repaired (see repairJSONResponse) unless repairJSON is False.
+async def gpt(modelName, systemMessage, prompt, outputType, executionContext=None, repairJSON=True):
+    requestArgs = buildRequestArgs(modelName, systemMessage, prompt, outputType)
+    cacheKey = cacheKeyFor(modelName, systemMessage, prompt, outputType, requestArgs)
+    outputJSON = None
+
+    with traceLLMCall(executionContext, modelName, outputType) as span:
+        fullResponse = await responseCache.get(cacheKey, requestArgs.get('temperature', API_DEFAULT_TEMPERATURE))
+        span.set(cacheHit=fullResponse is not None)
+
+        if fullResponse is None:
+            if executionContext is not None:
+                executionContext.beforeLLMCall()
+            recordUnusedCall = (lambda unusedUsage: executionContext.recordLLMCall(modelName, unusedUsage)) if executionContext is not None else None
+            fullResponse, usage = await dispatcher.dispatch(backend, modelName, requestArgs, span, tenantOf(executionContext), recordUnusedCall)
+            if executionContext is not None:
+                executionContext.recordLLMCall(modelName, usage)
+            span.set(**usageAttributes(usage))
+
+            if outputType == GPTOutputType.JSON:
+                outputJSON = extractJSONSubstring(fullResponse)
+                if outputJSON is None and repairJSON:
+                    outputJSON = await repairJSONResponse(fullResponse, executionContext, span)
+                    # The repaired JSON is cached, so the next run doesn't have to repair it again.
+                    if outputJSON is not None:
+                        fullResponse = json.dumps(outputJSON, ensure_ascii=False)
+
+            # Don't cache JSON responses that can't be parsed, so the next run asks again.
+            if outputType != GPTOutputType.JSON or outputJSON is not None:
+                await responseCache.put(cacheKey, modelName.value, fullResponse, requestArgs.get('temperature', API_DEFAULT_TEMPERATURE))
+
+        elif outputType == GPTOutputType.JSON:
+            outputJSON = extractJSONSubstring(fullResponse)
+
+    if outputType == GPTOutputType.TEXT:
+        return (fullResponse, None)
+
+    elif outputType == GPTOutputType.JSON:
         return (outputJSON, None)
 
     elif outputType == GPTOutputType.CODE:
-
-        response = client.chat.completions.create(
-        messages=[
-            {
-                "role": 'system',
-                "content": systemMessage.value
-            },
-                            {
-                "role": 'user',
-                "content": prompt,
-            }
-        ],
-        model=modelName.value,
-        )
-        fullResponse = response.choices[0].message.content
         outputJSON = extractPythonCodeSubstring(fullResponse)
 
-        return (outputJSON, fullResponse)
\ No newline at end of file
+        return (outputJSON, fullResponse)
+
+
+# Streams a JSON completion, and yields its text as it arrives. A cached response is yielded as a single chunk.
+# The request is the same as gpt()'s JSON request, so both share the same cache entries.
+# The span of the call is not activated, since the generator runs in the context of the code that iterates it.
+# A stream is only retried if it failed before its first chunk, since the chunks that were yielded can't be taken back.
+async def gptStream(modelName, systemMessage, prompt, executionContext=None):
+    outputType = GPTOutputType.JSON
+    requestArgs = buildRequestArgs(modelName, systemMessage, prompt, outputType)
+    cacheKey = cacheKeyFor(modelName, systemMessage, prompt, outputType, requestArgs)
+
+    with traceLLMCall(executionContext, modelName, outputType, activate=False) as span:
+        cachedResponse = await responseCache.get(cacheKey, requestArgs.get('temperature', API_DEFAULT_TEMPERATURE))
+        span.set(cacheHit=cachedResponse is not None, streamed=True)
+
+        if cachedResponse is not None:
+            yield cachedResponse
+            return
+
+        if executionContext is not None:
+            executionContext.beforeLLMCall()
+
+        responseChunks = []
+        usage = None
+        headers = None
+        estimatedTokens = estimateTokens(requestArgs)
+        startedAt = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                async with dispatcher.slot(modelName, tenantOf(executionContext), estimatedTokens):
+                    async for textChunk, chunkUsage, chunkHeaders in backend.stream(requestArgs):
+                        if chunkHeaders is not None:
+                            headers = chunkHeaders
+                        if chunkUsage is not None:
+                            usage = chunkUsage
+                        if textChunk:
+                            responseChunks.append(textChunk)
+                            yield textChunk
+                break
+            except Exception as error:
+                delay = None if responseChunks else dispatcher.retryDelay(backend, modelName, error, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                span.set(retries=attempt, retryError=type(error).__name__)
+                await asyncio.sleep(delay)
+
+        dispatcher.recordUsage(modelName, estimatedTokens, usage, headers)
+        dispatcher.callLatencies.record(modelName, time.monotonic() - startedAt)
+        if executionContext is not None:
+            executionContext.recordLLMCall(modelName, usage)
+        span.set(**usageAttributes(usage))
+
+        fullResponse = ''.join(responseChunks)
+        if extractJSONSubstring(fullResponse) is not None:
+            await responseCache.put(cacheKey, modelName.value, fullResponse, requestArgs.get('temperature', API_DEFAULT_TEMPERATURE))
@@ -1,10 +1,18 @@
 import networkx as nx
 import asyncio
+import os
+import time
+from collections import deque
 
 from gpt_api_calls import gpt
-from enums import GPT, GPTOutputType
+from deadlines import TIMED_OUT
+from prompts import NEXT_TASK_PROMPT
+from enums import GPTOutputType
 from enums import SystemMessage
-    
+
+# The maximum number of tasks of a single graph that can be running at the same time.
+DEFAULT_MAX_WIDTH = int(os.environ.get('GRAPH_MAX_WIDTH', 8))
+
 """
 This class represents a graph that can run an algorithm.
 The nodes in this graph are tasks, and the edges are dependencies between the tasks.
@@ -13,125 +21,437 @@ Notice that this implementation is agnostic of the task type.
 To understand how this helps achieve AGI, we need to understand the PlanningTask that we run on this graph.
 """
 class AlgorithmGraph:
-    # We initiate the graph by providing an edges array between the tasks.
+    # We initiate the graph by providing an edges array between the tasks, and the parent task that the graph resolves.
     # The array looks like this: [(Task 1, Task 2), (Task 2, Task 3), ...]
-    def __init__(self, edgesArray):
+    # maxWidth bounds how many tasks of this graph can be running at the same time.
+    # A graph can also be built while it runs (isSealed=False): tasks and edges are added as the plan streams in, and seal() is called
+    # once the whole plan is known.
+    def __init__(self, edgesArray, parentTask, maxWidth=DEFAULT_MAX_WIDTH, isSealed=True):
         self.edgesArray = edgesArray
-        # TODO: Change startTask to be more programmatic from the graph
-        self.startTask = edgesArray[0][0]
+        self.parentTask = parentTask
         self.graph = nx.DiGraph()
         self.finalResult = None
-        self.taskCache = dict()
+        self.isFinished = False
+        # The task cache is shared across the whole recursion tree, so a subgoal solved in one sub-plan is reused in all the others.
+        self.taskCache = parentTask.executionContext.taskCache
+        self.maxWidth = maxWidth
+        # The graph works on its own view of the parent's state history. Every task runs on a fork of this view,
+        # and its new steps are added to it once the task finishes.
+        self.state = parentTask.state.fork()
+
+        # Scheduler state: the number of unfinished predecessors of every scheduled task, the tasks that a finished predecessor selected,
+        # the tasks that are ready to start, and the successors selected by every finished task (None means all of them).
+        self.remainingPredecessors = dict()
+        self.selectedTasks = set()
+        self.readyTasks = deque()
+        self.resolvedSelections = dict()
+        # Tasks whose predecessors are not fully known yet. They are scheduled when the graph is sealed.
+        self.unscheduledTasks = []
+        self.isSealed = False
+        self.sealedEvent = asyncio.Event()
+        self.changedEvent = asyncio.Event()
+        # Successors of conditional tasks that started before the decision was made.
+        self.conditionEngine = parentTask.executionContext.conditionEngine
+        self.speculativeRuns = dict()
+        self.speculationTimes = dict()
+        self.tracer = parentTask.executionContext.tracer
+        # Set when the graph is built from a compiled plan.
+        self.compiledPlan = None
+        self.checkpoint = parentTask.executionContext.checkpoint
+        # The graph has to finish before the deadline of the task it resolves, or its own, if it is earlier (see deadlines.py).
+        self.deadlines = parentTask.executionContext.deadlines
+        self.deadlineAt = self.deadlines.graphDeadline(parentTask.deadlineAt)
 
         self.assignEdgesToGraph()
+        self.unscheduledTasks.extend(self.graph.nodes)
+        if isSealed:
+            self.seal()
+
+    # Builds the graph of a compiled plan (see plan_compiler.py). tasks[i] is the task of node i.
+    # The tasks are added in topological order, so the tasks that are ready at the same time start in the order of the plan.
+    @classmethod
+    def fromCompiledPlan(cls, compiledPlan, tasks, parentTask, maxWidth=DEFAULT_MAX_WIDTH):
+        algorithmGraph = cls([], parentTask, maxWidth, isSealed=False)
+        algorithmGraph.compiledPlan = compiledPlan
+        algorithmGraph.graph.add_nodes_from(tasks[index] for index in compiledPlan.topologicalOrder)
+        algorithmGraph.graph.add_edges_from((tasks[sourceIndex], tasks[targetIndex]) for sourceIndex, targetIndex in compiledPlan.edges)
+        algorithmGraph.unscheduledTasks.extend(algorithmGraph.graph.nodes)
+        algorithmGraph.seal()
+
+        return algorithmGraph
 
     # This function takes in the edges we provided to the graph, and uses networkx's graph function to add them to the graph.
     def assignEdgesToGraph(self):
         self.graph.add_edges_from(self.edgesArray)
-    
+
+    # Adds a task while the graph is being built. If its predecessors are given, they must be all of its predecessors,
+    # and the task is scheduled right away. Otherwise, it waits until the graph is sealed, and its predecessors come from the edges.
+    # END always waits until the graph is sealed, since the repairs of the complete plan can still add edges into it
+    # (e.g. from a node without successors), and END must not run before them.
+    def addTask(self, task, predecessors=None):
+        self.graph.add_node(task)
+        if predecessors is None or self.isSealed:
+            self.unscheduledTasks.append(task)
+        elif task.humanReadableName == 'END' or task.humanReadableName == 'DONE':
+            self.graph.add_edges_from((predecessor, task) for predecessor in predecessors)
+            self.unscheduledTasks.append(task)
+        else:
+            self.graph.add_edges_from((predecessor, task) for predecessor in predecessors)
+            self.scheduleTasks([task])
+
+    # Adds an edge while the graph is being built. Edges can only add predecessors to tasks that are not scheduled yet.
+    def addEdge(self, sourceTask, targetTask):
+        if self.graph.has_edge(sourceTask, targetTask):
+            return
+        if targetTask in self.remainingPredecessors:
+            self.tracer.log(f'~~ Ignoring edge: {sourceTask.humanReadableName} -> {targetTask.humanReadableName} (the target was already scheduled)')
+            return
+        self.graph.add_edge(sourceTask, targetTask)
+
+    # Marks the plan as complete, and schedules all the tasks that were waiting for their predecessors.
+    def seal(self):
+        unscheduledTasks = [task for task in self.unscheduledTasks if task not in self.remainingPredecessors]
+        self.unscheduledTasks = []
+        self.isSealed = True
+        self.scheduleTasks(unscheduledTasks)
+        self.sealedEvent.set()
+        self.changedEvent.set()
+
+    def scheduleTasks(self, tasks):
+        for task in tasks:
+            predecessors = list(self.graph.predecessors(task))
+            self.remainingPredecessors[task] = sum(1 for predecessor in predecessors if predecessor not in self.resolvedSelections)
+            if not predecessors or any(self.isSelectedBy(predecessor, task) for predecessor in predecessors):
+                self.selectedTasks.add(task)
+
+        for task in tasks:
+            if self.remainingPredecessors[task] == 0 and task not in self.resolvedSelections:
+                self.releaseTask(task)
+        self.changedEvent.set()
+
+    def isSelectedBy(self, predecessor, task):
+        if predecessor not in self.resolvedSelections:
+            return False
+        selection = self.resolvedSelections[predecessor]
+
+        return selection is None or task in selection
+
+    # Called when all the predecessors of a task are finished. The task runs if at least one of them selected it.
+    def releaseTask(self, task):
+        if task in self.selectedTasks:
+            self.readyTasks.append(task)
+        else:
+            # No predecessor picked this task, so it is skipped, and so are the tasks that only it leads to.
+            self.tracer.log(f'~~ Skipping Task: {task.humanReadableName}')
+            self.resolveTask(task, ())
+
     # This function actually executes the running/stepping through a graph.
-    # Provide it with the graph and the task, and it will recursively keep stepping through the graph until the END node is reached for the main graph.
-    async def runThroughGraph(self, graph, task):
+    # It is a ready-queue scheduler: every task keeps a count of its predecessors that have not finished yet,
+    # and a task is started (exactly once) as soon as that count reaches zero.
+    # A task only runs if at least one of its predecessors selected it. Conditional tasks select a single successor,
+    # so the successors they did not pick are skipped, and the skip is propagated to everything that only they lead to.
+    # Tasks that can't matter anymore are cancelled, with everything under them: all of them when the graph reaches its deadline,
+    # and the ones that are still running once END ran.
+    async def runThroughGraph(self, graph):
+        runningTasks = dict()
+
+        try:
+            while True:
+                while self.readyTasks and len(runningTasks) < self.maxWidth:
+                    task = self.readyTasks.popleft()
+                    task.deadlineAt = self.deadlines.nodeDeadline(task, self.deadlineAt)
+                    runningTasks[asyncio.ensure_future(self.runTaskBeforeDeadline(graph, task))] = task
+
+                if not runningTasks and self.isSealed:
+                    break
+
+                # Wake up when a task finishes, when the graph changes while it is being built, or at the deadline of the graph.
+                self.changedEvent.clear()
+                changedFuture = asyncio.ensure_future(self.changedEvent.wait())
+                doneFutures, _ = await asyncio.wait([*runningTasks.keys(), changedFuture], timeout=self.deadlines.remainingSeconds(self.deadlineAt), return_when=asyncio.FIRST_COMPLETED)
+                changedFuture.cancel()
+
+                for future in doneFutures:
+                    if future is changedFuture:
+                        continue
+                    task = runningTasks.pop(future)
+                    self.resolveTask(task, future.result())
+
+                if self.isFinished and (runningTasks or self.readyTasks):
+                    self.tracer.log(f'~~ Graph of task {self.parentTask.humanReadableName} is done, cancelling: {[task.humanReadableName for task in [*runningTasks.values(), *self.readyTasks]]}')
+                    self.deadlines.obsoleteTasks += len(runningTasks) + len(self.readyTasks)
+                    self.readyTasks.clear()
+                    await self.cancelTasks(runningTasks)
+                    break
+
+                if time.monotonic() >= self.deadlineAt:
+                    self.tracer.log(f'~~ Graph of task {self.parentTask.humanReadableName} reached its deadline')
+                    self.deadlines.timedOutGraphs += 1
+                    self.readyTasks.clear()
+                    timedOutTasks = list(runningTasks.values())
+                    await self.cancelTasks(runningTasks)
+                    for task in timedOutTasks:
+                        self.timeOutTask(task)
+                    break
+        finally:
+            # If the graph fails or gets cancelled, don't leave its tasks running in the background.
+            for future in runningTasks:
+                future.cancel()
+            for speculativeRun in self.speculativeRuns.values():
+                speculativeRun.cancel()
+
+        return self.finalResult
+
+    # Cancels the running tasks, and waits until they (and everything under them) have stopped.
+    @staticmethod
+    async def cancelTasks(runningTasks):
+        for future in runningTasks:
+            future.cancel()
+        await asyncio.gather(*runningTasks, return_exceptions=True)
+        runningTasks.clear()
+
+    # Runs a task that has a deadline of its own (see deadlines.py). A task that misses it is cancelled, and its successors still run.
+    # A conditional task that misses it has no result to decide on, so its default successor runs (see ConditionEngine.defaultSuccessor),
+    # and the TIMED OUT step tells the tasks after it why.
+    async def runTaskBeforeDeadline(self, graph, task):
+        if task.deadlineAt >= self.deadlineAt:
+            return await self.runTask(graph, task)
+
+        try:
+            return await asyncio.wait_for(self.runTask(graph, task), self.deadlines.remainingSeconds(task.deadlineAt))
+        except TimeoutError:
+            # The task itself can time out for its own reasons (e.g. a network timeout), and then the error is not about the deadline.
+            if time.monotonic() < task.deadlineAt:
+                raise
+            self.timeOutTask(task)
+            if task.isConditionalNode is not True:
+                return None
+
+            await self.sealedEvent.wait()
+            successors = list(graph.successors(task))
+            if len(successors) <= 1:
+                return None
+            nextTask = self.conditionEngine.defaultSuccessor(successors)
+            self.tracer.log(f'~~ Task: {task.humanReadableName} timed out before it could decide. Going to Run Next: {nextTask.humanReadableName}')
+
+            return (nextTask,)
+
+    # The task is not recorded as finished, so a resumed run runs it again.
+    def timeOutTask(self, task):
+        self.tracer.log(f'~~ Task: {task.humanReadableName} timed out')
+        self.deadlines.timedOutTasks += 1
+        self.state.append({task.humanReadableName: TIMED_OUT})
+        task.collapse()
+
+    # Marks a task as finished and releases the successors whose predecessors are now all finished.
+    # selectedSuccessors is None when the task selects all of its successors (including the ones that are added later).
+    def resolveTask(self, task, selectedSuccessors):
+        resolvedTasks = [(task, selectedSuccessors)]
+
+        while resolvedTasks:
+            resolvedTask, selection = resolvedTasks.pop()
+            self.resolvedSelections[resolvedTask] = selection
+            for successor in self.graph.successors(resolvedTask):
+                if successor not in self.remainingPredecessors:
+                    continue
+                if selection is None or successor in selection:
+                    self.selectedTasks.add(successor)
+
+                self.remainingPredecessors[successor] -= 1
+                if self.remainingPredecessors[successor] == 0:
+                    if successor in self.selectedTasks:
+                        self.readyTasks.append(successor)
+                    else:
+                        self.tracer.log(f'~~ Skipping Task: {successor.humanReadableName}')
+                        resolvedTasks.append((successor, ()))
+
+    # Runs a single task, and returns the successors that should run after it.
+    async def runTask(self, graph, task):
         if task.humanReadableName == 'END' or task.humanReadableName == 'DONE':
+            # Tasks that are still streaming in could lead to END, so END waits for the whole plan.
+            await self.sealedEvent.wait()
+            self.finishGraph()
+            return ()
+
+        # A task that already started speculatively (while its conditional predecessor was deciding) is adopted instead of started again.
+        speculativeRun = self.speculativeRuns.pop(task, None)
+        if speculativeRun is not None:
+            branchState = await speculativeRun
+            task.isSpeculative = False
+            if task.answer is not None and task.parentTask is not None:
+                task.parentTask.latestOutput = task.answer
+        else:
+            branchState = await self.executeTask(task)
+
+        newSteps = branchState.newSteps()
+        self.state.extend(newSteps)
+        if not task.isRestored:
+            self.checkpoint.recordTaskFinished(task, newSteps)
+
+        # If task is conditional, we will choose the successor who matches the condition.
+        # Its successors are only all known once the plan is complete.
+        if task.isConditionalNode is True:
+            await self.sealedEvent.wait()
+            successors = list(graph.successors(task))
+            if len(successors) > 1:
+                nextTask = await self.chooseSuccessor(task, successors)
+                self.tracer.log(f'~~ Picked: {nextTask.humanReadableName}')
+                task.collapse()
+                return (nextTask,)
+
+        if self.tracer.verbose:
+            self.tracer.log(f'~~ Task: {task.humanReadableName} is not conditional. Going to Run Next: {[successor.humanReadableName for successor in graph.successors(task)]}')
+
+        task.collapse()
+        # No need for successorsResults because each node will add its output to the state
+        return None
+
+    # Runs the task on its own branch of the state history, and returns the branch. The caller adds the branch's steps to the graph.
+    async def executeTask(self, task):
+        # Parallel branches don't see each other's steps until they finish.
+        branchState = self.state.fork()
+        task.state = branchState
+
+        # A task that finished before the run was resumed is not run again: its recorded steps are added instead.
+        restoredTask = self.checkpoint.restoredTask(task)
+        if restoredTask is not None:
+            self.tracer.log(f'~~ Task: {task.humanReadableName} was restored from the checkpoint')
+            task.restore(restoredTask['result'], restoredTask['answer'], restoredTask['steps'])
+            return branchState
 
-            # TODO: NEED TO DECIDE BETWEEN CODE BLOCK #1 (Removing subtasks) AND CODE BLOCK #2 (Keeping subtasks)
-            #CODE BLOCK #1 (CURRENTLY ACTIVE): Adding this code to remove subTasks and update parent task with latest task state
-            if task.parentTask is not None and (task.parentTask.reasoningType == 'type II' or task.parentTask.reasoningType == 'II'):
-                parentStateIndex = -1
-                for stateIndex, stateItem in enumerate(task.state):
-                    for stateKey in stateItem.keys():
-                        if stateItem.get(stateKey) == task.parentTask.humanReadableName:
-                            parentStateIndex = stateIndex
-                if parentStateIndex > -1:
-                    task.state[parentStateIndex][task.parentTask.humanReadableName] = task.parentTask.latestOutput
-                task.state = task.state[: parentStateIndex + 1]
-            else:
-                task.state.append({task.parentTask.humanReadableName: 'DONE'})    
-
-            # CODE BLOCK #2 (CURRENTLY COMMENTED): 
-            # task.state.append({task.parentTask.humanReadableName: 'DONE'})
-
-            print('~~ RETURNING ........')
-            return task.state
-        
-        # Recursively calculate results for successors
-        
-        # TODO: Allow multiple successors for a node. If the node is a decision/conditional node, some successors will be filtered.
-        #successors = []
-        #allSuccessors = filter graph.successors(task)
-        #for successor in allSuccessors:
-        #   edge = graph.edges[task, successor]:
-        #   edgeAttributes = edge['attributes']
-        #   edgeType = edgeAttributes['type']
-        #   if edgeType == 'conditional':
-        #       condition = edgeAttributes['condition']
-        #       conditionKey = condition.getkeys()[0]
-        #       if conditionKey in task.state:
-        #           valueFromState = task.state[conditionKey]
-        #           valueFromCondition = condition[conditionKey] # This needs to be done using an LLM call
-        #           if valueFromState == valueFromCondition:
-        #               successors.append(successor)
-        #   else:
-        #       successors.append(successor)       
-        
         # This is a caching mechanism to prevent running the same task with same inputs multiple times.
-        # If a task is in the cache, we will use the cached result.
+        # If a task is in the cache (or the same task is already running elsewhere), we will use the cached result.
         # If a task is NOT in the cache, we will run the task by calling its "run" method.
-        if task.humanReadableName not in self.taskCache:
-            await task.run()
-        else:
-            task.state.append({task.humanReadableName: self.taskCache[task.humanReadableName]})
+        fingerprint = self.taskCache.fingerprint(task)
+        result, computedHere = await self.taskCache.getOrCompute(fingerprint, task)
+        if not computedHere:
+            self.tracer.log(f'~~ Task: {task.humanReadableName} reused a cached result')
+            task.applyAnswer(result)
+
+        return branchState
+
+    # Conditions are evaluated locally first. Only the ones that can't be decided locally go to the LLM.
+    # In speculative mode, the successors that are still possible start running while the LLM decides, and the losers are cancelled.
+    async def chooseSuccessor(self, task, successors):
+        with self.tracer.span(f'decide after {task.humanReadableName}', 'decision', candidates=len(successors)) as span:
+            nextTask, verdicts = self.conditionEngine.pickSuccessor(successors, task.state)
+            if nextTask is not None:
+                self.tracer.log(f'~~ Task: {task.humanReadableName} is conditional (decided locally)')
+                span.set(local=True, picked=nextTask.humanReadableName)
+                return nextTask
+
+            self.tracer.log(f'~~ Task: {task.humanReadableName} ({task.task}) is conditional')
+            speculativeTasks = []
+            if self.conditionEngine.speculate:
+                speculativeTasks = self.startSpeculativeRuns(successors, verdicts)
+
+            try:
+                restoredPick = self.checkpoint.restoredPick(task)
+                restoredTasks = [successor for successor in successors if successor.humanReadableName == restoredPick]
+                if restoredTasks:
+                    nextTask = restoredTasks[0]
+                else:
+                    formattedStateHistory, _ = await task.executionContext.contextManager.buildContext(task)
+                    decisionStartedAt = time.monotonic()
+                    nextTask = await self.pickNextTask(formattedStateHistory, successors)
+                    self.conditionEngine.recordLLMDecision(time.monotonic() - decisionStartedAt)
+                    self.checkpoint.recordPick(task, nextTask)
+            finally:
+                for speculativeTask in speculativeTasks:
+                    if speculativeTask is not nextTask:
+                        self.cancelSpeculativeRun(speculativeTask)
+            span.set(local=False, picked=nextTask.humanReadableName, speculativeRuns=len(speculativeTasks))
+
+        if nextTask in speculativeTasks:
+            # The time saved is how long the winner ran before the decision (or until it finished, if it finished earlier).
+            startedAt, finishedAt = self.speculationTimes.pop(nextTask)
+            self.conditionEngine.speculativeWins += 1
+            self.conditionEngine.speculativeHeadStartSeconds += min(finishedAt or time.monotonic(), time.monotonic()) - startedAt
+
+        return nextTask
+
+    # Successors that are known to be false are never started, and the ones that are known to be true go first.
+    # Only successors whose other predecessors are all finished can start early.
+    def startSpeculativeRuns(self, successors, verdicts):
+        candidates = [successor for successor in successors if verdicts.get(successor) is not False]
+        candidates.sort(key=lambda successor: verdicts.get(successor) is not True)
+
+        speculativeTasks = []
+        for successor in candidates[:self.conditionEngine.speculationWidth]:
+            if successor.humanReadableName in ('END', 'DONE') or self.remainingPredecessors.get(successor) != 1:
+                continue
+            self.tracer.log(f'~~ Speculatively starting: {successor.humanReadableName}')
+            successor.isSpeculative = True
+            self.speculativeRuns[successor] = asyncio.ensure_future(self.executeTask(successor))
+            self.speculationTimes[successor] = [time.monotonic(), None]
+            self.speculativeRuns[successor].add_done_callback(lambda _, times=self.speculationTimes[successor]: times.__setitem__(1, time.monotonic()))
+            self.conditionEngine.speculativeRuns += 1
+            speculativeTasks.append(successor)
+
+        return speculativeTasks
 
-        # If node is conditional, decide which successor node to run.
-        isTaskConditional = task.isConditionalNode
+    def cancelSpeculativeRun(self, task):
+        speculativeRun = self.speculativeRuns.pop(task, None)
+        self.speculationTimes.pop(task, None)
+        if speculativeRun is not None:
+            self.tracer.log(f'~~ Cancelling speculative run: {task.humanReadableName}')
+            speculativeRun.cancel()
+            self.conditionEngine.speculativeCancellations += 1
 
-        successors = graph.successors(task)
+    # The END node runs once, after all of its predecessors are finished. It hands the results of the graph back to the parent task.
+    def finishGraph(self):
+        if self.isFinished:
+            return
+        self.isFinished = True
+        parentTask = self.parentTask
 
-        # If task is conditional, we will choose successors who match the condition.
-        if isTaskConditional is True:
-            print(f'~~ Task: {task.humanReadableName} ({task.task}) is conditional')
-            formattedStateHistory = task.formatState()
-            nextTask = await self.pickNextTask(formattedStateHistory, successors)
-            print(f'~~ Picked: {task.humanReadableName}')
-            await self.runThroughGraph(nextTask)
+        # TODO: NEED TO DECIDE BETWEEN CODE BLOCK #1 (Removing subtasks) AND CODE BLOCK #2 (Keeping subtasks)
+        # CODE BLOCK #1 (CURRENTLY ACTIVE): The steps of the subtasks of a type II task are collapsed into a single step with the task's latest output.
+        if parentTask.reasoningType == 'type II' or parentTask.reasoningType == 'II':
+            parentTask.state.append({parentTask.humanReadableName: parentTask.latestOutput})
         else:
-            print(f'~~ Task: {task.humanReadableName} is not conditional. Going to Run Next:')
-            for succ in graph.successors(task):
-                print(succ.humanReadableName)
+            parentTask.state.extend(self.state.newSteps())
+            parentTask.state.append({parentTask.humanReadableName: 'DONE'})
 
-            # Then run its successors. No need for successorsResults because each node will add its output to the state
-            await asyncio.gather(*[self.runThroughGraph(graph, successor) for successor in graph.successors(task)])
+        # CODE BLOCK #2 (CURRENTLY COMMENTED):
+        # parentTask.state.extend(self.state.newSteps())
+        # parentTask.state.append({parentTask.humanReadableName: 'DONE'})
 
+        self.tracer.log(f'~~ Graph of task {parentTask.humanReadableName} is returning')
+        self.finalResult = parentTask.state
 
     async def run(self):
-        finalResult = await self.runThroughGraph(self.graph, self.startTask)
-        self.finalResult = finalResult
+        await self.runThroughGraph(self.graph)
+        # A graph whose END node was never reached (e.g. it was skipped) still reports back to its parent task.
+        self.finishGraph()
+        finalResult = self.finalResult
 
         return finalResult
     
     async def pickNextTask(self, stateHistory, successors):
         formattedSuccessors = self.formatSuccessors(successors)
-        prompt = f'''Given the following state history (STATE HISTORY) of the steps taken along with their outputs, and the following potential next steps (POTENTIAL NEXT STEPS). Pick the next step whose condition matches what is in the state history (STATE HISTORY):
-
-STATE HISTORY
-{stateHistory}
-
-POTENTIAL NEXT STEPS
-{formattedSuccessors}
-
-OUTPUT FORMAT (JSON)
-Your output MUST be a JSON object that contains the following key:
-    "next_task_name": The exact task name of the next task that you pick from the POTENTIAL NEXT STEPS based on the state history (STATE HISTORY).
-
-'''
-        print(f'~~ Pick Next Task Prompt: {prompt}')
-        outputJSON, _ = await gpt(GPT.GPT4OMNI, SystemMessage.PLANNER, prompt, outputType=GPTOutputType.JSON)
-        pickedNextTaskName = outputJSON['next_task_name']
-        print(f'~~ Picked Next Task: {pickedNextTaskName}')
-        print('FROM:')
-        for successor in successors:
-            print(successor.humanReadableName)
-        nextTask = list(filter(lambda n: n.humanReadableName == pickedNextTaskName.strip(), successors))[0]
+        prompt = NEXT_TASK_PROMPT.render(state=stateHistory, successors=formattedSuccessors)
+        if self.tracer.verbose:
+            self.tracer.log(f'~~ Pick Next Task Prompt: {prompt}')
+        executionContext = self.parentTask.executionContext
+        successorsByName = {successor.humanReadableName: successor for successor in successors}
+
+        async def askForPick(modelName):
+            outputJSON, _ = await gpt(modelName, SystemMessage.PLANNER, prompt, outputType=GPTOutputType.JSON, executionContext=executionContext)
+            return outputJSON
+
+        # Picks go to the cheap model, and are asked again to the strong model if the picked name is not one of the successors.
+        isKnownSuccessor = lambda outputJSON: str(outputJSON['next_task_name']).strip() in successorsByName
+        outputJSON = await executionContext.router.call('pick', executionContext.router.modelForPick(), askForPick, 'next_task_name', isKnownSuccessor)
+        # If neither model named one of the successors, the default successor is taken, like when the conditional task timed out.
+        if not isinstance(outputJSON, dict) or 'next_task_name' not in outputJSON or not isKnownSuccessor(outputJSON):
+            nextTask = self.conditionEngine.defaultSuccessor(successors)
+            self.tracer.log(f'~~ The LLM did not pick one of the successors {list(successorsByName)}: {outputJSON}. Going to Run Next: {nextTask.humanReadableName}')
+            return nextTask
+
+        pickedNextTaskName = str(outputJSON['next_task_name']).strip()
+        self.tracer.log(f'~~ Picked Next Task: {pickedNextTaskName} from {list(successorsByName)}')
+        nextTask = successorsByName[pickedNextTaskName]
 
         return nextTask
 
@@ -0,0 +1,355 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from rate_limits import parseDuration
+
+# The HTTP connection pool is shared by every gpt() call, so parallel plan branches reuse keep-alive connections
+# instead of opening a new TLS connection per request.
+MAX_CONNECTIONS = int(os.environ.get('GPT_MAX_CONNECTIONS', 64))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('GPT_MAX_KEEPALIVE_CONNECTIONS', 32))
+KEEPALIVE_EXPIRY_SECONDS = 60.0
+
+# Which backend gpt() talks to: 'openai' (default) or 'simulated'.
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'openai')
+
+# Providers cache the prefixes of prompts in blocks of 128 tokens, once a prompt has at least 1024 tokens.
+# The simulated backend caches prefixes the same way.
+PROMPT_CACHE_BLOCK_TOKENS = 128
+PROMPT_CACHE_MIN_TOKENS = 1024
+# How many prefixes the simulated backend caches per model. Like a provider's cache, the least recently used ones are evicted first.
+SIMULATED_CACHED_PREFIXES = int(os.environ.get('SIMULATED_CACHED_PREFIXES', 4096))
+
+# How many requests the simulated backend counts the attempts of. The oldest ones are forgotten first.
+SIMULATED_TRACKED_REQUESTS = int(os.environ.get('SIMULATED_TRACKED_REQUESTS', 10000))
+
+
+class SimulatedBackendError(RuntimeError):
+    pass
+
+
+class LLMPromptTokensDetails:
+    def __init__(self, cachedTokens):
+        self.cached_tokens = cachedTokens
+
+
+"""
+This class holds the token usage of a response. It has the same attributes as the usage objects of the OpenAI SDK,
+including the prompt tokens that were served from the provider's prompt prefix cache (prompt_tokens_details.cached_tokens).
+"""
+class LLMUsage:
+    def __init__(self, promptTokens, completionTokens, cachedTokens=0):
+        self.prompt_tokens = promptTokens
+        self.completion_tokens = completionTokens
+        self.total_tokens = promptTokens + completionTokens
+        self.prompt_tokens_details = LLMPromptTokensDetails(cachedTokens)
+
+    def __repr__(self):
+        return f'LLMUsage(prompt_tokens={self.prompt_tokens}, completion_tokens={self.completion_tokens}, cached_tokens={self.prompt_tokens_details.cached_tokens})'
+
+
+"""
+This is the interface that gpt() and gptStream() call. A backend takes the request arguments built by buildRequestArgs
+(messages, model, temperature, response_format) and returns the text of the completion along with its usage,
+and the response headers (only the rate limit headers are used, and backends without headers return None).
+- complete(requestArgs) returns (content, usage, headers).
+- stream(requestArgs) is an async generator of (textChunk, usage, headers) triples. usage is None on every triple but the last one,
+and headers is None on every triple but the first one.
+- retryableError(error) returns why a failed request can be retried ('rate-limit', 'timeout', 'connection' or 'server'),
+or None if retrying it can't help. retryAfterSeconds(error) returns how long the API asked to wait, if it did.
+"""
+class LLMBackend:
+    name = 'backend'
+
+    async def complete(self, requestArgs):
+        raise NotImplementedError
+
+    async def stream(self, requestArgs):
+        raise NotImplementedError
+        yield
+
+    def retryableError(self, error):
+        if isinstance(error, asyncio.TimeoutError):
+            return 'timeout'
+
+        return None
+
+    def retryAfterSeconds(self, error):
+        return None
+
+    async def close(self):
+        pass
+
+
+"""
+This class sends the requests to the OpenAI API.
+The client (and its connection pool) is created on the first request, so importing this module doesn't need an API key.
+The SDK's own retries are turned off, since gpt() retries with the rate limits of all the calls in mind.
+"""
+class OpenAIBackend(LLMBackend):
+    name = 'openai'
+
+    def __init__(self, apiKey=None):
+        self.apiKey = apiKey
+        self.client = None
+
+    def getClient(self):
+        if self.client is None:
+            self.client = AsyncOpenAI(
+                api_key=self.apiKey if self.apiKey is not None else os.environ['OPENAI_KEY_SECRET'],
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=MAX_CONNECTIONS,
+                        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+                    ),
+                ),
+                max_retries=0,
+            )
+
+        return self.client
+
+    async def complete(self, requestArgs):
+        rawResponse = await self.getClient().chat.completions.with_raw_response.create(**requestArgs)
+        response = rawResponse.parse()
+
+        return (response.choices[0].message.content, response.usage, rawResponse.headers)
+
+    async def stream(self, requestArgs):
+        rawResponse = await self.getClient().chat.completions.with_raw_response.create(**requestArgs, stream=True, stream_options={'include_usage': True})
+        yield ('', None, rawResponse.headers)
+        async for chunk in rawResponse.parse():
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield (chunk.choices[0].delta.content, None, None)
+            if chunk.usage is not None:
+                yield ('', chunk.usage, None)
+
+    def retryableError(self, error):
+        if isinstance(error, openai.RateLimitError):
+            # Running out of quota is reported as a rate limit too, but waiting won't bring it back.
+            return None if getattr(error, 'code', None) == 'insufficient_quota' else 'rate-limit'
+        if isinstance(error, openai.APITimeoutError):
+            return 'timeout'
+        if isinstance(error, openai.APIConnectionError):
+            return 'connection'
+        if isinstance(error, openai.InternalServerError) or (isinstance(error, openai.APIStatusError) and error.status_code in (408, 409)):
+            return 'server'
+
+        return super().retryableError(error)
+
+    def retryAfterSeconds(self, error):
+        response = getattr(error, 'response', None)
+        if response is None:
+            return None
+
+        retryAfterMilliseconds = parseDuration(response.headers.get('retry-after-ms'))
+        if retryAfterMilliseconds is not None:
+            return retryAfterMilliseconds / 1000
+
+        return parseDuration(response.headers.get('retry-after'))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+
+"""
+This class stands in for a real LLM, so the executor can be run and measured offline.
+The content of every response comes from responder(prompt, requestArgs), which returns either a string or a JSON-serializable object.
+Without a responder, JSON requests get a generic answer (or the first candidate, for next-task picks), and TEXT requests get a short summary.
+The latency of every call is drawn from a distribution:
+- 'fixed': always latencySeconds.
+- 'uniform': between latencySeconds - latencyJitterSeconds and latencySeconds + latencyJitterSeconds.
+- 'lognormal': a long-tailed distribution with a median of latencySeconds, and latencyJitterSeconds as the sigma of its log.
+and a call fails with SimulatedBackendError with probability failureRate. These failures are treated as transient, so they are retried.
+Prompt prefixes are cached like a provider does (see PROMPT_CACHE_BLOCK_TOKENS), up to cachedPrefixesPerModel prefixes per model,
+and the cached tokens are reported in the usage.
+Every prompt token that is not cached adds uncachedTokenSeconds to the latency, so the effect of the prompt layout can be measured.
+The random draws are seeded by the seed and the request itself, so the same run gets the same latencies and failures,
+whatever order its calls happen to be made in. Only the digests of the last trackedRequests requests are kept to count their attempts
+(with 0, attempts are not counted, and every attempt of a request gets the same draw), and reset() forgets them (and the cached prefixes and the statistics),
+so the same backend can be used for another run, which then gets the same draws as the first one.
+"""
+class SimulatedBackend(LLMBackend):
+    name = 'simulated'
+
+    def __init__(self, responder=None, latencySeconds=0.0, latencyJitterSeconds=0.0, latencyDistribution='fixed', failureRate=0.0, streamChunkCharacters=32, seed=0, promptCaching=True, uncachedTokenSeconds=0.0, trackedRequests=SIMULATED_TRACKED_REQUESTS, cachedPrefixesPerModel=SIMULATED_CACHED_PREFIXES):
+        self.responder = responder if responder is not None else self.defaultResponder
+        self.latencySeconds = latencySeconds
+        self.latencyJitterSeconds = latencyJitterSeconds
+        self.latencyDistribution = latencyDistribution
+        self.failureRate = failureRate
+        self.streamChunkCharacters = streamChunkCharacters
+        self.seed = seed
+        self.promptCaching = promptCaching
+        self.uncachedTokenSeconds = uncachedTokenSeconds
+        self.trackedRequests = trackedRequests
+        self.cachedPrefixesPerModel = cachedPrefixesPerModel
+        # The digests of the cached prompt prefixes of every model, from the least to the most recently used.
+        self.cachedPrefixes = dict()
+        # The same request can be sent several times (e.g. retries), so every attempt gets its own draw.
+        # Keyed by the digest of the request, in the order the requests were first sent.
+        self.attemptsByRequest = dict()
+        self.reset()
+
+    # Starts a new run: forgets the requests and the cached prefixes of the previous runs, and their statistics.
+    def reset(self):
+        self.attemptsByRequest.clear()
+        self.cachedPrefixes.clear()
+        self.calls = 0
+        self.failures = 0
+        self.simulatedLatencySeconds = 0.0
+        self.promptTokens = 0
+        self.cachedPromptTokens = 0
+
+    @staticmethod
+    def defaultResponder(prompt, requestArgs):
+        if requestArgs.get('response_format') is None:
+            return 'Summary of the previous steps.'
+
+        if '"next_task_name"' in prompt:
+            candidateNames = re.findall(r'^Task Name: (.*)$', prompt, re.MULTILINE)
+            return {'next_task_name': candidateNames[0] if candidateNames else ''}
+
+        goalMatch = re.search(r'\nGOAL\n(.*?)\n', prompt)
+        goal = goalMatch.group(1) if goalMatch else 'the goal'
+
+        return {'reasoning': 'Simulated reasoning.', 'answer': f'Simulated answer for {goal}'}
+
+    def randomFor(self, requestArgs):
+        requestKey = json.dumps([requestArgs.get('model'), requestArgs.get('messages')], ensure_ascii=False)
+        requestDigest = hashlib.sha256(requestKey.encode('utf-8')).digest()
+        attempt = self.attemptsByRequest.get(requestDigest, 0)
+        if self.trackedRequests > 0:
+            if attempt == 0 and len(self.attemptsByRequest) >= self.trackedRequests:
+                del self.attemptsByRequest[next(iter(self.attemptsByRequest))]
+            self.attemptsByRequest[requestDigest] = attempt + 1
+        seedMaterial = f'{self.seed}:{attempt}:'.encode('utf-8') + requestDigest
+
+        return random.Random(hashlib.sha256(seedMaterial).digest())
+
+    def drawLatency(self, randomGenerator):
+        if self.latencyDistribution == 'uniform':
+            latency = randomGenerator.uniform(self.latencySeconds - self.latencyJitterSeconds, self.latencySeconds + self.latencyJitterSeconds)
+        elif self.latencyDistribution == 'lognormal' and self.latencySeconds > 0:
+            latency = randomGenerator.lognormvariate(0.0, self.latencyJitterSeconds) * self.latencySeconds
+        else:
+            latency = self.latencySeconds
+
+        return max(latency, 0.0)
+
+    # Roughly 4 characters per token, which is close enough for budgets and benchmarks.
+    @staticmethod
+    def promptTokensFor(requestArgs):
+        return sum(len(message['content']) for message in requestArgs['messages']) // 4 + 1
+
+    # Returns how many tokens of the prompt were already cached, and caches its prefixes for the next calls.
+    # Like a provider, only whole blocks of an exact prefix (system message included) are cached.
+    def cachePromptPrefixes(self, requestArgs):
+        if not self.promptCaching:
+            return 0
+
+        promptText = '\n'.join(message['content'] for message in requestArgs['messages'])
+        blockCharacters = PROMPT_CACHE_BLOCK_TOKENS * 4
+        cachedPrefixes = self.cachedPrefixes.setdefault(requestArgs.get('model'), dict())
+        prefixHash = hashlib.sha256()
+        cachedCharacters = 0
+        isCachedSoFar = True
+        for end in range(blockCharacters, len(promptText) + 1, blockCharacters):
+            prefixHash.update(promptText[end - blockCharacters:end].encode('utf-8'))
+            if end < PROMPT_CACHE_MIN_TOKENS * 4:
+                continue
+            prefixDigest = prefixHash.digest()
+            if isCachedSoFar and prefixDigest in cachedPrefixes:
+                cachedCharacters = end
+            else:
+                isCachedSoFar = False
+            # The prefix becomes the most recently used one.
+            if prefixDigest in cachedPrefixes:
+                del cachedPrefixes[prefixDigest]
+            elif len(cachedPrefixes) >= self.cachedPrefixesPerModel:
+                del cachedPrefixes[next(iter(cachedPrefixes))]
+            cachedPrefixes[prefixDigest] = None
+
+        return cachedCharacters // 4
+
+    def buildResponse(self, requestArgs, cachedTokens=0):
+        prompt = requestArgs['messages'][-1]['content']
+        content = self.responder(prompt, requestArgs)
+        if not isinstance(content, str):
+            content = json.dumps(content)
+
+        usage = LLMUsage(self.promptTokensFor(requestArgs), len(content) // 4 + 1, cachedTokens)
+
+        return (content, usage, None)
+
+    # Draws the latency and the failure of a call. Returns the latency, whether the call fails, and its cached prompt tokens.
+    def startCall(self, requestArgs):
+        randomGenerator = self.randomFor(requestArgs)
+        latency = self.drawLatency(randomGenerator)
+        failed = randomGenerator.random() < self.failureRate
+        cachedTokens = 0 if failed else self.cachePromptPrefixes(requestArgs)
+        promptTokens = self.promptTokensFor(requestArgs)
+        latency += (promptTokens - cachedTokens) * self.uncachedTokenSeconds
+        self.calls += 1
+        self.simulatedLatencySeconds += latency
+        if failed:
+            self.failures += 1
+        else:
+            self.promptTokens += promptTokens
+            self.cachedPromptTokens += cachedTokens
+
+        return (latency, failed, cachedTokens)
+
+    async def complete(self, requestArgs):
+        latency, failed, cachedTokens = self.startCall(requestArgs)
+        await asyncio.sleep(latency)
+        if failed:
+            raise SimulatedBackendError('Simulated LLM failure')
+
+        return self.buildResponse(requestArgs, cachedTokens)
+
+    async def stream(self, requestArgs):
+        latency, failed, cachedTokens = self.startCall(requestArgs)
+        content, usage, _ = self.buildResponse(requestArgs, cachedTokens)
+        chunks = [content[index:index + self.streamChunkCharacters] for index in range(0, len(content), self.streamChunkCharacters)] or ['']
+
+        # The first chunk arrives after a third of the latency, and the rest of the latency is spread over the remaining chunks.
+        await asyncio.sleep(latency / 3)
+        if failed:
+            raise SimulatedBackendError('Simulated LLM failure')
+        for index, chunk in enumerate(chunks):
+            if index > 0:
+                await asyncio.sleep(latency * 2 / 3 / len(chunks))
+            yield (chunk, None, None)
+        yield ('', usage, None)
+
+    def retryableError(self, error):
+        if isinstance(error, SimulatedBackendError):
+            return 'server'
+
+        return super().retryableError(error)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'simulatedLatencySeconds': round(self.simulatedLatencySeconds, 3),
+            'promptTokens': self.promptTokens,
+            'cachedPromptTokens': self.cachedPromptTokens,
+        }
+
+
+def createBackend(name=LLM_BACKEND):
+    if name == 'simulated':
+        return SimulatedBackend()
+
+    return OpenAIBackend()
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+
+
+# These values mark a step that hasn't produced a result yet, so they are never part of a task's inputs.
+UNSETTLED_STATE_VALUES = ('RUNNING', 'DONE')
+
+
+"""
+This class memoizes subtask results across a whole recursion tree.
+A result is stored under a fingerprint of what the subtask depends on: its goal, description, reasoning type and relevant state inputs.
+So when a recursive sub-plan contains a subgoal that was already solved somewhere else in the tree, from the same inputs, it is not solved again.
+If several tasks with the same fingerprint are requested at the same time, only the first one runs, and the rest wait for its result.
+"""
+class SubtaskMemo:
+    def __init__(self):
+        self.results = dict()
+        self.inFlight = dict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def normalizeText(text):
+        return ' '.join(str(text or '').lower().split())
+
+    @staticmethod
+    def normalizeReasoningType(reasoningType):
+        if reasoningType == 'I' or reasoningType == 'type I':
+            return 'type I'
+        elif reasoningType == 'II' or reasoningType == 'type II':
+            return 'type II'
+
+        return ''
+
+    # The relevant state inputs of a task are all the settled steps that its view of the state history holds: the problem statement,
+    # and the outputs of its predecessors and of the tasks before them (other than earlier results of the task itself).
+    # Every one of them is in its prompt, so two tasks with the same goal only share a result when they were given the same inputs.
+    @staticmethod
+    def relevantStateInputs(task):
+        relevantInputs = []
+
+        for stateIndex, stateItem in enumerate(task.state):
+            for key, value in stateItem.items():
+                if stateIndex == 0 or (value not in UNSETTLED_STATE_VALUES and key != task.humanReadableName):
+                    relevantInputs.append([key, str(value)])
+
+        return relevantInputs
+
+    @classmethod
+    def fingerprint(cls, task):
+        keyMaterial = json.dumps([
+            cls.normalizeText(task.goal),
+            cls.normalizeText(task.description),
+            cls.normalizeReasoningType(task.reasoningType),
+            cls.relevantStateInputs(task),
+        ], ensure_ascii=False)
+
+        return hashlib.sha256(keyMaterial.encode('utf-8')).hexdigest()
+
+    # Returns (result, computedHere). When computedHere is False, the result came from the memo,
+    # and the caller is responsible for recording it (task.runForResult() was not called).
+    async def getOrCompute(self, fingerprint, task):
+        if fingerprint in self.results:
+            self.hits += 1
+            return (self.results[fingerprint], False)
+
+        if fingerprint in self.inFlight:
+            future, ownerTask = self.inFlight[fingerprint]
+            # A task can't wait for one of its own ancestors, since the ancestor is waiting for it.
+            if self.isAncestor(ownerTask, task):
+                return (await task.runForResult(), True)
+
+            self.coalesced += 1
+            result = await future
+            if result is not None:
+                return (result, False)
+            # The task we waited for didn't produce a result, so compute it ourselves.
+            return (await task.runForResult(), True)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inFlight[fingerprint] = (future, task)
+        result = None
+        try:
+            result = await task.runForResult()
+            if result is not None:
+                self.results[fingerprint] = result
+        finally:
+            del self.inFlight[fingerprint]
+            future.set_result(result)
+
+        return (result, True)
+
+    @staticmethod
+    def isAncestor(ancestorTask, task):
+        parentTask = task.parentTask
+        while parentTask is not None:
+            if parentTask is ancestorTask:
+                return True
+            parentTask = parentTask.parentTask
+
+        return False
+
+    def hitRate(self):
+        lookups = self.hits + self.coalesced + self.misses
+
+        return (self.hits + self.coalesced) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'hitRate': self.hitRate(),
+            'storedResults': len(self.results),
+        }
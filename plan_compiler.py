@@ -0,0 +1,154 @@
+from collections import deque
+
+END_NODE_IDS = ('END', 'DONE')
+
+
+class PlanCompilationError(ValueError):
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+"""
+This class is a plan (the "nodes"/"edges" JSON of a planning response) compiled into an integer-addressed graph.
+Node i is nodes[i], and nodeIndex maps a node id to its index. The edges are (source index, target index) pairs, and
+edgeConditions[i] is the condition of edges[i] (or None). successors, predecessors and inDegrees are indexed by node.
+roots are the nodes with no predecessors, levels[i] is the length of the longest path from a root to node i,
+and topologicalOrder lists the nodes level by level. endIndex is the index of the END node.
+repairs lists what was fixed in the plan while compiling it.
+"""
+class CompiledPlan:
+    def __init__(self, nodes, edges, edgeConditions, repairs):
+        self.nodes = nodes
+        self.nodeIndex = {node['id']: index for index, node in enumerate(nodes)}
+        self.edges = edges
+        self.edgeConditions = edgeConditions
+        self.repairs = repairs
+        self.successors = [[] for _ in nodes]
+        self.predecessors = [[] for _ in nodes]
+        for sourceIndex, targetIndex in edges:
+            self.successors[sourceIndex].append(targetIndex)
+            self.predecessors[targetIndex].append(sourceIndex)
+        self.inDegrees = [len(predecessors) for predecessors in self.predecessors]
+        self.roots = [index for index, inDegree in enumerate(self.inDegrees) if inDegree == 0]
+        self.endIndex = next(index for index, node in enumerate(nodes) if node['id'] in END_NODE_IDS)
+        self.levels, self.topologicalOrder = self.sortTopologically()
+
+    # Kahn's algorithm. Nodes that are never reached are on a cycle.
+    def sortTopologically(self):
+        remainingPredecessors = list(self.inDegrees)
+        levels = [0] * len(self.nodes)
+        topologicalOrder = []
+        readyNodes = deque(self.roots)
+
+        while readyNodes:
+            index = readyNodes.popleft()
+            topologicalOrder.append(index)
+            for successorIndex in self.successors[index]:
+                levels[successorIndex] = max(levels[successorIndex], levels[index] + 1)
+                remainingPredecessors[successorIndex] -= 1
+                if remainingPredecessors[successorIndex] == 0:
+                    readyNodes.append(successorIndex)
+
+        if len(topologicalOrder) < len(self.nodes):
+            cycleNodeIDs = [self.nodes[index]['id'] for index, remaining in enumerate(remainingPredecessors) if remaining > 0]
+            raise PlanCompilationError([f'the plan has a cycle through {cycleNodeIDs}'])
+
+        topologicalOrder.sort(key=lambda index: levels[index])
+
+        return (levels, topologicalOrder)
+
+    def levelCount(self):
+        return max(self.levels) + 1 if self.levels else 0
+
+
+# Compiles the plan JSON of a planning response. Problems that can be fixed safely are repaired (and listed in the result's repairs):
+# - nodes without an id are dropped, duplicate ids keep their first node, and missing descriptions and types get defaults,
+# - a START node is dropped (its successors become roots),
+# - edges with unknown ids, self-loops and edges out of END are dropped, and duplicate edges are merged,
+# - a missing END node is added, and every node without successors gets an edge to END.
+# A plan that can't be repaired (no tasks, or a cycle) raises PlanCompilationError.
+def compilePlan(planJSON):
+    if not isinstance(planJSON, dict) or not isinstance(planJSON.get('nodes'), list):
+        raise PlanCompilationError(['the plan has no "nodes" list'])
+
+    repairs = []
+    edgesJSON = planJSON.get('edges')
+    if not isinstance(edgesJSON, list):
+        repairs.append('added the missing "edges" list')
+        edgesJSON = []
+
+    nodes = []
+    nodeIDs = set()
+    for node in planJSON['nodes']:
+        node = normalizeNode(node, nodeIDs, repairs)
+        if node is not None:
+            nodes.append(node)
+            nodeIDs.add(node['id'])
+
+    if not any(node['id'] not in END_NODE_IDS for node in nodes):
+        raise PlanCompilationError(['the plan has no tasks'])
+
+    if not any(node['id'] in END_NODE_IDS for node in nodes):
+        nodes.append({'id': 'END', 'description': 'The end of the plan.', 'type': 'type I'})
+        repairs.append('added the missing END node')
+
+    nodeIndex = {node['id']: index for index, node in enumerate(nodes)}
+    edges = []
+    edgeConditions = []
+    edgePositions = dict()
+    for edge in edgesJSON:
+        sourceIndex = nodeIndex.get(edge.get('source')) if isinstance(edge, dict) else None
+        targetIndex = nodeIndex.get(edge.get('target')) if isinstance(edge, dict) else None
+        if sourceIndex is None or targetIndex is None:
+            if not (isinstance(edge, dict) and edge.get('source') == 'START'):
+                repairs.append(f'dropped an edge with an unknown node id: {edge}')
+            continue
+        if sourceIndex == targetIndex:
+            repairs.append(f'dropped a self-loop on node "{edge["source"]}"')
+            continue
+        if nodes[sourceIndex]['id'] in END_NODE_IDS:
+            repairs.append(f'dropped an edge out of {edge["source"]}')
+            continue
+        if (sourceIndex, targetIndex) in edgePositions:
+            if 'condition' in edge:
+                edgeConditions[edgePositions[(sourceIndex, targetIndex)]] = edge['condition']
+            continue
+
+        edgePositions[(sourceIndex, targetIndex)] = len(edges)
+        edges.append((sourceIndex, targetIndex))
+        edgeConditions.append(edge.get('condition'))
+
+    hasSuccessors = {sourceIndex for sourceIndex, _ in edges}
+    for index, node in enumerate(nodes):
+        if index not in hasSuccessors and node['id'] not in END_NODE_IDS:
+            endIndex = next(endIndex for endIndex, endNode in enumerate(nodes) if endNode['id'] in END_NODE_IDS)
+            edges.append((index, endIndex))
+            edgeConditions.append(None)
+            repairs.append(f'added an edge from "{node["id"]}" to END')
+
+    return CompiledPlan(nodes, edges, edgeConditions, repairs)
+
+
+# Repairs a single node of a plan, whose node ids so far are nodeIDs (see compilePlan). Returns the repaired copy of the node,
+# or None if the node is dropped. What was repaired is added to repairs.
+def normalizeNode(node, nodeIDs, repairs):
+    if not isinstance(node, dict) or not isinstance(node.get('id'), str) or not node['id'].strip():
+        repairs.append(f'dropped a node without an id: {node}')
+        return None
+    if node['id'] == 'START':
+        repairs.append('dropped the START node')
+        return None
+    if node['id'] in nodeIDs:
+        repairs.append(f'dropped a duplicate of node "{node["id"]}"')
+        return None
+
+    node = dict(node)
+    if not isinstance(node.get('description'), str):
+        node['description'] = node['id']
+        repairs.append(f'added a description to node "{node["id"]}"')
+    if node.get('type') not in ('type I', 'I', 'type II', 'II'):
+        node['type'] = 'type I'
+        repairs.append(f'made node "{node["id"]}" a type I task')
+
+    return node
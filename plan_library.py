@@ -0,0 +1,312 @@
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+
+from memoization import UNSETTLED_STATE_VALUES
+from plan_compiler import compilePlan, PlanCompilationError
+
+# When set, the plans that worked are kept in this JSON lines file, and reused by later runs for similar goals.
+PLAN_LIBRARY_PATH = os.environ.get('PLAN_LIBRARY_PATH')
+# The library is on when it has a file. PLAN_LIBRARY=1 turns it on without one, so the plans are only reused within the process.
+PLAN_LIBRARY = os.environ.get('PLAN_LIBRARY', '1' if PLAN_LIBRARY_PATH else '0') == '1'
+# A stored plan is reused when its goal (and description) is at least this similar to the task's, and its problem statement
+# (the first state step) at least PLAN_LIBRARY_MIN_PROBLEM_SIMILARITY. Similarities are TF-IDF cosine similarities, from 0 to 1.
+PLAN_LIBRARY_MIN_SIMILARITY = float(os.environ.get('PLAN_LIBRARY_MIN_SIMILARITY', 0.9))
+PLAN_LIBRARY_MIN_PROBLEM_SIMILARITY = float(os.environ.get('PLAN_LIBRARY_MIN_PROBLEM_SIMILARITY', 0.6))
+# When enabled, the cheap model is asked whether a stored plan fits the task before it is reused.
+PLAN_LIBRARY_VALIDATE = os.environ.get('PLAN_LIBRARY_VALIDATE', '0') == '1'
+
+
+# Words and word pairs, so that "area of the circle" and "circle of the area" are similar, but not the same.
+def tokenize(text):
+    words = re.findall(r'[a-z0-9]+', str(text or '').lower())
+
+    return words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+
+
+"""
+This class is a TF-IDF index of short texts, with cosine similarity. It runs locally, and needs no embeddings.
+The postings of every term list the documents that contain it, so a query only scores the documents it shares a term with.
+The inverse document frequencies change with every added document, and so do the norms of the documents. So the norm of a document
+is only computed when a query scores it, and it is kept until the next document is added: adding a plan costs nothing more than its own terms,
+whatever the size of the library.
+"""
+class TFIDFIndex:
+    def __init__(self):
+        self.termCounts = []
+        self.documentFrequencies = Counter()
+        self.postings = dict()
+        # {documentID: norm}, for the documents that were scored since the last document was added.
+        self.norms = dict()
+        self.normsDocumentCount = 0
+
+    def __len__(self):
+        return len(self.termCounts)
+
+    def add(self, text):
+        documentID = len(self.termCounts)
+        termCounts = Counter(tokenize(text))
+        self.termCounts.append(termCounts)
+        for term in termCounts:
+            self.documentFrequencies[term] += 1
+            self.postings.setdefault(term, []).append(documentID)
+
+        return documentID
+
+    def idf(self, term):
+        return math.log((1 + len(self.termCounts)) / (1 + self.documentFrequencies.get(term, 0))) + 1
+
+    def norm(self, documentID):
+        if self.normsDocumentCount != len(self.termCounts):
+            self.norms.clear()
+            self.normsDocumentCount = len(self.termCounts)
+        if documentID not in self.norms:
+            self.norms[documentID] = math.sqrt(sum((count * self.idf(term)) ** 2 for term, count in self.termCounts[documentID].items()))
+
+        return self.norms[documentID]
+
+    def queryWeights(self, text):
+        return {term: count * self.idf(term) for term, count in Counter(tokenize(text)).items()}
+
+    # Returns {documentID: similarity} for the documents that share at least one term with the text.
+    def query(self, text):
+        queryWeights = self.queryWeights(text)
+        queryNorm = math.sqrt(sum(weight ** 2 for weight in queryWeights.values()))
+        dotProducts = Counter()
+        for term, queryWeight in queryWeights.items():
+            idf = self.idf(term)
+            for documentID in self.postings.get(term, ()):
+                dotProducts[documentID] += queryWeight * self.termCounts[documentID][term] * idf
+
+        return {
+            documentID: dotProduct / (queryNorm * self.norm(documentID))
+            for documentID, dotProduct in dotProducts.items()
+            if queryNorm and self.norm(documentID)
+        }
+
+    def similarity(self, text, documentID):
+        queryWeights = self.queryWeights(text)
+        queryNorm = math.sqrt(sum(weight ** 2 for weight in queryWeights.values()))
+        termCounts = self.termCounts[documentID]
+        dotProduct = sum(queryWeight * termCounts[term] * self.idf(term) for term, queryWeight in queryWeights.items() if term in termCounts)
+        if not queryNorm or not self.norm(documentID):
+            return 0.0
+
+        return dotProduct / (queryNorm * self.norm(documentID))
+
+
+"""
+This class is a stored plan: the goal, description and problem statement it was made for, its nodes and edges (as the LLM wrote them,
+with their reasoning types and conditions), and how it did every time it ran.
+"""
+class StoredPlan:
+    def __init__(self, planKey, goal, description, problem, nodes, edges, successes=0, failures=0):
+        self.planKey = planKey
+        self.goal = goal
+        self.description = description
+        self.problem = problem
+        self.nodes = nodes
+        self.edges = edges
+        self.successes = successes
+        self.failures = failures
+
+    # A plan that failed more often than it worked is not reused anymore.
+    def isReusable(self):
+        return self.successes > self.failures
+
+    def outputJSON(self):
+        return {'nodes': self.nodes, 'edges': self.edges}
+
+
+"""
+This class is a library of the plans that worked, so a planning task whose goal is nearly identical to one that was already solved
+reuses its plan instead of asking the LLM for a new one (the most expensive call of a task).
+- Plans are stored once their graph finished with a result. A reused plan is not stored again, but its outcome is recorded,
+and a plan that fails more often than it works is not reused anymore.
+- Plans are found with two TF-IDF indexes (see TFIDFIndex): one of the goals and descriptions, and one of the problem statements
+(the first state step), since a root goal like "Solve the problem" says nothing without its problem.
+A plan is reused when both are similar enough (minSimilarity and minProblemSimilarity). The most similar one wins.
+- Only plans that compile (see plan_compiler.py) are stored. A task checks a stored plan before it reuses it
+(see PlanningTask.validateReusedPlan): a plan that an ancestor is running is not reused, and with validate on,
+the cheap model is asked whether the plan fits.
+With a path, the library is kept in an append-only JSON lines file, with a "plan" record per stored plan, and an "outcome" record
+per run of a reused plan, so later runs (and other processes, when they start) reuse the plans too.
+"""
+class PlanLibrary:
+    def __init__(self, path=PLAN_LIBRARY_PATH, enabled=PLAN_LIBRARY, minSimilarity=PLAN_LIBRARY_MIN_SIMILARITY, minProblemSimilarity=PLAN_LIBRARY_MIN_PROBLEM_SIMILARITY, validate=PLAN_LIBRARY_VALIDATE):
+        self.path = path
+        self.enabled = enabled
+        self.validate = validate
+        self.minSimilarity = minSimilarity
+        self.minProblemSimilarity = minProblemSimilarity
+        self.plans = []
+        self.plansByKey = dict()
+        self.goalIndex = TFIDFIndex()
+        self.problemIndex = TFIDFIndex()
+        self.lookups = 0
+        self.hits = 0
+        self.rejectedPlans = 0
+        self.storedPlans = 0
+        self.reusedSuccesses = 0
+        self.reusedFailures = 0
+
+        if self.enabled and self.path is not None and os.path.exists(self.path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as libraryFile:
+            for line in libraryFile:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line can be cut short if the process died while writing it.
+                    continue
+
+                if record.get('type') == 'plan':
+                    self.addPlan(record['goal'], record['description'], record['problem'], record['nodes'], record['edges'])
+                elif record.get('type') == 'outcome' and record.get('plan') in self.plansByKey:
+                    self.countOutcome(self.plansByKey[record['plan']], record['succeeded'])
+
+    def write(self, record):
+        if self.path is None:
+            return
+
+        with open(self.path, 'a') as libraryFile:
+            libraryFile.write(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str) + '\n')
+
+    @staticmethod
+    def goalText(goal, description):
+        return f'{goal}\n{description or ""}'
+
+    # The problem statement of a task is the first step of its state history, without the values that only mark it as running.
+    @staticmethod
+    def problemOf(task):
+        if len(task.state) == 0:
+            return ''
+
+        problemParts = []
+        for key, value in task.state[0].items():
+            problemParts.append(str(key))
+            if value not in UNSETTLED_STATE_VALUES:
+                problemParts.append(str(value))
+
+        return '\n'.join(problemParts)
+
+    # Plans are identified by their content, so the records of several processes that share the file don't get mixed up.
+    @staticmethod
+    def planKey(goal, description, problem, nodes, edges):
+        keyMaterial = json.dumps([goal, description, problem, nodes, edges], ensure_ascii=False, sort_keys=True, default=str)
+
+        return hashlib.sha256(keyMaterial.encode('utf-8')).hexdigest()
+
+    # Returns (storedPlan, isNew). A plan that is already in the library counts as one more success.
+    def addPlan(self, goal, description, problem, nodes, edges):
+        planKey = self.planKey(goal, description, problem, nodes, edges)
+        if planKey in self.plansByKey:
+            storedPlan = self.plansByKey[planKey]
+            storedPlan.successes += 1
+            return (storedPlan, False)
+
+        storedPlan = StoredPlan(planKey, goal, description, problem, nodes, edges, successes=1)
+        self.plans.append(storedPlan)
+        self.plansByKey[planKey] = storedPlan
+        self.goalIndex.add(self.goalText(goal, description))
+        self.problemIndex.add(problem)
+
+        return (storedPlan, True)
+
+    @staticmethod
+    def countOutcome(storedPlan, succeeded):
+        if succeeded:
+            storedPlan.successes += 1
+        else:
+            storedPlan.failures += 1
+
+    # Returns (storedPlan, similarity) for the most similar reusable plan, or None if no plan is similar enough.
+    def find(self, task):
+        if not self.enabled or not task.isPlanningTask() or task.mustAnswer:
+            return None
+
+        self.lookups += 1
+        problem = self.problemOf(task)
+        bestMatch = None
+        for planIndex, similarity in self.goalIndex.query(self.goalText(task.goal, task.description)).items():
+            storedPlan = self.plans[planIndex]
+            if similarity < self.minSimilarity or not storedPlan.isReusable():
+                continue
+            problemSimilarity = self.problemIndex.similarity(problem, planIndex) if problem or storedPlan.problem else 1.0
+            if problemSimilarity < self.minProblemSimilarity:
+                continue
+            if bestMatch is None or similarity + problemSimilarity > bestMatch[1] + bestMatch[2]:
+                bestMatch = (storedPlan, similarity, problemSimilarity)
+
+        if bestMatch is None:
+            return None
+
+        self.hits += 1
+
+        return (bestMatch[0], round(bestMatch[1], 3))
+
+    # Called when a validator turned down the plan that find() returned.
+    def reject(self):
+        self.hits -= 1
+        self.rejectedPlans += 1
+
+    # Stores the plan of a task whose graph finished with a result.
+    def store(self, task, outputJSON):
+        if not self.enabled or not isinstance(outputJSON, dict):
+            return None
+
+        nodes = outputJSON.get('nodes', [])
+        edges = outputJSON.get('edges', [])
+        try:
+            compilePlan(outputJSON)
+        except PlanCompilationError:
+            return None
+
+        storedPlan, isNew = self.addPlan(task.goal, task.description, self.problemOf(task), nodes, edges)
+        if isNew:
+            self.storedPlans += 1
+        self.write({'type': 'plan', 'goal': task.goal, 'description': task.description, 'problem': storedPlan.problem, 'nodes': nodes, 'edges': edges, 'storedAt': time.time()})
+
+        return storedPlan
+
+    # Records whether a reused plan worked.
+    def recordOutcome(self, storedPlan, succeeded):
+        self.countOutcome(storedPlan, succeeded)
+        if succeeded:
+            self.reusedSuccesses += 1
+        else:
+            self.reusedFailures += 1
+        self.write({'type': 'outcome', 'plan': storedPlan.planKey, 'succeeded': succeeded})
+
+    def hitRate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hitRate': round(self.hitRate(), 3),
+            'rejectedPlans': self.rejectedPlans,
+            'storedPlans': self.storedPlans,
+            'reusedSuccesses': self.reusedSuccesses,
+            'reusedFailures': self.reusedFailures,
+            'libraryPlans': len(self.plans),
+        }
+
+
+planLibrary = PlanLibrary()
+
+
+# Replaces the module-level plan library, e.g. to share a library file between runs. Call this before starting a run.
+def configurePlanLibrary(path=PLAN_LIBRARY_PATH, enabled=True, **libraryOptions):
+    global planLibrary
+    planLibrary = PlanLibrary(path, enabled, **libraryOptions)
+
+    return planLibrary
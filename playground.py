@@ -1,7 +1,13 @@
 import asyncio
+import sys
 
 from tasks import PlanningTask
 from enums import SystemMessage
+import gpt_api_calls
+import sandbox
+from gpt_api_calls import closeClient
+from checkpoint import Checkpoint, CHECKPOINT_PATH
+from execution_context import ExecutionContext
 
 """
 We start any algorithm here with the start method. The start method requires the following:
@@ -45,7 +51,37 @@ of Pluto?''': 'RUNNING'}]
 
     mainPlanTask = PlanningTask(humanReadableTaskName, systemMessage, inputTuple)
     await mainPlanTask.run()
+    await finish(mainPlanTask)
+
+"""
+Resumes a checkpointed run (see checkpoint.py). The root task is rebuilt from the inputs recorded in the checkpoint,
+the tasks that already finished are restored, and only the unfinished ones run.
+"""
+async def resume(checkpointPath):
+    checkpoint = Checkpoint(checkpointPath, resume=True)
+    run = checkpoint.runRecord
+    if run is None:
+        raise ValueError(f'{checkpointPath} does not contain a run to resume')
+
+    inputTuple = (run['rulesList'], run['state'], run['goal'], run['expectedOutputJSONSchema'], run['description'], run['reasoningType'], None)
+    mainPlanTask = PlanningTask(run['humanReadableName'], SystemMessage[run['systemMessage']], inputTuple, executionContext=ExecutionContext(checkpoint=checkpoint))
+    await mainPlanTask.run()
+    await finish(mainPlanTask)
+
+async def finish(mainPlanTask):
     print(f'~~ FINAL STATE: {mainPlanTask.state}')
+    if mainPlanTask.abortResult is not None:
+        print(f'~~ ABORTED RUN: {mainPlanTask.abortResult}')
+    print(f'~~ RUN STATS: {mainPlanTask.executionContext.stats()}')
+    print(f'~~ LLM CALLS: {gpt_api_calls.dispatcher.stats()}')
+    print(f'~~ RESPONSE CACHE: {gpt_api_calls.responseCache.stats()}')
+    print(f'~~ SANDBOX: {sandbox.sandboxPool.stats()}')
+    tracer = mainPlanTask.executionContext.tracer
+    if tracer.enabled:
+        print(f'~~ TRACE: {tracer.exportChromeTrace()}')
+        tracer.printSummary()
+    mainPlanTask.executionContext.checkpoint.close()
+    await closeClient()
 
 if __name__ == '__main__':
 
@@ -56,6 +92,11 @@ if __name__ == '__main__':
         asyncio.set_event_loop(loop)
 
     # loop = asyncio.get_event_loop()
-    res = loop.run_until_complete(start())
+    # python playground.py --resume [checkpoint path] continues a checkpointed run instead of starting a new one.
+    if '--resume' in sys.argv:
+        resumeArguments = sys.argv[sys.argv.index('--resume') + 1:]
+        res = loop.run_until_complete(resume(resumeArguments[0] if resumeArguments else CHECKPOINT_PATH))
+    else:
+        res = loop.run_until_complete(start())
     print(res)
     loop.close()
\ No newline at end of file
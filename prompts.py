@@ -0,0 +1,257 @@
+import string
+import sys
+from functools import lru_cache
+
+"""
+The prompts of the executor, laid out for provider-side prompt prefix caching.
+Providers cache the longest prefix that a request shares with earlier requests, and only the tokens after it are processed
+at full cost. So every prompt goes from the most static content to the most dynamic one:
+1-) The system message (a separate message, see buildRequestArgs), which is the same for every call.
+2-) The instruction block (TASK, OUTPUT FORMAT), which only depends on the kind of call (e.g. the reasoning type of the task).
+3-) The state history (STATE HISTORY). It is append-only, so the steps that an earlier call already sent are a stable prefix,
+and only the new steps come after it.
+4-) What only this call has: its goal and goal description, its candidate next steps, its goals.
+Sibling tasks of a plan share the same instructions and state history, so their prompts only differ in their last lines.
+"""
+
+
+"""
+This class is a prompt template that is parsed once, when the module is imported. Rendering it only joins its literal parts
+with the field values, instead of parsing a format string (or building an f-string) on every call.
+Fields are written {name}. Literal braces are written {{ and }}, as with str.format.
+"""
+class PromptTemplate:
+    def __init__(self, text):
+        self.literals = []
+        self.fieldNames = []
+        for literal, fieldName, _, _ in string.Formatter().parse(text):
+            self.literals.append(literal)
+            if fieldName is not None:
+                self.fieldNames.append(fieldName)
+        if len(self.literals) == len(self.fieldNames):
+            self.literals.append('')
+        self.literals = [sys.intern(literal) for literal in self.literals]
+
+    def render(self, **fields):
+        parts = [self.literals[0]]
+        for fieldName, literal in zip(self.fieldNames, self.literals[1:]):
+            parts.append(str(fields[fieldName]))
+            parts.append(literal)
+
+        return ''.join(parts)
+
+
+# The instructions of a planning task that may either answer or plan (no reasoning type).
+ANSWER_OR_PLAN_INSTRUCTIONS = '''You must choose ONE from the following:
+
+Option 1: Evaluate if you can directly satisfy the goal (GOAL) by reviewing the provided state history (STATE HISTORY). If you can achieve this without additional computations, you MUST return a pure JSON object that contains the following key/value pair: key is: “answer” and its value is: the actual answer that you found from the state. It cannot be ambiguous, and it cannot be another task. It must be a clear returned value.
+Option 2: If the state history (STATE HISTORY) does not provide sufficient information to directly satisfy the goal (GOAL), create a Python networkx graph represented in JSON format to outline the algorithm or plan you will use to achieve the goal, given the current state history (STATE HISTORY). The graph MUST be a JSON object that contains the following keys:
+    "nodes": This must contain all the graph's nodes in the networkx graph. The nodes will represent subtasks that you will take. Each node will be a JSON object that contains "id" key. The "id" should be a human-readable short description of the node. Each node MUST also contain a "description" key that describes the node's function in more details than the "id". A maximum of one sentence is allowed. Each node must include its reasoning type "type" (type I for direct computation tasks vs. type II for more multi-step computations). If a node is a conditional node, you should add the key "conditional" to it. The graph MUST NOT contain a "START" node. The graph MUST contain an "END" node to represent the termination node of the algorithm.
+    "edges": This must contain all the graph's edges. If an edge is a conditional edge, you should add the key "condition" that specifies the condition as a string. Each edge is an object that contains a "source" and a "target" node ids. The ids should match the node ids you define.
+'''
+
+# The instructions of a type I task.
+ANSWER_INSTRUCTIONS = '''Use the provided state history (STATE HISTORY) to achieve the goal (GOAL). You MUST return a pure JSON object that contains the following key/value pairs:
+"reasoning": the reasoning that justifies the answer. You can use intermediate results from this reasoning to form your final answer.
+“answer”: the actual answer that you found from the state and your reasoning above. It cannot be ambigious, and it cannot be another task. It must be a clear computed returned value.
+"confidence": a number between 0 and 1 that tells how sure you are that the answer is correct.
+'''
+
+# The instructions of a type II task.
+PLAN_INSTRUCTIONS = '''If the state history (STATE HISTORY) does not provide sufficient information to directly satisfy the goal (GOAL), create a Python networkx graph represented in JSON format to outline the algorithm or plan you will use to achieve the goal, given the current state history (STATE HISTORY). The graph MUST be a JSON object that contains the following keys:
+"nodes": This must contain all the graph's nodes in the networkx graph. The nodes will represent subtasks that you will take. Each node will be a JSON object that contains "id" key. The "id" should be a human-readable short description of the node. Each node MUST also contain a "description" key that describes the node's function in more details than the "id". A maximum of one sentence is allowed. Each node must include its reasoning type "type" (type I for direct computation tasks vs. type II for more multi-step computations). If a node is a conditional node, you should add the key "conditional" to it. The graph MUST NOT contain a "START" node. The graph MUST contain an "END" node to represent the termination node of the algorithm.
+"edges": This must contain all the graph's edges. If an edge is a conditional edge, you should add the key "condition" that specifies the condition as a string. Each edge is an object that contains a "source" and a "target" node ids. The ids should match the node ids you define.
+'''
+
+# When plans are streamed, every node lists its predecessors, so it can be scheduled as soon as it arrives.
+STREAMED_PLAN_INSTRUCTIONS = '''The nodes MUST be listed in execution order. Each node MUST also contain an "after" key that lists the ids of all the nodes that must be completed before it (an empty list if it can start right away). The "after" lists MUST match the edges.
+'''
+
+# When code execution is enabled, plans mark the type I nodes that are pure computations.
+COMPUTE_NODE_INSTRUCTIONS = '''If a type I node is a pure computation (arithmetic, unit conversions, formulas) whose inputs are all known from the state history or the problem, you should add the key "compute" to it.
+'''
+
+# The task of a computational node: a program whose output is the answer.
+COMPUTATION_TASK = '''Write a short, self-contained Python program that computes the goal (GOAL) from the values in the state history (STATE HISTORY). Write the values it needs as constants in the program. Use only the Python standard library, and don't read any input or file. The program MUST print the final answer, and nothing else (include the unit, if there is one). Return the program in a ```python code block.
+'''
+
+
+# Returns the instruction block (TASK) of a task. There are only a few distinct blocks, so every task of a run shares the same
+# interned string instead of building its own copy. The reasoning type comes from the plan, so it can be anything.
+def taskInstructions(reasoningType, codeExecution, streamPlans):
+    if reasoningType is not None and not isinstance(reasoningType, str):
+        return None
+
+    return buildTaskInstructions(reasoningType, bool(codeExecution), bool(streamPlans))
+
+
+@lru_cache(maxsize=64)
+def buildTaskInstructions(reasoningType, codeExecution, streamPlans):
+    if reasoningType in ('type I', 'I'):
+        return sys.intern(ANSWER_INSTRUCTIONS)
+
+    if reasoningType in (None, ''):
+        instructions = ANSWER_OR_PLAN_INSTRUCTIONS
+    elif reasoningType in ('type II', 'II'):
+        instructions = PLAN_INSTRUCTIONS
+    else:
+        return None
+
+    if codeExecution:
+        instructions += COMPUTE_NODE_INSTRUCTIONS
+    if streamPlans:
+        instructions += STREAMED_PLAN_INSTRUCTIONS
+
+    return sys.intern(instructions)
+
+
+# The prompt of a task (see PlanningTask.assemblePrompt).
+TASK_PROMPT = PromptTemplate('''You will be presented with the following:
+
+- Task (TASK): A task to perform given the full state history (STATE HISTORY) and the goal (GOAL).
+- State History (STATE HISTORY): This is a list of all previously taken steps along with their returned values.
+- Goal (GOAL): A goal you MUST achieve.
+- Goal Description (GOAL DESCRIPTION): A more detailed description of the goal (GOAL).
+
+TASK
+{task}
+YOU MUST LEVERAGE THE RESULTS IN THE STATE HISTORY WHEN POSSIBLE, AND AVOID CREATING TYPE II TASKS AND GRAPHS WHEN THEY ARE NOT NEEDED.
+
+Here is the information:
+
+STATE HISTORY
+{state}
+
+GOAL
+{goal}
+
+GOAL DESCRIPTION
+{description}
+''')
+
+# The prompt that filters the state history down to the steps that are relevant to a goal (see PlanningTask.selectRelevantState).
+RELEVANT_STATE_PROMPT = PromptTemplate('''You will be presented with the following:
+
+- Task (TASK): A task to perform given the full state history (FULL STATE HISTORY) and the goal (GOAL).
+- Full State History (FULL STATE HISTORY): This is a list of all previously taken steps along with their returned values.
+- Goal (GOAL): A goal you MUST achieve.
+- Goal Description (GOAL DESCRIPTION): A more detailed description of the goal (GOAL).
+
+TASK
+Select and filter the state history (FULL STATE HISTORY) items that are relevant to the goal (GOAL), while removing irrelevant items. Use the goal (GOAL) and goal description (GOAL DESCRIPTION) to inform you about what you think you will need.
+
+OUTPUT FORMAT (JSON)
+Your output must be a JSON object that contains the following keys:
+"filtered_state_history": The new filtered state history to elements that are relevant to the task. It must be of the same structure as the full state history, and it must use the same keys for the kept items.
+
+Here is the information:
+
+FULL STATE HISTORY
+{state}
+
+GOAL
+{goal}
+
+GOAL DESCRIPTION
+{description}
+''')
+
+# The prompt that asks whether a plan of the plan library fits a new goal (see PlanningTask.validateReusedPlan).
+PLAN_VALIDATION_PROMPT = PromptTemplate('''You will be presented with the following:
+
+- Task (TASK): A task to perform given the state history (STATE HISTORY), the stored plan (STORED PLAN) and the goal (GOAL).
+- State History (STATE HISTORY): This is a list of all previously taken steps along with their returned values.
+- Stored Plan (STORED PLAN): A plan (a graph of subtasks) that achieved a similar goal (STORED GOAL) before.
+- Goal (GOAL): A goal you MUST achieve.
+- Goal Description (GOAL DESCRIPTION): A more detailed description of the goal (GOAL).
+
+TASK
+Decide whether running the stored plan (STORED PLAN) as it is, given the state history (STATE HISTORY), achieves the goal (GOAL). Its subtasks must not depend on anything that is specific to the stored goal (STORED GOAL) and differs in the goal (GOAL).
+
+OUTPUT FORMAT (JSON)
+Your output MUST be a JSON object that contains the following key:
+    "fits": true if the stored plan achieves the goal, and false otherwise.
+
+Here is the information:
+
+STATE HISTORY
+{state}
+
+STORED GOAL
+{storedGoal}
+
+STORED PLAN
+{plan}
+
+GOAL
+{goal}
+
+GOAL DESCRIPTION
+{description}
+''')
+
+# The prompt that picks the successor of a conditional node (see AlgorithmGraph.pickNextTask).
+NEXT_TASK_PROMPT = PromptTemplate('''Given the following state history (STATE HISTORY) of the steps taken along with their outputs, and the following potential next steps (POTENTIAL NEXT STEPS). Pick the next step whose condition matches what is in the state history (STATE HISTORY).
+
+OUTPUT FORMAT (JSON)
+Your output MUST be a JSON object that contains the following key:
+    "next_task_name": The exact task name of the next task that you pick from the POTENTIAL NEXT STEPS based on the state history (STATE HISTORY).
+
+STATE HISTORY
+{state}
+
+POTENTIAL NEXT STEPS
+{successors}
+''')
+
+# The prompt that answers a batch of type I tasks with the same state history (see TypeIBatcher).
+BATCH_PROMPT = PromptTemplate('''You will be presented with the following:
+
+- Task (TASK): A task to perform given the state history (STATE HISTORY) and the goals (GOALS).
+- State History (STATE HISTORY): This is a list of all previously taken steps along with their returned values.
+- Goals (GOALS): A numbered list of goals you MUST achieve. Each goal comes with a more detailed description (Goal Description).
+
+TASK
+Use the provided state history (STATE HISTORY) to achieve EACH goal in GOALS, independently of the other goals. You MUST return a pure JSON object that contains the following key:
+"answers": a JSON object whose keys are the goal numbers as strings ("1", "2", ...), one for every goal. The value of each key MUST be a JSON object that contains the following key/value pairs:
+    "reasoning": the reasoning that justifies the answer. You can use intermediate results from this reasoning to form your final answer.
+    "answer": the actual answer that you found from the state and your reasoning above. It cannot be ambigious, and it cannot be another task. It must be a clear computed returned value.
+    "confidence": a number between 0 and 1 that tells how sure you are that the answer is correct.
+YOU MUST LEVERAGE THE RESULTS IN THE STATE HISTORY WHEN POSSIBLE.
+
+Here is the information:
+
+STATE HISTORY
+{state}
+
+GOALS
+{goals}
+''')
+
+# The prompt that extends the summary of the older steps of a state history (see ContextManager.createSummary).
+SUMMARY_PROMPT = PromptTemplate('''You will be presented with the following:
+
+- Task (TASK): What to do with the previous summary (PREVIOUS SUMMARY) and the new steps (NEW STEPS).
+- Previous Summary (PREVIOUS SUMMARY): A summary of the earlier steps of a state history.
+- New Steps (NEW STEPS): The steps that came right after the ones in the previous summary, along with their returned values.
+
+TASK
+Write a single concise summary that covers both the previous summary (PREVIOUS SUMMARY) and the new steps (NEW STEPS).
+You MUST keep every computed value, every intermediate result and the id of the step that produced it. You MUST drop the reasoning text.
+
+Here is the information:
+
+PREVIOUS SUMMARY
+{previousSummary}
+
+NEW STEPS
+{newSteps}
+''')
+
+# The prompt that fixes a JSON response that can't be parsed (see repairJSONResponse).
+JSON_REPAIR_PROMPT = PromptTemplate('''The following text was meant to be a single valid JSON object, but it can't be parsed (it may be cut short, or have syntax errors).
+Fix it, and output the corrected JSON object. Keep all of its keys and values, and don't add any new information.
+
+TEXT
+{text}
+''')
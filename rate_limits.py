@@ -0,0 +1,174 @@
+import asyncio
+import os
+import random
+import re
+import time
+
+# Requests and tokens per minute allowed per model. When unset, the limits are learned from the rate limit headers of the responses.
+REQUESTS_PER_MINUTE = os.environ.get('GPT_REQUESTS_PER_MINUTE')
+TOKENS_PER_MINUTE = os.environ.get('GPT_TOKENS_PER_MINUTE')
+# Transient errors (rate limits, timeouts, connection and server errors) are retried this many times, with a jittered exponential backoff.
+MAX_RETRIES = int(os.environ.get('GPT_MAX_RETRIES', 5))
+RETRY_BASE_SECONDS = float(os.environ.get('GPT_RETRY_BASE_SECONDS', 0.5))
+RETRY_MAX_SECONDS = float(os.environ.get('GPT_RETRY_MAX_SECONDS', 30.0))
+
+
+# Parses the reset durations of the rate limit headers, e.g. "1s", "6m0s", "20ms" or "0.5".
+def parseDuration(text):
+    if text is None:
+        return None
+
+    text = str(text).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', text)
+    if not parts:
+        return None
+
+    unitSeconds = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+
+    return sum(float(value) * unitSeconds[unit] for value, unit in parts)
+
+
+def parseCount(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+"""
+This class is a token bucket that refills continuously at capacity per minute.
+A bucket with no capacity (the limit is not known yet) never makes a call wait.
+observe() corrects the bucket with what the API reported: its limit, what remains, and when it is fully refilled.
+"""
+class TokenBucket:
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.level = capacity
+        self.refillRate = capacity / 60.0 if capacity else None
+        self.updatedAt = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updatedAt) * self.refillRate)
+        self.updatedAt = now
+
+    # Requests bigger than the whole bucket only wait for a full bucket, otherwise they would wait forever.
+    def secondsUntil(self, amount):
+        if not self.capacity:
+            return 0.0
+        self.refill()
+        amount = min(amount, self.capacity)
+
+        return max(0.0, (amount - self.level) / self.refillRate)
+
+    def consume(self, amount):
+        if self.capacity:
+            self.refill()
+            self.level -= min(amount, self.capacity)
+
+    def observe(self, limit, remaining, resetSeconds):
+        self.refill()
+        if limit:
+            if self.capacity != limit:
+                self.level = limit if self.level is None else min(self.level, limit)
+            self.capacity = limit
+            self.refillRate = limit / 60.0
+        if remaining is not None and self.capacity:
+            # Calls that are still in flight were already taken out of the local level, but maybe not out of the reported one.
+            self.level = min(self.level, remaining)
+            if resetSeconds:
+                self.refillRate = max(self.refillRate, (self.capacity - remaining) / resetSeconds)
+
+
+"""
+This class schedules LLM calls under the requests per minute (RPM) and tokens per minute (TPM) limits of every model.
+Before a call is sent, acquire() waits until both buckets of its model have room for one request and its estimated tokens.
+Waiting calls are served in order, so a big call can't be starved by small ones.
+After the call, record() replaces the estimate with the actual token usage, and updates the buckets from the rate limit headers.
+When the API still answers with a rate limit error, pause() stops all the calls of the model until the API says it is ready again.
+"""
+class RateLimiter:
+    def __init__(self, requestsPerMinute=REQUESTS_PER_MINUTE, tokensPerMinute=TOKENS_PER_MINUTE):
+        self.requestsPerMinute = float(requestsPerMinute) if requestsPerMinute else None
+        self.tokensPerMinute = float(tokensPerMinute) if tokensPerMinute else None
+        self.buckets = dict()
+        self.locks = dict()
+        self.pausedUntil = dict()
+        self.waits = 0
+        self.waitedSeconds = 0.0
+        self.pauses = 0
+
+    def bucketsFor(self, modelName):
+        if modelName not in self.buckets:
+            self.buckets[modelName] = (TokenBucket(self.requestsPerMinute), TokenBucket(self.tokensPerMinute))
+            self.locks[modelName] = asyncio.Lock()
+
+        return self.buckets[modelName]
+
+    def secondsUntilReady(self, modelName, estimatedTokens):
+        requestBucket, tokenBucket = self.bucketsFor(modelName)
+        pausedSeconds = self.pausedUntil.get(modelName, 0.0) - time.monotonic()
+
+        return max(pausedSeconds, requestBucket.secondsUntil(1), tokenBucket.secondsUntil(estimatedTokens))
+
+    async def acquire(self, modelName, estimatedTokens):
+        requestBucket, tokenBucket = self.bucketsFor(modelName)
+        async with self.locks[modelName]:
+            waitSeconds = self.secondsUntilReady(modelName, estimatedTokens)
+            if waitSeconds > 0:
+                self.waits += 1
+            while waitSeconds > 0:
+                await asyncio.sleep(waitSeconds)
+                self.waitedSeconds += waitSeconds
+                waitSeconds = self.secondsUntilReady(modelName, estimatedTokens)
+            requestBucket.consume(1)
+            tokenBucket.consume(estimatedTokens)
+
+    def record(self, modelName, estimatedTokens, usage, headers):
+        requestBucket, tokenBucket = self.bucketsFor(modelName)
+        totalTokens = getattr(usage, 'total_tokens', None) if usage is not None else None
+        if totalTokens is not None:
+            tokenBucket.consume(totalTokens - estimatedTokens)
+
+        if headers:
+            requestBucket.observe(
+                parseCount(headers.get('x-ratelimit-limit-requests')),
+                parseCount(headers.get('x-ratelimit-remaining-requests')),
+                parseDuration(headers.get('x-ratelimit-reset-requests')),
+            )
+            tokenBucket.observe(
+                parseCount(headers.get('x-ratelimit-limit-tokens')),
+                parseCount(headers.get('x-ratelimit-remaining-tokens')),
+                parseDuration(headers.get('x-ratelimit-reset-tokens')),
+            )
+
+    def pause(self, modelName, seconds):
+        self.pauses += 1
+        self.pausedUntil[modelName] = max(self.pausedUntil.get(modelName, 0.0), time.monotonic() + seconds)
+
+    def stats(self):
+        return {
+            'waits': self.waits,
+            'waitedSeconds': round(self.waitedSeconds, 3),
+            'pauses': self.pauses,
+            'limits': {
+                getattr(modelName, 'value', modelName): {'requestsPerMinute': requestBucket.capacity, 'tokensPerMinute': tokenBucket.capacity}
+                for modelName, (requestBucket, tokenBucket) in self.buckets.items()
+            },
+        }
+
+
+# Full jitter: a random delay between 0 and the exponential backoff, so the calls that failed together don't retry together.
+# A delay asked for by the API (a Retry-After header) is always honored.
+def backoffSeconds(attempt, retryAfterSeconds=None, baseSeconds=RETRY_BASE_SECONDS, maxSeconds=RETRY_MAX_SECONDS):
+    delay = random.uniform(0, min(maxSeconds, baseSeconds * 2 ** attempt))
+    if retryAfterSeconds is not None:
+        delay = max(delay, retryAfterSeconds)
+
+    return delay
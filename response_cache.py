@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from enums import CacheMode
+
+
+class ResponseCacheMissError(LookupError):
+    pass
+
+
+"""
+This class is a persistent, content-addressed cache for LLM responses.
+A response is stored under a hash of everything that determines it: model, system message, prompt, output type and temperature.
+The cache lives in a single SQLite file, so several processes can share it (SQLite takes care of the locking).
+Entries expire after maxAgeSeconds, and when the cache grows past maxEntries or maxBytes, the least recently used entries are evicted.
+In REPLAY mode, the cache never lets a call through to the API: a miss raises ResponseCacheMissError instead.
+Sampled calls (temperature above 0) are only cached with cacheSampledResponses, since a cached sample would be returned to every later call,
+which silently makes the sampled outputs deterministic. In REPLAY mode they are still looked up, so a replay never calls the API.
+"""
+class ResponseCache:
+    def __init__(self, path, mode=CacheMode.READ_WRITE, maxEntries=50000, maxBytes=512 * 1024 * 1024, maxAgeSeconds=30 * 24 * 3600, evictEveryWrites=100, cacheSampledResponses=False):
+        self.path = path
+        self.mode = mode
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.maxAgeSeconds = maxAgeSeconds
+        self.evictEveryWrites = evictEveryWrites
+        self.cacheSampledResponses = cacheSampledResponses
+        self.connection = None
+        self.lock = threading.Lock()
+        self.writesSinceEviction = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.sampledBypasses = 0
+
+    @staticmethod
+    def keyFor(modelName, systemMessage, prompt, outputType, temperature):
+        keyMaterial = json.dumps([modelName, systemMessage, prompt, outputType, temperature], ensure_ascii=False)
+
+        return hashlib.sha256(keyMaterial.encode('utf-8')).hexdigest()
+
+    def isEnabled(self):
+        return self.mode != CacheMode.OFF
+
+    def isCacheable(self, temperature):
+        return not temperature or self.cacheSampledResponses or self.mode == CacheMode.REPLAY
+
+    def connect(self):
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False, isolation_level=None)
+            # WAL lets readers in other processes keep going while one process writes.
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                content TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                createdAt REAL NOT NULL,
+                lastAccessedAt REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )''')
+            connection.execute('CREATE INDEX IF NOT EXISTS responsesByLastAccess ON responses (lastAccessedAt)')
+            connection.execute('CREATE INDEX IF NOT EXISTS responsesByCreation ON responses (createdAt)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self.connection = connection
+
+        return self.connection
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    # Counters are kept both for this process and in the file, so hit rates can be read across processes and runs.
+    def incrementCounter(self, connection, name, amount=1):
+        connection.execute('INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, amount))
+
+    def getSync(self, key):
+        with self.lock:
+            connection = self.connect()
+            now = time.time()
+            row = connection.execute('SELECT content, createdAt FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and now - row[1] > self.maxAgeSeconds:
+                connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                row = None
+
+            if row is None:
+                self.misses += 1
+                self.incrementCounter(connection, 'misses')
+                return None
+
+            connection.execute('UPDATE responses SET lastAccessedAt = ?, hits = hits + 1 WHERE key = ?', (now, key))
+            self.hits += 1
+            self.incrementCounter(connection, 'hits')
+
+            return row[0]
+
+    def putSync(self, key, modelName, content):
+        with self.lock:
+            connection = self.connect()
+            now = time.time()
+            connection.execute(
+                'INSERT OR REPLACE INTO responses (key, model, content, size, createdAt, lastAccessedAt) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, modelName, content, len(content.encode('utf-8')), now, now),
+            )
+            self.writes += 1
+            self.writesSinceEviction += 1
+            if self.writesSinceEviction >= self.evictEveryWrites:
+                self.evictSync(connection, now)
+
+    # Drops expired entries first, then the least recently used entries until the cache fits in maxEntries and maxBytes.
+    def evictSync(self, connection, now):
+        self.writesSinceEviction = 0
+        evicted = connection.execute('DELETE FROM responses WHERE createdAt < ?', (now - self.maxAgeSeconds,)).rowcount
+
+        entryCount, totalBytes = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        if entryCount > self.maxEntries or totalBytes > self.maxBytes:
+            keysToEvict = []
+            for key, size in connection.execute('SELECT key, size FROM responses ORDER BY lastAccessedAt ASC'):
+                if entryCount <= self.maxEntries and totalBytes <= self.maxBytes:
+                    break
+                keysToEvict.append((key,))
+                entryCount -= 1
+                totalBytes -= size
+            connection.executemany('DELETE FROM responses WHERE key = ?', keysToEvict)
+            evicted += len(keysToEvict)
+
+        if evicted:
+            self.evictions += evicted
+            self.incrementCounter(connection, 'evictions', evicted)
+
+    async def get(self, key, temperature=None):
+        if not self.isEnabled():
+            return None
+        if not self.isCacheable(temperature):
+            self.sampledBypasses += 1
+            return None
+
+        content = await asyncio.to_thread(self.getSync, key)
+        if content is None and self.mode == CacheMode.REPLAY:
+            raise ResponseCacheMissError(f'No cached response for key {key} (the response cache is in replay-only mode)')
+
+        return content
+
+    async def put(self, key, modelName, content, temperature=None):
+        if self.mode != CacheMode.READ_WRITE or content is None or not self.isCacheable(temperature):
+            return
+
+        await asyncio.to_thread(self.putSync, key, modelName, content)
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hitRate(),
+            'writes': self.writes,
+            'evictions': self.evictions,
+            'sampledBypasses': self.sampledBypasses,
+        }
@@ -0,0 +1,139 @@
+import os
+import time
+from collections import deque
+
+from enums import GPT
+from tracing import currentSpan
+
+# When disabled, every call goes to the strong model, as before.
+MODEL_ROUTING = os.environ.get('MODEL_ROUTING', '1') == '1'
+# Answers with a lower self-reported confidence are asked again to the strong model.
+ROUTER_MIN_CONFIDENCE = float(os.environ.get('ROUTER_MIN_CONFIDENCE', 0.5))
+# The share of the calls of a category that was sent straight to the strong model, which still go to the cheap model.
+ROUTER_EXPLORATION_RATE = float(os.environ.get('ROUTER_EXPLORATION_RATE', 0.05))
+
+# Answers that give up instead of answering.
+LOW_CONFIDENCE_PHRASES = ('cannot be determined', 'cannot determine', 'can not be determined', 'not enough information', 'insufficient information', 'unable to determine')
+# Answers that are nothing but a give-up word. "unknown" is often part of a valid answer (e.g. "the unknown x = 5"), so it only counts on its own.
+LOW_CONFIDENCE_ANSWERS = ('unknown', 'it is unknown', 'the answer is unknown')
+
+
+"""
+This class picks the model of every LLM call, and escalates calls that the cheap model got wrong.
+- Planning tasks (and tasks forced to answer after a planning loop) go to the strong model.
+- Type I tasks and conditional picks go to the cheap model. If its output can't be parsed, misses the expected key,
+is rejected by the caller, or has a low confidence, the call is made again with the strong model.
+It keeps the latency and success rate of every model, and the success rate of the cheap model on the last categoryWindow calls
+of every category of call. Once a category has minSamples of them, and the cheap model succeeds on fewer than minSuccessRate of them,
+the category goes straight to the strong model, since escalating almost every call would cost more than it saves.
+Still, explorationRate of its calls go to the cheap model, so the category goes back to it once the cheap model does better.
+"""
+class ModelRouter:
+    def __init__(self, enabled=MODEL_ROUTING, cheapModel=GPT.GPT4OMNIMINI, strongModel=GPT.GPT4OMNI, minConfidence=ROUTER_MIN_CONFIDENCE, minSuccessRate=0.7, minSamples=20, categoryWindow=100, explorationRate=ROUTER_EXPLORATION_RATE):
+        self.enabled = enabled
+        self.cheapModel = cheapModel
+        self.strongModel = strongModel
+        self.minConfidence = minConfidence
+        self.minSuccessRate = minSuccessRate
+        self.minSamples = minSamples
+        self.categoryWindow = categoryWindow
+        self.explorationRate = explorationRate
+        self.modelStats = dict()
+        # The outcomes (True if it succeeded) of the last categoryWindow calls of the cheap model, by category.
+        self.categoryOutcomes = dict()
+        # How many calls of every category were routed while it went straight to the strong model (the explored ones included).
+        self.strongRoutedCalls = dict()
+        self.explorationCalls = 0
+        self.escalations = dict()
+
+    def modelFor(self, task):
+        if not self.enabled or task.isPlanningTask() or task.mustAnswer:
+            return self.strongModel
+
+        return self.modelForCategory('type I')
+
+    def modelForPick(self):
+        if not self.enabled:
+            return self.strongModel
+
+        return self.modelForCategory('pick')
+
+    def modelForCategory(self, category):
+        outcomes = self.categoryOutcomes.get(category, ())
+        if len(outcomes) < self.minSamples or sum(outcomes) / len(outcomes) >= self.minSuccessRate:
+            return self.cheapModel
+
+        # Every 1 / explorationRate-th call goes to the cheap model, which keeps the window of the category up to date.
+        strongRoutedCalls = self.strongRoutedCalls.get(category, 0) + 1
+        self.strongRoutedCalls[category] = strongRoutedCalls
+        if int(strongRoutedCalls * self.explorationRate) > int((strongRoutedCalls - 1) * self.explorationRate):
+            self.explorationCalls += 1
+            return self.cheapModel
+
+        return self.strongModel
+
+    # Returns why the output should be escalated to the strong model, or None if it is good enough.
+    def escalationReason(self, outputJSON, requiredKey=None, isValid=None):
+        if not isinstance(outputJSON, dict):
+            return 'parse-failure'
+        if requiredKey is not None and requiredKey not in outputJSON:
+            return f'missing-{requiredKey}'
+        if isValid is not None and not isValid(outputJSON):
+            return 'invalid-output'
+
+        confidence = outputJSON.get('confidence')
+        if isinstance(confidence, (int, float)) and not isinstance(confidence, bool) and confidence < self.minConfidence:
+            return 'low-confidence'
+        if requiredKey == 'answer':
+            answer = str(outputJSON['answer']).lower()
+            if any(phrase in answer for phrase in LOW_CONFIDENCE_PHRASES) or answer.strip(' .!') in LOW_CONFIDENCE_ANSWERS:
+                return 'low-confidence'
+
+        return None
+
+    # Makes the call with modelName (makeCall(modelName) returns the parsed output), and escalates it if it needs to.
+    async def call(self, category, modelName, makeCall, requiredKey=None, isValid=None):
+        startedAt = time.monotonic()
+        outputJSON = await makeCall(modelName)
+        reason = self.escalationReason(outputJSON, requiredKey, isValid)
+        self.recordCall(modelName, category, time.monotonic() - startedAt, reason is None)
+
+        if reason is None or modelName == self.strongModel:
+            return outputJSON
+
+        self.escalations[reason] = self.escalations.get(reason, 0) + 1
+        span = currentSpan.get()
+        if span is not None:
+            span.set(escalation=reason)
+
+        startedAt = time.monotonic()
+        outputJSON = await makeCall(self.strongModel)
+        self.recordCall(self.strongModel, category, time.monotonic() - startedAt, self.escalationReason(outputJSON, requiredKey, isValid) is None)
+
+        return outputJSON
+
+    def recordCall(self, modelName, category, seconds, succeeded):
+        calls, successes, latencies = self.modelStats.setdefault(modelName, [0, 0, deque(maxlen=500)])
+        self.modelStats[modelName][:2] = [calls + 1, successes + (1 if succeeded else 0)]
+        latencies.append(seconds)
+
+        if modelName == self.cheapModel:
+            self.categoryOutcomes.setdefault(category, deque(maxlen=self.categoryWindow)).append(succeeded)
+
+    def stats(self):
+        modelStats = dict()
+        for modelName, (calls, successes, latencies) in self.modelStats.items():
+            sortedLatencies = sorted(latencies)
+            modelStats[modelName.value] = {
+                'calls': calls,
+                'successRate': successes / calls if calls else 0.0,
+                'medianSeconds': round(sortedLatencies[len(sortedLatencies) // 2], 3) if sortedLatencies else 0.0,
+            }
+
+        return {
+            'enabled': self.enabled,
+            'models': modelStats,
+            'cheapSuccessRates': {category: sum(outcomes) / len(outcomes) for category, outcomes in self.categoryOutcomes.items() if outcomes},
+            'explorationCalls': self.explorationCalls,
+            'escalations': dict(self.escalations),
+        }
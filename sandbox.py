@@ -0,0 +1,248 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import queue
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# How many sandbox processes are kept warm, and the limits of every program they run.
+SANDBOX_PROCESSES = int(os.environ.get('SANDBOX_PROCESSES', 4))
+SANDBOX_TIMEOUT_SECONDS = float(os.environ.get('SANDBOX_TIMEOUT_SECONDS', 5.0))
+SANDBOX_MEMORY_MB = int(os.environ.get('SANDBOX_MEMORY_MB', 512))
+SANDBOX_MAX_OUTPUT_CHARACTERS = 10000
+# A sandbox process is replaced after this many programs, so nothing a program leaves behind (e.g. in sys.modules) builds up.
+SANDBOX_MAX_RUNS_PER_PROCESS = 200
+
+# The program that every sandbox process runs. It reads one JSON request per line ({"code": ...}), runs the code with its stdout
+# captured, and writes one JSON response per line. The protocol uses its own copies of stdin and stdout, so a program that reads
+# stdin, or writes to file descriptor 1, can't break it. The modules that computations usually need are imported up front.
+SANDBOX_WORKER_SOURCE = r'''
+import contextlib, io, json, os, resource, sys, traceback
+import math, cmath, fractions, decimal, statistics, itertools, functools, collections, re, datetime
+
+memoryBytes, cpuSeconds, maxOutputCharacters = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+resource.setrlimit(resource.RLIMIT_AS, (memoryBytes, memoryBytes))
+resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+
+protocolIn = os.fdopen(os.dup(0), 'r')
+protocolOut = os.fdopen(os.dup(1), 'w')
+devNull = os.open(os.devnull, os.O_RDWR)
+os.dup2(devNull, 0)
+os.dup2(devNull, 1)
+
+for line in protocolIn:
+    request = json.loads(line)
+    output = io.StringIO()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + cpuSeconds, resource.RLIM_INFINITY))
+    response = {'ok': True}
+    try:
+        sys.stdin = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            exec(compile(request['code'], '<sandbox>', 'exec'), {'__name__': '__main__'})
+    except SystemExit as error:
+        if error.code not in (None, 0):
+            response = {'ok': False, 'error': f'SystemExit: {error.code}'}
+    except BaseException as error:
+        response = {'ok': False, 'error': ''.join(traceback.format_exception_only(type(error), error)).strip()}
+    response['stdout'] = output.getvalue()[:maxOutputCharacters]
+    protocolOut.write(json.dumps(response) + '\n')
+    protocolOut.flush()
+'''
+
+
+"""
+This class is the outcome of a program: whether it ran without an error, what it printed, and the error, if any.
+"""
+class SandboxResult:
+    __slots__ = ('ok', 'stdout', 'error', 'seconds', 'cached')
+
+    def __init__(self, ok, stdout, error=None, seconds=0.0, cached=False):
+        self.ok = ok
+        self.stdout = stdout
+        self.error = error
+        self.seconds = seconds
+        self.cached = cached
+
+    def answer(self):
+        return self.stdout.strip() if self.ok else None
+
+
+"""
+This class is a sandbox process: a Python interpreter that runs SANDBOX_WORKER_SOURCE in isolated mode (-I), with an empty environment,
+in its own temporary directory, and with limits on its memory, CPU time, file writes and child processes.
+These limits keep a wrong program from hurting the run (a runaway loop, a huge allocation), but they are not a security boundary
+against hostile code.
+"""
+class SandboxProcess:
+    def __init__(self, timeoutSeconds, memoryMB):
+        self.timeoutSeconds = timeoutSeconds
+        self.workingDirectory = tempfile.mkdtemp(prefix='sandbox-')
+        cpuSeconds = max(int(timeoutSeconds) + 1, 1)
+        self.process = subprocess.Popen(
+            [sys.executable, '-I', '-c', SANDBOX_WORKER_SOURCE, str(memoryMB * 1024 * 1024), str(cpuSeconds), str(SANDBOX_MAX_OUTPUT_CHARACTERS)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=self.workingDirectory,
+            env={},
+            text=True,
+        )
+        self.runs = 0
+
+    def isAlive(self):
+        return self.process.poll() is None
+
+    def run(self, code):
+        self.runs += 1
+        self.process.stdin.write(json.dumps({'code': code}) + '\n')
+        self.process.stdin.flush()
+
+        readable, _, _ = select.select([self.process.stdout], [], [], self.timeoutSeconds)
+        if not readable:
+            self.close()
+            return SandboxResult(False, '', f'The program timed out after {self.timeoutSeconds}s')
+
+        line = self.process.stdout.readline()
+        if not line:
+            # The process was killed by one of its limits.
+            self.close()
+            return SandboxResult(False, '', 'The program exceeded the limits of the sandbox')
+
+        response = json.loads(line)
+
+        return SandboxResult(response['ok'], response['stdout'], response.get('error'))
+
+    def close(self):
+        if self.isAlive():
+            self.process.kill()
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        shutil.rmtree(self.workingDirectory, ignore_errors=True)
+
+
+"""
+This class runs the programs of computational tasks in a pool of pre-warmed sandbox processes (see SandboxProcess).
+The processes start on first use and are reused, so a program only pays for its own run, not for starting an interpreter.
+A process that timed out or hit a limit is replaced, and so is a process that ran maxRunsPerProcess programs.
+Results are cached by a hash of the code, and a program that is already running is not started again, so identical
+computations run once. Only successful runs are cached, since a failure may come from a limit rather than from the code.
+The processes are used from threads, so the pool doesn't depend on any event loop.
+"""
+class SandboxPool:
+    def __init__(self, processCount=SANDBOX_PROCESSES, timeoutSeconds=SANDBOX_TIMEOUT_SECONDS, memoryMB=SANDBOX_MEMORY_MB, maxRunsPerProcess=SANDBOX_MAX_RUNS_PER_PROCESS):
+        self.processCount = processCount
+        self.timeoutSeconds = timeoutSeconds
+        self.memoryMB = memoryMB
+        self.maxRunsPerProcess = maxRunsPerProcess
+        self.idleProcesses = queue.Queue()
+        self.startLock = threading.Lock()
+        self.isStarted = False
+        self.results = dict()
+        self.inFlight = dict()
+        self.runs = 0
+        self.cacheHits = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.runSeconds = 0.0
+
+    def start(self):
+        with self.startLock:
+            if not self.isStarted:
+                for _ in range(self.processCount):
+                    self.idleProcesses.put(SandboxProcess(self.timeoutSeconds, self.memoryMB))
+                self.isStarted = True
+
+    @staticmethod
+    def codeHash(code):
+        return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+    def runSync(self, code):
+        self.start()
+        sandboxProcess = self.idleProcesses.get()
+        startedAt = time.monotonic()
+        try:
+            result = sandboxProcess.run(code)
+        finally:
+            if not sandboxProcess.isAlive() or sandboxProcess.runs >= self.maxRunsPerProcess:
+                sandboxProcess.close()
+                sandboxProcess = SandboxProcess(self.timeoutSeconds, self.memoryMB)
+            self.idleProcesses.put(sandboxProcess)
+        result.seconds = time.monotonic() - startedAt
+
+        return result
+
+    # Every caller of the same program waits for the same run, and only its own wait is cancelled if it is cancelled:
+    # the run goes on (its thread can't be stopped anyway), and its result still goes to the others, and to the cache.
+    async def run(self, code):
+        key = self.codeHash(code)
+        if key in self.results:
+            self.cacheHits += 1
+            cachedResult = self.results[key]
+            return SandboxResult(cachedResult.ok, cachedResult.stdout, cachedResult.error, 0.0, cached=True)
+
+        if key in self.inFlight:
+            self.cacheHits += 1
+        else:
+            self.inFlight[key] = asyncio.ensure_future(self.runInThread(key, code))
+            # If every caller was cancelled, nobody retrieves its error, so asyncio would report it.
+            self.inFlight[key].add_done_callback(lambda runFuture: runFuture.cancelled() or runFuture.exception())
+
+        return await asyncio.shield(self.inFlight[key])
+
+    async def runInThread(self, key, code):
+        try:
+            result = await asyncio.to_thread(self.runSync, code)
+        finally:
+            del self.inFlight[key]
+
+        self.runs += 1
+        self.runSeconds += result.seconds
+        if result.ok:
+            self.results[key] = result
+        else:
+            self.failures += 1
+            if result.error is not None and 'timed out' in result.error:
+                self.timeouts += 1
+
+        return result
+
+    def close(self):
+        with self.startLock:
+            while not self.idleProcesses.empty():
+                self.idleProcesses.get().close()
+            self.isStarted = False
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'cacheHits': self.cacheHits,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'averageRunSeconds': round(self.runSeconds / self.runs, 4) if self.runs else 0.0,
+        }
+
+
+sandboxPool = SandboxPool()
+atexit.register(lambda: sandboxPool.close())
+
+
+# Replaces the module-level sandbox pool. Call this before starting a run, not while programs are running.
+def configureSandbox(**poolOptions):
+    global sandboxPool
+    sandboxPool.close()
+    sandboxPool = SandboxPool(**poolOptions)
+
+    return sandboxPool
@@ -0,0 +1,116 @@
+"""
+This class is the state history (STATE HISTORY) of a run: an append-only list of steps, where each step is an {id: return value} dict.
+Steps are addressed by their step id, which is their index in the history, and they never change once appended.
+
+The rendered text of the history is cached and extended incrementally, so rendering it for a prompt only formats the steps
+that were appended since the last render.
+
+A history can be forked into a copy-on-write view. The view shares all the steps of its parent up to the fork point,
+and the steps appended to the view stay private to it. Parallel branches of a graph each work on their own view,
+so siblings never see each other's in-progress steps.
+"""
+class StateHistory:
+    __slots__ = ('parent', 'baseLength', 'ownSteps', 'renderedText', 'renderedLength', 'prefixLengths')
+
+    def __init__(self, steps=None, parent=None):
+        self.parent = parent
+        self.baseLength = len(parent) if parent is not None else 0
+        self.ownSteps = list(steps or [])
+        self.renderedText = None
+        self.renderedLength = 0
+        # prefixLengths[i] is the length of the rendered text that covers the first (baseLength + i) steps.
+        self.prefixLengths = []
+
+    @staticmethod
+    def formatStep(stepId, step):
+        formattedStepList = []
+        for key, value in step.items():
+            formattedStepList.append(f'''Step #{stepId}:\n\tId: {key}\n\tReturn Value: {value}''')
+
+        return '\n'.join(formattedStepList)
+
+    def __len__(self):
+        return self.baseLength + len(self.ownSteps)
+
+    def __getitem__(self, stepId):
+        if stepId < 0:
+            stepId += len(self)
+        if stepId < 0 or stepId >= len(self):
+            raise IndexError(f'Step #{stepId} is not in the state history')
+        if stepId < self.baseLength:
+            return self.parent[stepId]
+
+        return self.ownSteps[stepId - self.baseLength]
+
+    def __iter__(self):
+        return self.iterateSteps(len(self))
+
+    def iterateSteps(self, length):
+        if self.parent is not None:
+            yield from self.parent.iterateSteps(min(length, self.baseLength))
+        yield from self.ownSteps[:max(length - self.baseLength, 0)]
+
+    def __repr__(self):
+        return repr(self.toList())
+
+    def toList(self):
+        return list(self)
+
+    def append(self, step):
+        self.ownSteps.append(step)
+
+        return len(self) - 1
+
+    def extend(self, steps):
+        for step in steps:
+            self.append(step)
+
+    # Returns a copy-on-write view of this history. Forking doesn't copy any steps.
+    def fork(self):
+        return StateHistory(parent=self)
+
+    # The steps that were appended to this view since it was forked.
+    def newSteps(self):
+        return list(self.ownSteps)
+
+    # Returns the rendered text of the first `length` steps (all the steps by default).
+    def render(self, length=None):
+        if length is None:
+            length = len(self)
+        if length <= self.baseLength and self.parent is not None:
+            return self.parent.render(length)
+
+        self.renderThrough(length)
+        if length == self.renderedLength:
+            return self.renderedText
+
+        return self.renderedText[:self.prefixLengths[length - self.baseLength]]
+
+    # Returns the rendered text of steps [start, end).
+    def renderRange(self, start, end=None):
+        prefixLength = len(self.render(start))
+
+        return self.render(end)[prefixLength:].lstrip('\n')
+
+    def renderThrough(self, length):
+        if self.renderedText is None:
+            self.renderedText = self.parent.render(self.baseLength) if self.parent is not None else ''
+            self.renderedLength = self.baseLength
+            self.prefixLengths = [len(self.renderedText)]
+
+        if length <= self.renderedLength:
+            return
+
+        newTextList = []
+        textLength = len(self.renderedText)
+        for stepId in range(self.renderedLength, length):
+            formattedStep = self.formatStep(stepId, self.ownSteps[stepId - self.baseLength])
+            if formattedStep:
+                if textLength > 0:
+                    formattedStep = '\n' + formattedStep
+                newTextList.append(formattedStep)
+                textLength += len(formattedStep)
+            self.prefixLengths.append(textLength)
+
+        self.renderedText += ''.join(newTextList)
+        self.renderedLength = length
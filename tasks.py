@@ -1,8 +1,19 @@
+import asyncio
 import json
+import math
 
-from gpt_api_calls import gpt
-from enums import GPT, GPTOutputType
+import sandbox
+from gpt_api_calls import gpt, gptStream
+from enums import GPTOutputType
 from graph import AlgorithmGraph
+from execution_context import ExecutionContext
+from state_history import StateHistory
+from governor import ExecutionAborted
+from checkpoint import Checkpoint
+from enums import RepeatedPlanAction
+from text_helpers import IncrementalJSONParser, extractJSONSubstring, repairJSONSubstring
+from plan_compiler import compilePlan, normalizeNode, PlanCompilationError
+from prompts import TASK_PROMPT, RELEVANT_STATE_PROMPT, PLAN_VALIDATION_PROMPT, COMPUTATION_TASK, taskInstructions
 
 """
 This class represents a planning task. A planning task is a task that creates a plan.
@@ -13,9 +24,19 @@ The way the Planning Task works is the following:
 - If the response from the LLM indicates the reaching of the final goal, it stores the final results and terminates.
 - Else if the response from the LLM does not indicate reaching the final goal, it spins up another plan (algorithmic graph) and runs it.
 3-) It keeps doing this recursively until the final goal is reached.
+Deep recursion trees create many tasks, so a task is kept small: its attributes are slots, its instructions (task) are shared with
+every task of the same kind (see prompts.taskInstructions), its prompt is released once it was sent, and once it finished in its graph,
+it is collapsed into a record of its result (see collapse).
 """
 class PlanningTask:
-    def __init__(self, humanReadableName, systemMessage, inputTuple, isConditionalNode=False):
+    __slots__ = (
+        'humanReadableName', 'systemMessage', 'isConditionalNode', 'rulesList', 'state', 'goal', 'expectedOutputJSONSchema', 'description',
+        'reasoningType', 'parentTask', 'condition', 'rules', 'outputJSON', 'inputJSON', 'prompt', 'executionContext', 'planFingerprint',
+        'mustAnswer', 'task', 'gptModel', 'latestOutput', 'contextReport', 'abortResult', 'result', 'answer', 'isSpeculative', 'isRestored',
+        'isComputation', 'reusedPlan', 'depth', 'path', 'deadlineAt', 'isRemoteUnit', 'planOutcome',
+    )
+
+    def __init__(self, humanReadableName, systemMessage, inputTuple, isConditionalNode=False, executionContext=None):
 
         rulesList, state, goal, expectedOutputJSONSchema, description, reasoningType, parentTask = inputTuple
 
@@ -23,7 +44,7 @@ class PlanningTask:
         self.systemMessage = systemMessage
         self.isConditionalNode = isConditionalNode
         self.rulesList = rulesList
-        self.state = state
+        self.state = state if isinstance(state, StateHistory) else StateHistory(state)
         self.goal = goal
         self.expectedOutputJSONSchema = expectedOutputJSONSchema
         self.description = description
@@ -32,9 +53,40 @@ class PlanningTask:
         self.condition = None
         self.rules = None
         self.outputJSON = None
+        self.inputJSON = None
+        # The prompt of the task's LLM call. It is only kept until the call returns.
+        self.prompt = None
+        # The root task creates the execution context, and all the tasks below it share it.
+        self.executionContext = executionContext if executionContext is not None else ExecutionContext()
+        # Set by the governor checks: the fingerprint of the plan this task generated, and whether the task must answer directly.
+        self.planFingerprint = None
+        self.mustAnswer = False
         self.task = self.determineTask()
         self.gptModel = self.determineGPTModelBasedOnReasoningType()
         self.latestOutput = None
+        self.contextReport = None
+        # Set on the root task when the run is aborted by the governor.
+        self.abortResult = None
+        # The result of the task: its direct answer, or the latest output of the graph it spun off.
+        self.result = None
+        self.answer = None
+        # A speculative task runs before its conditional predecessor has picked it, so it must not touch its parent task yet.
+        self.isSpeculative = False
+        # Set when the task finished in an earlier run, and its result was restored from the checkpoint.
+        self.isRestored = False
+        # Set on the type I nodes that the plan marked as computations (see computeWithCode).
+        self.isComputation = False
+        # The plan of the plan library that this task reuses, if any (see reuseStoredPlan).
+        self.reusedPlan = None
+        # Set on the root task of a work unit in a worker, whose plan outcome is sent back with its result (see worker.py).
+        self.isRemoteUnit = False
+        self.planOutcome = None
+        # The time (time.monotonic()) by which the task must be finished. The graph that runs the task sets it (see deadlines.py).
+        self.deadlineAt = math.inf
+        self.depth = parentTask.depth + 1 if parentTask is not None else 0
+        self.executionContext.governor.recordDepth(self.depth)
+        # The path of the task in the recursion tree. It identifies the task in checkpoints.
+        self.path = Checkpoint.taskPath(self)
     
     @staticmethod
     def convertinputDataDictsToSingleJSON(inputDataDicts):
@@ -51,40 +103,14 @@ class PlanningTask:
         return finalInputJSON
 
 
+    # The instruction blocks are precompiled and shared by all the tasks (see prompts.py).
     def determineTask(self):
-        reasoningType = self.reasoningType
-        if reasoningType is None or reasoningType == '':
-            return f'''You must choose ONE from the following:
-
-Option 1: Evaluate if you can directly satisfy the goal (GOAL) by reviewing the provided state history (STATE HISTORY) above. If you can achieve this without additional computations, you MUST return a pure JSON object that contains the following key/value pair: key is: “answer” and its value is: the actual answer that you found from the state. It cannot be ambiguous, and it cannot be another task. It must be a clear returned value.
-Option 2: If the state history (STATE HISTORY) does not provide sufficient information to directly satisfy the goal (GOAL), create a Python networkx graph represented in JSON format to outline the algorithm or plan you will use to achieve the goal, given the current state history (STATE HISTORY). The graph MUST be a JSON object that contains the following keys:
-    "nodes": This must contain all the graph's nodes in the networkx graph. The nodes will represent subtasks that you will take. Each node will be a JSON object that contains "id" key. The "id" should be a human-readable short description of the node. Each node MUST also contain a "description" key that describes the node's function in more details than the "id". A maximum of one sentence is allowed. Each node must include its reasoning type "type" (type I for direct computation tasks vs. type II for more multi-step computations). If a node is a conditional node, you should add the key "conditional" to it. The graph MUST NOT contain a "START" node. The graph MUST contain an "END" node to represent the termination node of the algorithm.
-    "edges": This must contain all the graph's edges. If an edge is a conditional edge, you should add the key "condition" that specifies the condition as a string. Each edge is an object that contains a "source" and a "target" node ids. The ids should match the node ids you define.
-'''
-        elif reasoningType == 'type I' or reasoningType == 'I':
-            return '''Use the provided state history (STATE HISTORY) to achieve the goal (GOAL). You MUST return a pure JSON object that contains the following key/value pairs:
-"reasoning": the reasoning that justifies the answer. You can use intermediate results from this reasoning to form your final answer.
-“answer”: the actual answer that you found from the state and your reasoning above. It cannot be ambigious, and it cannot be another task. It must be a clear computed returned value.
-'''
-        
-        elif reasoningType == 'type II' or reasoningType == 'II':
-            return '''If the state history (STATE HISTORY) does not provide sufficient information to directly satisfy the goal (GOAL), create a Python networkx graph represented in JSON format to outline the algorithm or plan you will use to achieve the goal, given the current state history (STATE HISTORY). The graph MUST be a JSON object that contains the following keys:
-"nodes": This must contain all the graph's nodes in the networkx graph. The nodes will represent subtasks that you will take. Each node will be a JSON object that contains "id" key. The "id" should be a human-readable short description of the node. Each node MUST also contain a "description" key that describes the node's function in more details than the "id". A maximum of one sentence is allowed. Each node must include its reasoning type "type" (type I for direct computation tasks vs. type II for more multi-step computations). If a node is a conditional node, you should add the key "conditional" to it. The graph MUST NOT contain a "START" node. The graph MUST contain an "END" node to represent the termination node of the algorithm.
-"edges": This must contain all the graph's edges. If an edge is a conditional edge, you should add the key "condition" that specifies the condition as a string. Each edge is an object that contains a "source" and a "target" node ids. The ids should match the node ids you define.
-'''
+        return taskInstructions(self.reasoningType, self.executionContext.codeExecution, self.executionContext.streamPlans)
 
-    """We use this function to save costs on GPT calls. If a task is simple, use a simple and cheaper model."""
+    """We use this function to save costs on GPT calls. If a task is simple, use a simple and cheaper model.
+    The model router (see routing.py) sends planning tasks to the sophisticated model, and type I tasks to the cheaper one."""
     def determineGPTModelBasedOnReasoningType(self):
-        reasoningType = self.reasoningType
-        if reasoningType is None or reasoningType == '':
-            # Should return a more sophisticated model
-            return GPT.GPT4OMNI
-        elif reasoningType == 'type I' or reasoningType == 'I':
-            # Can return a simpler model since the task is simple
-            return GPT.GPT4OMNI
-        elif reasoningType == 'type II' or reasoningType == 'II':
-            # Should return a more sophisticated model
-            return GPT.GPT4OMNI
+        return self.executionContext.router.modelFor(self)
 
 
     def assembleRules(self):
@@ -97,39 +123,19 @@ Option 2: If the state history (STATE HISTORY) does not provide sufficient infor
 
         return rulesString
     
+    # The state history caches its rendered text, so this only formats the steps appended since the last call.
     def formatState(self):
-
-        formattedStateList = []
-        for stateIndex, state in enumerate(self.state):
-            for key, value in state.items():
-                formattedStateList.append(f'''Step #{stateIndex}:\n\tId: {key}\n\tReturn Value: {value}''')
-
-        return '\n'.join(formattedStateList)
-
-    def assemblePrompt(self):
-        formattedState = self.formatState()
-        prompt = f'''You will be presented with the following:
-
-- State History (STATE HISTORY): This is a list of all previously taken steps along with their returned values.
-- Goal (GOAL): A goal you MUST achieve.
-- Goal Description (GOAL DESCRIPTION): A more detailed description of the goal (GOAL).
-- Task (TASK): A task to perform given the full state history (STATE HISTORY) and the goal (GOAL).
-
-Here is the information:
-
-STATE HISTORY
-{formattedState}
-
-GOAL
-{self.goal}
-
-GOAL DESCRIPTION
-{self.description}
-
-TASK
-{self.task}
-YOU MUST LEVERAGE THE RESULTS IN THE STATE HISTORY WHEN POSSIBLE, AND AVOID CREATING TYPE II TASKS AND GRAPHS WHEN THEY ARE NOT NEEDED.
-'''
+        return self.state.render()
+
+    # formattedState is the (possibly compacted) state history to send. By default, the full state history is sent.
+    # task replaces the task's own instructions (TASK).
+    def assemblePrompt(self, formattedState=None, task=None):
+        if formattedState is None:
+            formattedState = self.formatState()
+        if task is None:
+            task = self.task
+        # The state history goes after the instructions and before the goal, so that the calls of a branch share the longest prefix.
+        prompt = TASK_PROMPT.render(task=task, state=formattedState, goal=self.goal, description=self.description)
 
 #         If you end up creating a graph (Option 2), avoid creating nodes from the state history (STATE HISTORY). The nodes cannot contain the following node: {self.goal}.
 # If you end up in an infinite cycle or loop in the state history, it is your responsibility to cleverly create the graph in a way that resolves the loop.
@@ -139,61 +145,184 @@ YOU MUST LEVERAGE THE RESULTS IN THE STATE HISTORY WHEN POSSIBLE, AND AVOID CREA
 
     async def selectRelevantState(self):
 
-        prompt = f'''You will be presented with the following:
+        prompt = RELEVANT_STATE_PROMPT.render(state=self.state, goal=self.goal, description=self.description)
 
-- Full State History (FULL STATE HISTORY): This is a list of all previously taken steps along with their returned values.
-- Goal (GOAL): A goal you MUST achieve.
-- Goal Description (GOAL DESCRIPTION): A more detailed description of the goal (GOAL).
-- Task (TASK): A task to perform given the full state history (STATE HISTORY) and the goal (GOAL).
+        outputJSON, _ = await gpt(self.gptModel, self.systemMessage, prompt, outputType=GPTOutputType.JSON, executionContext=self.executionContext)
 
-Here is the information:
+        if not isinstance(outputJSON, dict):
+            return None
 
-FULL STATE HISTORY
-{self.state}
-
-GOAL
-{self.goal}
+        return outputJSON.get('filtered_state_history')
+    
 
-GOAL DESCRIPTION
-{self.description}
+    # The governor can abort the run from anywhere in the recursion tree. The error goes up to the root task,
+    # which keeps the structured result (including the partial state history) in abortResult.
+    async def run(self, inputJSONs=None):
+        tracer = self.executionContext.tracer
+        parentName = self.parentTask.humanReadableName if self.parentTask is not None else None
+        checkpoint = self.executionContext.checkpoint
+        with tracer.span(self.humanReadableName, 'task', depth=self.depth, parentTask=parentName, reasoningType=self.reasoningType, model=self.gptModel.value) as span:
+            try:
+                if self.parentTask is None:
+                    checkpoint.recordRun(self)
+
+                if inputJSONs:
+                    self.inputJSON = self.convertinputDataDictsToSingleJSON(inputJSONs)
+
+                planningLoopReason = self.executionContext.governor.findPlanningLoop(self) if self.isPlanningTask() else None
+                if planningLoopReason is not None:
+                    self.forceAnswer(planningLoopReason)
+
+                await self.reason()
+                if self.parentTask is None:
+                    checkpoint.recordFinished(self)
+            except ExecutionAborted as error:
+                error.attachState(self.state)
+                if self.parentTask is not None:
+                    raise
+                self.abortResult = error.result()
+                span.set(aborted=error.reason)
+                tracer.log(f'~~ ABORTED: {error}')
+            finally:
+                span.set(answered=self.answer is not None, context=(self.contextReport or {}).get('strategy'))
+                # Whatever happens to the run, the root task writes out the buffered checkpoint records, and drops the batches that nobody waits for.
+                if self.parentTask is None:
+                    checkpoint.flush()
+                    self.executionContext.batcher.cancelPendingBatches()
+
+    def isPlanningTask(self):
+        return self.reasoningType in (None, '', 'type II', 'II')
+
+    def isTypeI(self):
+        return self.reasoningType in ('type I', 'I')
+
+    # Turns the task into a type I task, so the next LLM call has to answer it directly instead of planning again.
+    def forceAnswer(self, reason):
+        self.executionContext.tracer.log(f'~~ Forcing a direct answer for task: {self.humanReadableName}, because {reason}')
+        self.executionContext.governor.forcedAnswers += 1
+        self.reasoningType = 'type I'
+        self.task = self.determineTask()
+        self.mustAnswer = True
+        self.gptModel = self.determineGPTModelBasedOnReasoningType()
 
-TASK
-Select and filter the state history (STATE HISTORY) items that are relevant to the goal (GOAL), while removing irrelevant items. Use the goal (GOAL) and goal description (GOAL description) to inform you about what you think you will need.
+    async def reason(self):
+        # A resumed run replays the LLM outputs that were recorded before it stopped.
+        restoredOutputJSON = self.executionContext.checkpoint.restoredOutput(self)
+        if restoredOutputJSON is not None:
+            self.outputJSON = restoredOutputJSON
+            await self.evaluateLLMResponse()
+            return
 
-OUTPUT FORMAT (JSON)
-Your output must be a JSON object that contains the following keys:
-"filtered_state_history": The new filtered state history to elements that are relevant to the task. It must be of the same structure as the full state history, and it must use the same keys for the kept items.
+        if await self.reuseStoredPlan():
+            return
 
-'''
-        
-        outputJSON, _ = await gpt(self.gptModel, self.systemMessage, prompt, outputType=GPTOutputType.JSON)
+        if self.executionContext.streamPlans and self.isPlanningTask() and not self.mustAnswer:
+            await self.reasonWithStreamedPlan()
+            return
 
-        return outputJSON['filtered_state_history']
-    
-
-    async def run(self, inputJSONs=None):
-        if inputJSONs:
-            self.inputJSON = self.convertinputDataDictsToSingleJSON(inputJSONs)
-        
         self.rules = self.assembleRules()
-        self.prompt = self.assemblePrompt()
+        # The context manager keeps the state history within the token budget of a single prompt.
+        formattedState, self.contextReport = await self.executionContext.contextManager.buildContext(self)
+        self.prompt = self.assemblePrompt(formattedState)
+
+        tracer = self.executionContext.tracer
+        if tracer.verbose:
+            tracer.log(f'DETAILED STATE HISTORY:\n{self.state.render()}\n-------------------------')
 
-        print('DETAILED STATE HISTORY:')
-        for state in self.state:
-            for key, value in state.items():
-                print(f'{key}: {value}')
-        print('-------------------------')
+        outputJSON = None
+        if self.isComputation and self.isTypeI() and self.executionContext.codeExecution:
+            outputJSON = await self.computeWithCode(formattedState)
 
         """ DIRECTLY USING OPENAI """
-        outputJSON, _ = await gpt(self.gptModel, self.systemMessage, self.prompt, outputType=GPTOutputType.JSON)
+        # Type I answers from the cheap model are asked again to the strong model when they are missing, unparsable or unsure.
+        if outputJSON is None:
+            requiredKey = 'answer' if self.isTypeI() else None
+            outputJSON = await self.executionContext.router.call('type I' if self.isTypeI() else 'plan', self.gptModel, lambda modelName: self.askLLM(modelName, formattedState), requiredKey)
+        self.prompt = None
 
-        print('GPT OUTPUT:')
-        print(outputJSON)
-        # print('-------------------------')
+        tracer.log(f'GPT OUTPUT:\n{outputJSON}')
         self.outputJSON = outputJSON
+        self.executionContext.checkpoint.recordOutput(self, outputJSON)
 
         await self.evaluateLLMResponse()
 
+    # Reuses the plan of a similar goal from the plan library (see plan_library.py), instead of asking the LLM for a new plan.
+    # Returns whether a plan was reused.
+    async def reuseStoredPlan(self):
+        planLibrary = self.executionContext.planLibrary
+        match = planLibrary.find(self)
+        if match is None:
+            return False
+
+        storedPlan, similarity = match
+        tracer = self.executionContext.tracer
+        rejectionReason = await self.validateReusedPlan(storedPlan)
+        if rejectionReason is not None:
+            planLibrary.reject()
+            tracer.log(f'~~ Task: {self.humanReadableName} does not reuse the stored plan of "{storedPlan.goal}", because {rejectionReason}')
+            return False
+
+        tracer.log(f'~~ Task: {self.humanReadableName} reuses the stored plan of "{storedPlan.goal}" (similarity {similarity})')
+        self.reusedPlan = storedPlan
+        self.outputJSON = storedPlan.outputJSON()
+        self.executionContext.checkpoint.recordOutput(self, self.outputJSON)
+        await self.evaluateLLMResponse()
+
+        return True
+
+    # Returns why the stored plan can't be reused for this task, or None if it can.
+    # A plan that an ancestor is already running would loop. With validation on, the cheap model is also asked whether the plan fits.
+    async def validateReusedPlan(self, storedPlan):
+        governor = self.executionContext.governor
+        planFingerprint = governor.planFingerprint(self.goal, storedPlan.nodes, storedPlan.edges)
+        if any(ancestor.planFingerprint == planFingerprint for ancestor in governor.ancestors(self)):
+            return 'an ancestor task is running the same plan'
+
+        if not self.executionContext.planLibrary.validate:
+            return None
+
+        prompt = PLAN_VALIDATION_PROMPT.render(
+            state=self.formatState(),
+            storedGoal=storedPlan.goal,
+            plan=json.dumps(storedPlan.outputJSON(), ensure_ascii=False),
+            goal=self.goal,
+            description=self.description,
+        )
+        outputJSON, _ = await gpt(self.executionContext.router.cheapModel, self.systemMessage, prompt, outputType=GPTOutputType.JSON, executionContext=self.executionContext)
+        if not isinstance(outputJSON, dict) or outputJSON.get('fits') is not True:
+            return 'the validator found that it does not fit the goal'
+
+        return None
+
+    # A computational task asks the LLM for a program instead of an answer, and runs it in the sandbox pool (see sandbox.py).
+    # What the program prints is the answer. Returns None if there is no program, or if it fails, so the task answers directly instead.
+    async def computeWithCode(self, formattedState):
+        prompt = self.assemblePrompt(formattedState, COMPUTATION_TASK)
+        code, _ = await gpt(self.gptModel, self.systemMessage, prompt, outputType=GPTOutputType.CODE, executionContext=self.executionContext)
+        tracer = self.executionContext.tracer
+        if code is None:
+            tracer.log(f'~~ Task: {self.humanReadableName} got no program, so it answers directly')
+            return None
+
+        with tracer.span(f'run program of {self.humanReadableName}', 'sandbox') as span:
+            result = await sandbox.sandboxPool.run(code)
+            span.set(ok=result.ok, cached=result.cached, error=result.error)
+
+        if not result.answer():
+            tracer.log(f'~~ Task: {self.humanReadableName} has a program that failed ({result.error or "no output"}), so it answers directly')
+            return None
+
+        return {'reasoning': f'Computed by the program:\n{code}', 'answer': result.answer()}
+
+    async def askLLM(self, modelName, formattedState):
+        if modelName == self.gptModel and self.isTypeI() and self.executionContext.batcher.enabled:
+            # Type I tasks that are ready at the same time, with the same context, share one LLM call.
+            return await self.executionContext.batcher.submit(self, formattedState)
+
+        outputJSON, _ = await gpt(modelName, self.systemMessage, self.prompt, outputType=GPTOutputType.JSON, executionContext=self.executionContext)
+
+        return outputJSON
+
     # This function evaluates the JSON response from the reasoning LLM.
     # If the JSON response contains the key "answer", this means we have reached the goal and got an answer, so terminate.
     # If the JSON response does not contain the key "answer", this means that we need to create the next plan.
@@ -201,74 +330,272 @@ Your output must be a JSON object that contains the following keys:
         # outputAsDict = json.loads(self.outputJSON)
         outputJSON = self.outputJSON
 
-        if 'answer' in outputJSON.keys():
+        # An output that couldn't be parsed (None) has no answer, and fails to compile as a plan.
+        if isinstance(outputJSON, dict) and 'answer' in outputJSON:
             # for state in self.state:
             #     for key, value in state:
             #         if key == self.parentTask.humanReadableName:
             #             state[key].append({self.humanReadableName: outputJSON['answer']})
-            self.state.append({self.humanReadableName: outputJSON['answer']})
-            if self.parentTask is not None and self.humanReadableName != 'END':
-                self.parentTask.latestOutput = outputJSON['answer']
+            self.applyAnswer(outputJSON['answer'])
+        elif self.mustAnswer:
+            raise ExecutionAborted('no-answer', f'The task "{self.humanReadableName}" was forced to answer directly, but did not')
+        else:
+            # The plan is validated (and repaired where that is safe) before any of its tasks runs.
+            try:
+                compiledPlan = compilePlan(outputJSON)
+            except PlanCompilationError as error:
+                self.forceAnswer(f'its plan is invalid ({error})')
+                await self.reason()
+                return
+
+            repeatedPlanReason = self.checkForRepeatedPlan()
+            if repeatedPlanReason is not None:
+                self.forceAnswer(repeatedPlanReason)
+                await self.reason()
+                return
+
+            self.executionContext.tracer.log(f'~~ Going to spin off a new graph for task: {self.humanReadableName}')
+            try:
+                await self.createAndRunGraphForTask(compiledPlan)
+            except ExecutionAborted:
+                raise
+            except Exception:
+                self.recordPlanOutcome(False)
+                raise
+            self.result = self.latestOutput
+            self.recordPlanOutcome(self.result is not None)
+
+    # A plan that worked goes to the plan library. For a plan that came from the library, its outcome is recorded instead.
+    # The outcome of a work unit's plan is recorded by the run that sent the unit, in its own plan library (see SubplanOffloader).
+    def recordPlanOutcome(self, succeeded):
+        if self.isRemoteUnit:
+            self.planOutcome = {'plan': self.outputJSON, 'reusedPlanKey': self.reusedPlan.planKey if self.reusedPlan is not None else None, 'succeeded': succeeded}
+            return
+
+        planLibrary = self.executionContext.planLibrary
+        if self.reusedPlan is not None:
+            planLibrary.recordOutcome(self.reusedPlan, succeeded)
+        elif succeeded:
+            planLibrary.store(self, self.outputJSON)
+
+    # Records the outcome of the plan that this task ran in a worker. A plan that the worker took from its own library is only
+    # counted as reused if this run's library has it too. Otherwise, it is stored like any plan that worked.
+    def recordRemotePlanOutcome(self, planOutcome):
+        self.outputJSON = planOutcome['plan']
+        self.reusedPlan = self.executionContext.planLibrary.plansByKey.get(planOutcome['reusedPlanKey'])
+        self.recordPlanOutcome(planOutcome['succeeded'])
+
+    # Fingerprints the plan in outputJSON. Returns the reason why it repeats an ancestor's plan, or None if it is new.
+    def checkForRepeatedPlan(self):
+        governor = self.executionContext.governor
+        self.planFingerprint = governor.planFingerprint(self.goal, self.outputJSON.get('nodes', []), self.outputJSON.get('edges', []))
+        repeatedPlanReason = governor.findRepeatedPlan(self, self.planFingerprint)
+        if repeatedPlanReason is not None and governor.onRepeatedPlan == RepeatedPlanAction.ABORT:
+            raise ExecutionAborted('repeated-plan', repeatedPlanReason)
+
+        return repeatedPlanReason
+
+    # Same as reason(), but the response is streamed. Every node of the plan becomes a task as soon as it arrives,
+    # and it starts running as soon as its predecessors (its "after" list) are done, while the rest of the plan is still being generated.
+    # If the response turns out to be an answer, no graph is run.
+    async def reasonWithStreamedPlan(self):
+        self.rules = self.assembleRules()
+        formattedState, self.contextReport = await self.executionContext.contextManager.buildContext(self)
+        self.prompt = self.assemblePrompt(formattedState)
+
+        algorithmGraph = AlgorithmGraph([], self, isSealed=False)
+        algorithmGraph.state.append({self.goal: 'RUNNING'})
+        parser = IncrementalJSONParser(('nodes', 'edges'))
+        subtasksByID = dict()
+        graphRun = None
+        tracer = self.executionContext.tracer
+        # The plan is being built for as long as the response streams in. Its nodes start running in the meantime,
+        # so the span is not activated, and they stay under this task.
+        planSpan = tracer.span(f'plan {self.humanReadableName}', 'plan', activate=False, streamed=True)
+
+        try:
+            with planSpan:
+                async for textChunk in gptStream(self.gptModel, self.systemMessage, self.prompt, executionContext=self.executionContext):
+                    for key, item in parser.feed(textChunk):
+                        if key == 'nodes':
+                            # Nodes are repaired like in a compiled plan. A node that the compiler would drop is left to the full plan,
+                            # whose repairs are listed once it has arrived (see applyStreamedRepairs).
+                            node = normalizeNode(item, subtasksByID, [])
+                            if node is None:
+                                continue
+                            subtask = self.createSubtask(node)
+                            subtasksByID[node['id']] = subtask
+                            # Without a complete "after" list, the node waits for the edges of the full plan.
+                            predecessorIDs = node.get('after')
+                            predecessors = None
+                            if isinstance(predecessorIDs, list) and all(predecessorID in subtasksByID for predecessorID in predecessorIDs):
+                                predecessors = [subtasksByID[predecessorID] for predecessorID in predecessorIDs]
+                            algorithmGraph.addTask(subtask, predecessors)
+
+                            if graphRun is None:
+                                # The goal is being planned from now on, and its subtasks start before the plan is complete,
+                                # so they must see it to catch a planning loop (see governor.findPlanningLoop). The fingerprint of the
+                                # complete plan replaces this one once it has arrived.
+                                self.planFingerprint = self.executionContext.governor.planFingerprint(self.goal, [], [])
+                                tracer.log(f'~~ Going to spin off a new graph for task: {self.humanReadableName} (streaming)')
+                                graphRun = asyncio.ensure_future(algorithmGraph.run())
+                        elif key == 'edges':
+                            sourceTask = subtasksByID.get(item.get('source'))
+                            targetTask = subtasksByID.get(item.get('target'))
+                            if sourceTask is None or targetTask is None:
+                                tracer.log(f'~~ Ignoring edge with unknown node ids: {item}')
+                                continue
+                            if 'condition' in item:
+                                targetTask.condition = item['condition']
+                            algorithmGraph.addEdge(sourceTask, targetTask)
+
+                planSpan.set(nodes=len(subtasksByID), edges=algorithmGraph.graph.number_of_edges())
+            self.prompt = None
+
+            self.outputJSON = extractJSONSubstring(parser.text) or repairJSONSubstring(parser.text)
+            tracer.log(f'GPT OUTPUT:\n{self.outputJSON}')
+            self.executionContext.checkpoint.recordOutput(self, self.outputJSON)
+
+            if graphRun is None:
+                await self.evaluateLLMResponse()
+                return
+
+            # The streamed plan is compiled like any other plan. A plan that can't be repaired (e.g. it has a cycle) is dropped.
+            try:
+                compiledPlan = compilePlan(self.outputJSON)
+            except PlanCompilationError as error:
+                graphRun.cancel()
+                self.forceAnswer(f'its plan is invalid ({error})')
+                await self.reason()
+                return
+
+            repeatedPlanReason = self.checkForRepeatedPlan()
+            if repeatedPlanReason is not None:
+                graphRun.cancel()
+                self.forceAnswer(repeatedPlanReason)
+                await self.reason()
+                return
+
+            self.applyStreamedRepairs(compiledPlan, subtasksByID, algorithmGraph)
+            algorithmGraph.seal()
+            finalResult = await graphRun
+            tracer.log(f'~~ Graph result for task {self.humanReadableName}: {finalResult}')
+            self.result = self.latestOutput
+            self.recordPlanOutcome(self.result is not None)
+        finally:
+            if graphRun is not None and not graphRun.done():
+                graphRun.cancel()
+
+    # The nodes of a streamed plan already run as they arrive, so only the repairs that add to the plan can still be applied:
+    # the nodes that the compiler added (e.g. a missing END), and the edges of the compiled plan (e.g. from the nodes without successors
+    # to END). The graph ignores the edges into tasks that were already scheduled, and END is only scheduled once the graph is sealed.
+    def applyStreamedRepairs(self, compiledPlan, subtasksByID, algorithmGraph):
+        tracer = self.executionContext.tracer
+        for repair in compiledPlan.repairs:
+            tracer.log(f'~~ Repaired the streamed plan of task {self.humanReadableName}: {repair}')
+
+        for node in compiledPlan.nodes:
+            if node['id'] not in subtasksByID:
+                subtasksByID[node['id']] = self.createSubtask(node)
+                algorithmGraph.addTask(subtasksByID[node['id']])
+        for sourceIndex, targetIndex in compiledPlan.edges:
+            algorithmGraph.addEdge(subtasksByID[compiledPlan.nodes[sourceIndex]['id']], subtasksByID[compiledPlan.nodes[targetIndex]['id']])
+
+    # Records an answer for this task, whether it was just computed or reused from the task cache.
+    def applyAnswer(self, answer):
+        self.result = answer
+        self.answer = answer
+        self.state.append({self.humanReadableName: answer})
+        if self.parentTask is not None and self.humanReadableName != 'END' and not self.isSpeculative:
+            self.parentTask.latestOutput = answer
+
+    # Restores a task that finished before the run was resumed: its result, and the steps it added to the state history.
+    def restore(self, result, answer, steps):
+        self.isRestored = True
+        self.completeWith(result, answer, steps)
+
+    # Finishes the task with a result that was produced elsewhere (in an earlier run, or in a worker), and adds the steps it produced.
+    def completeWith(self, result, answer, steps):
+        self.result = result
+        self.answer = answer
+        self.state.extend(steps)
+        if answer is not None and self.parentTask is not None and not self.isSpeculative:
+            self.parentTask.latestOutput = answer
+
+    # Called by the graph once the task is finished and its steps were handed over. The task then only stays in the graph as a node
+    # that other tasks are scheduled around, so everything but its name, condition, result and place in the tree is released:
+    # its prompt, its LLM output, its state history view (and the rendered text it caches), and its instructions.
+    def collapse(self):
+        self.state = None
+        self.prompt = None
+        self.outputJSON = None
+        self.inputJSON = None
+        self.contextReport = None
+        self.rules = None
+        self.rulesList = None
+        self.task = None
+        self.expectedOutputJSONSchema = None
+        self.reusedPlan = None
+
+    # Runs the task and returns its result. This is what the task cache calls on a miss.
+    # Sub-plans are sent to the workers of the work queue when there is one.
+    async def runForResult(self):
+        offloader = self.executionContext.offloader
+        if offloader.shouldOffload(self):
+            await offloader.runRemotely(self)
+        else:
+            await self.run()
+
+        return self.result
+
+
+    # Creates the task for a node of this task's plan.
+    def createSubtask(self, node):
+        rulesList = []
+        state = self.state
+
+        goal = node['id']
+        description = node['description']
+        reasoningType = node['type']
+        expectedOutputJSONSchema = ['output']
+
+        humanReadableName = node['id']
+        systemMessage = self.systemMessage
+        parentTask = self
+
+        inputTuple = rulesList, state, goal, expectedOutputJSONSchema, description, reasoningType, parentTask
+
+        if 'conditional' in node:
+            isConditionalNode = True
         else:
-            print(f'~~ Going to spin off a new graph for task: {self.humanReadableName}')
-            await self.createAndRunGraphForTask()
+            isConditionalNode = False
+
+        subtask = PlanningTask(humanReadableName, systemMessage, inputTuple, isConditionalNode, self.executionContext)
+        subtask.isComputation = bool(node.get('compute'))
+
+        return subtask
 
 
     # This function, as the name suggests, creates and runs a plan.
-    # It takes in the response from the LLM. The response contains a plan in the form of nodes and edges.
+    # It takes in the compiled plan of the LLM's response (see plan_compiler.py). The plan is made of nodes and edges.
     # The nodes are tasks, and the edges are dependencies.
     # It then creates a networkx Algorithmic Graph representing the plan, and executes it.
-    async def createAndRunGraphForTask(self):
-        graph = self.outputJSON
-        # graph = json.loads(graphJSONDescription)
+    async def createAndRunGraphForTask(self, compiledPlan):
+        tracer = self.executionContext.tracer
+        with tracer.span(f'plan {self.humanReadableName}', 'plan', nodes=len(compiledPlan.nodes), edges=len(compiledPlan.edges), levels=compiledPlan.levelCount(), repairs=len(compiledPlan.repairs), reused=self.reusedPlan is not None):
+            for repair in compiledPlan.repairs:
+                tracer.log(f'~~ Repaired the plan of task {self.humanReadableName}: {repair}')
+
+            # Tasks are addressed by their index in the compiled plan.
+            finalNodes = [self.createSubtask(node) for node in compiledPlan.nodes]
+            for (_, targetIndex), condition in zip(compiledPlan.edges, compiledPlan.edgeConditions):
+                if condition is not None:
+                    finalNodes[targetIndex].condition = condition
+
+            # The steps of the new graph go to the graph's own view of the state history, and are handed back to this task when it finishes.
+            algorithmGraph = AlgorithmGraph.fromCompiledPlan(compiledPlan, finalNodes, self)
+            algorithmGraph.state.append({self.goal: 'RUNNING'})
 
-        nodes = graph['nodes']
-        edges = graph['edges']
-
-        finalNodes = []
-        finalEdges = []
-        
-        self.state.append({self.goal: 'RUNNING'})
-
-        for _, node in enumerate(nodes):
-            task = self.task
-            rulesList = []
-            state = self.state
-                
-            goal = node['id']
-            description = node['description']
-            reasoningType = node['type']
-            expectedOutputJSONSchema = ['output']
-
-            humanReadableName = node['id']
-            systemMessage = self.systemMessage
-            parentTask = self
-
-            inputTuple = rulesList, state, goal, expectedOutputJSONSchema, description, reasoningType, parentTask
-
-            if 'conditional' in node:
-                isConditionalNode = True
-            else:
-                isConditionalNode = False
-            
-            task = PlanningTask(humanReadableName, systemMessage, inputTuple, isConditionalNode)
-
-            finalNodes.append(task)
-
-        for edge in edges:
-            sourceID = edge['source']
-            targetID = edge['target']
- 
-            sourceTask = list(filter(lambda n: n.humanReadableName == sourceID, finalNodes))[0]
-            targetTask = list(filter(lambda n: n.humanReadableName == targetID, finalNodes))[0]
-            if 'condition' in edge:
-                targetTask.condition = edge['condition']
-
-            # finalEdges.append((sourceTask, targetTask, isConditionalEdge))
-            finalEdges.append((sourceTask, targetTask))
-
-        algorithmGraph = AlgorithmGraph(finalEdges)
-        
         finalResult = await algorithmGraph.run()
 
-        print(finalResult)
+        tracer.log(f'~~ Graph result for task {self.humanReadableName}: {finalResult}')
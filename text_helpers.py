@@ -10,6 +10,25 @@ def extractJSONSubstring(inputString):
 
     return asJson
 
+# Fixes the usual ways a JSON response is malformed, without calling the LLM again: code fences or text around the object,
+# and trailing commas. Returns None if the response still can't be parsed.
+def repairJSONSubstring(inputString):
+    if not isinstance(inputString, str):
+        return None
+
+    start = inputString.find('{')
+    end = inputString.rfind('}')
+    if start == -1 or end <= start:
+        return None
+
+    candidate = inputString[start:end + 1]
+    for repairedString in (candidate, re.sub(r',\s*([}\]])', r'\1', candidate)):
+        asJson = extractJSONSubstring(repairedString)
+        if isinstance(asJson, dict):
+            return asJson
+
+    return None
+
 def extractPythonCodeSubstring(inputString):
     # Using regular expression to find Python code substring
     pattern = r'```python(.*?)```'
@@ -20,4 +39,59 @@ def extractPythonCodeSubstring(inputString):
         return pythonCodeSubstring
     else:
         print("No Python code substring found.")
-        return None
\ No newline at end of file
+        return None
+
+"""
+This class parses a JSON object while it is still being streamed.
+Every time a complete object inside one of the watched top-level arrays (e.g. "nodes" or "edges") has been received,
+feed() returns it as a (key, object) pair, so it can be used before the rest of the JSON arrives.
+"""
+class IncrementalJSONParser:
+    def __init__(self, watchedKeys):
+        self.watchedKeys = set(watchedKeys)
+        self.text = ''
+        self.position = 0
+        self.depth = 0
+        self.isInString = False
+        self.isEscaped = False
+        self.stringStart = None
+        self.lastString = None
+        self.currentKey = None
+        self.objectStart = None
+
+    def feed(self, textChunk):
+        self.text += textChunk
+        completedItems = []
+
+        while self.position < len(self.text):
+            character = self.text[self.position]
+
+            if self.isInString:
+                if self.isEscaped:
+                    self.isEscaped = False
+                elif character == '\\':
+                    self.isEscaped = True
+                elif character == '"':
+                    self.isInString = False
+                    if self.depth == 1:
+                        self.lastString = self.text[self.stringStart:self.position]
+            elif character == '"':
+                self.isInString = True
+                self.stringStart = self.position + 1
+            elif character == ':' and self.depth == 1:
+                self.currentKey = self.lastString
+            elif character in '{[':
+                if character == '{' and self.depth == 2 and self.currentKey in self.watchedKeys:
+                    self.objectStart = self.position
+                self.depth += 1
+            elif character in '}]':
+                self.depth -= 1
+                if character == '}' and self.depth == 2 and self.objectStart is not None:
+                    completedItem = extractJSONSubstring(self.text[self.objectStart:self.position + 1])
+                    if completedItem is not None:
+                        completedItems.append((self.currentKey, completedItem))
+                    self.objectStart = None
+
+            self.position += 1
+
+        return completedItems
@@ -0,0 +1,268 @@
+import contextvars
+import json
+import math
+import os
+import time
+
+# Tracing is enabled by giving the path of the Chrome trace (Perfetto) file to write at the end of a run.
+TRACE_PATH = os.environ.get('TRACE_PATH')
+# When enabled, the log messages of the run are also printed, as they happen.
+TRACE_VERBOSE = os.environ.get('TRACE_VERBOSE', '0') == '1'
+
+# The span that the running code is in. asyncio copies it into every task it creates, so spans started there get the right parent.
+currentSpan = contextvars.ContextVar('currentSpan', default=None)
+
+
+# The value below which `fraction` of the sorted values are (nearest rank).
+def percentileOf(sortedValues, fraction):
+    return sortedValues[max(math.ceil(fraction * len(sortedValues)) - 1, 0)]
+
+
+# The median and the tail of a list of durations, in seconds.
+def latencyPercentiles(durations):
+    if not durations:
+        return {'count': 0, 'p50Seconds': 0.0, 'p95Seconds': 0.0, 'p99Seconds': 0.0, 'maxSeconds': 0.0}
+
+    sortedDurations = sorted(durations)
+
+    return {
+        'count': len(sortedDurations),
+        'p50Seconds': round(percentileOf(sortedDurations, 0.5), 3),
+        'p95Seconds': round(percentileOf(sortedDurations, 0.95), 3),
+        'p99Seconds': round(percentileOf(sortedDurations, 0.99), 3),
+        'maxSeconds': round(sortedDurations[-1], 3),
+    }
+
+
+"""
+This class is a timed piece of the run: a task execution, an LLM call, a plan construction or a conditional decision.
+It is used as a context manager. Its attributes can be set at any time before it ends.
+"""
+class Span:
+    __slots__ = ('spanId', 'name', 'category', 'parent', 'attributes', 'activate', 'startedAt', 'endedAt', 'contextToken')
+
+    def __init__(self, spanId, name, category, parent, attributes, activate):
+        self.spanId = spanId
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.attributes = attributes
+        self.activate = activate
+        self.startedAt = None
+        self.endedAt = None
+        self.contextToken = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.startedAt = time.perf_counter()
+        if self.activate:
+            self.contextToken = currentSpan.set(self)
+
+        return self
+
+    def __exit__(self, errorType, error, traceback):
+        self.endedAt = time.perf_counter()
+        if self.contextToken is not None:
+            currentSpan.reset(self.contextToken)
+            self.contextToken = None
+        if errorType is not None:
+            self.attributes['error'] = errorType.__name__
+
+        return False
+
+    def durationSeconds(self):
+        if self.startedAt is None:
+            return 0.0
+
+        return (self.endedAt if self.endedAt is not None else time.perf_counter()) - self.startedAt
+
+
+"""
+This class stands in for a span when tracing is disabled. A single instance is shared, so a disabled span costs one method call.
+"""
+class NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, errorType, error, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+"""
+This class records the spans and log messages of a run, and exports them.
+- exportChromeTrace(path) writes a Chrome trace (chrome://tracing, https://ui.perfetto.dev), with one track per task execution.
+- summary() returns the critical path, the slowest tasks and the token spend by depth, and printSummary() prints them.
+When it is disabled, span() returns NULL_SPAN and log() only prints in verbose mode, so tracing costs next to nothing.
+"""
+class Tracer:
+    def __init__(self, enabled=TRACE_PATH is not None, verbose=TRACE_VERBOSE, tracePath=TRACE_PATH):
+        self.enabled = enabled
+        self.verbose = verbose
+        self.tracePath = tracePath
+        self.startedAt = time.perf_counter()
+        self.spans = []
+        self.logEvents = []
+
+    # Spans nest under the current span. A span that is not activated doesn't become the current span, which is what
+    # async generators need, since they run in the context of whoever is iterating them.
+    def span(self, name, category, activate=True, **attributes):
+        if not self.enabled:
+            return NULL_SPAN
+
+        parent = currentSpan.get()
+        if 'depth' not in attributes and parent is not None and 'depth' in parent.attributes:
+            attributes['depth'] = parent.attributes['depth']
+        span = Span(len(self.spans) + 1, name, category, parent, attributes, activate)
+        self.spans.append(span)
+
+        return span
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
+        if self.enabled:
+            self.logEvents.append((time.perf_counter(), message, currentSpan.get()))
+
+    @staticmethod
+    def taskSpanOf(span):
+        while span is not None and span.category != 'task':
+            span = span.parent
+
+        return span
+
+    def microseconds(self, timestamp):
+        return round((timestamp - self.startedAt) * 1e6, 1)
+
+    @staticmethod
+    def jsonAttributes(attributes):
+        return {key: value if isinstance(value, (str, int, float, bool)) or value is None else str(value) for key, value in attributes.items()}
+
+    def exportChromeTrace(self, path=None):
+        path = path or self.tracePath
+        traceEvents = []
+
+        for span in self.spans:
+            if span.startedAt is None:
+                continue
+            taskSpan = self.taskSpanOf(span)
+            trackID = taskSpan.spanId if taskSpan is not None else 0
+            if span is taskSpan:
+                traceEvents.append({'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': trackID, 'args': {'name': span.name}})
+            traceEvents.append({
+                'ph': 'X',
+                'name': span.name,
+                'cat': span.category,
+                'pid': 1,
+                'tid': trackID,
+                'ts': self.microseconds(span.startedAt),
+                'dur': round(span.durationSeconds() * 1e6, 1),
+                'args': self.jsonAttributes(span.attributes),
+            })
+
+        for timestamp, message, span in self.logEvents:
+            taskSpan = self.taskSpanOf(span)
+            traceEvents.append({
+                'ph': 'i',
+                's': 't',
+                'name': message[:80],
+                'pid': 1,
+                'tid': taskSpan.spanId if taskSpan is not None else 0,
+                'ts': self.microseconds(timestamp),
+                'args': {'message': message},
+            })
+
+        with open(path, 'w') as traceFile:
+            json.dump({'traceEvents': traceEvents, 'displayTimeUnit': 'ms'}, traceFile)
+
+        return path
+
+    # The critical path starts at the root task. Within the plan of a task, it goes back from the subtask that finished last
+    # to the subtask that finished last before it started (the one it was waiting for), and so on. Each of these subtasks
+    # is followed by the critical path of its own plan.
+    def criticalPath(self):
+        subtaskSpans = dict()
+        rootSpans = []
+        for span in self.spans:
+            if span.category != 'task' or span.startedAt is None:
+                continue
+            parentTaskSpan = self.taskSpanOf(span.parent)
+            if parentTaskSpan is None:
+                rootSpans.append(span)
+            else:
+                subtaskSpans.setdefault(parentTaskSpan.spanId, []).append(span)
+
+        if not rootSpans:
+            return []
+
+        return [rootSpans[0]] + self.criticalSubtasks(rootSpans[0], subtaskSpans)
+
+    def criticalSubtasks(self, span, subtaskSpans):
+        subtasks = subtaskSpans.get(span.spanId, [])
+        endOf = lambda subtask: subtask.endedAt if subtask.endedAt is not None else time.perf_counter()
+
+        chain = []
+        subtask = max(subtasks, key=endOf) if subtasks else None
+        while subtask is not None:
+            chain.append(subtask)
+            earlierSubtasks = [earlierSubtask for earlierSubtask in subtasks if endOf(earlierSubtask) <= subtask.startedAt]
+            subtask = max(earlierSubtasks, key=endOf) if earlierSubtasks else None
+
+        path = []
+        for subtask in reversed(chain):
+            path.append(subtask)
+            path.extend(self.criticalSubtasks(subtask, subtaskSpans))
+
+        return path
+
+    def summary(self, slowestCount=5):
+        taskSpans = [span for span in self.spans if span.category == 'task']
+        llmSpans = [span for span in self.spans if span.category == 'llm']
+        decisionSpans = [span for span in self.spans if span.category == 'decision']
+
+        tokensByDepth = dict()
+        for span in llmSpans:
+            depth = span.attributes.get('depth') or 0
+            tokensByDepth[depth] = tokensByDepth.get(depth, 0) + span.attributes.get('promptTokens', 0) + span.attributes.get('completionTokens', 0)
+
+        return {
+            'wallSeconds': round(max((span.endedAt or 0.0 for span in self.spans), default=self.startedAt) - self.startedAt, 3) if self.spans else 0.0,
+            'tasks': len(taskSpans),
+            'llmCalls': len(llmSpans),
+            'llmCacheHits': sum(1 for span in llmSpans if span.attributes.get('cacheHit')),
+            'llmSeconds': round(sum(span.durationSeconds() for span in llmSpans), 3),
+            'decisions': len(decisionSpans),
+            'localDecisions': sum(1 for span in decisionSpans if span.attributes.get('local')),
+            'criticalPath': [(span.name, round(span.durationSeconds(), 3)) for span in self.criticalPath()],
+            'slowestTasks': [(span.name, span.attributes.get('depth'), round(span.durationSeconds(), 3)) for span in sorted(taskSpans, key=Span.durationSeconds, reverse=True)[:slowestCount]],
+            'tokensByDepth': dict(sorted(tokensByDepth.items())),
+            'promptTokens': sum(span.attributes.get('promptTokens', 0) for span in llmSpans),
+            'cachedPromptTokens': sum(span.attributes.get('cachedPromptTokens', 0) for span in llmSpans),
+            # Cached responses take no time, so they would hide the tail of the calls that went to the API.
+            'llmLatency': latencyPercentiles([span.durationSeconds() for span in llmSpans if not span.attributes.get('cacheHit')]),
+            'hedgedLLMCalls': sum(1 for span in llmSpans if span.attributes.get('hedged')),
+        }
+
+    def printSummary(self):
+        summary = self.summary()
+        print('~~ TRACE SUMMARY')
+        print(f'Wall time: {summary["wallSeconds"]}s, tasks: {summary["tasks"]}, LLM calls: {summary["llmCalls"]} ({summary["llmCacheHits"]} cached, {summary["llmSeconds"]}s in total), decisions: {summary["decisions"]} ({summary["localDecisions"]} local)')
+        print('Critical path:')
+        for name, seconds in summary['criticalPath']:
+            print(f'\t{seconds:>8.3f}s  {name}')
+        print('Slowest tasks:')
+        for name, depth, seconds in summary['slowestTasks']:
+            print(f'\t{seconds:>8.3f}s  {name} (depth {depth})')
+        print(f'Prompt tokens: {summary["promptTokens"]} ({summary["cachedPromptTokens"]} served from the prompt prefix cache)')
+        llmLatency = summary['llmLatency']
+        print(f'LLM call latency: p50 {llmLatency["p50Seconds"]}s, p95 {llmLatency["p95Seconds"]}s, p99 {llmLatency["p99Seconds"]}s, max {llmLatency["maxSeconds"]}s ({summary["hedgedLLMCalls"]} hedged)')
+        print('Tokens by depth:')
+        for depth, tokens in summary['tokensByDepth'].items():
+            print(f'\tdepth {depth}: {tokens}')
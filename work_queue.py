@@ -0,0 +1,281 @@
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from governor import ExecutionAborted
+
+# When set, the sub-plans of a run are sent to the workers of this SQLite work queue (see worker.py) instead of running in this process.
+WORK_QUEUE_PATH = os.environ.get('WORK_QUEUE_PATH')
+# How often the queue is checked for new work units (by the workers) and for finished ones (by the run that sent them).
+WORK_QUEUE_POLL_SECONDS = float(os.environ.get('WORK_QUEUE_POLL_SECONDS', 0.05))
+# A unit whose worker stopped renewing its lease for this long (e.g. the worker died) goes back to the queue.
+WORK_QUEUE_LEASE_SECONDS = float(os.environ.get('WORK_QUEUE_LEASE_SECONDS', 60))
+WORK_QUEUE_MAX_ATTEMPTS = int(os.environ.get('WORK_QUEUE_MAX_ATTEMPTS', 3))
+
+
+class RemoteTaskError(RuntimeError):
+    pass
+
+
+"""
+This is the interface of the queue that carries work units between a run and its workers. A work unit is a JSON-serializable dict.
+- submit(payload) adds a unit, and returns its id.
+- claim(workerID) takes the oldest pending unit, and returns (unitID, payload), or None if there is none.
+- renewLeases(workerID) tells the queue that the worker is still working on the units it claimed, and returns the ids of these units.
+A unit that was discarded in the meantime is not among them, so the worker knows to stop it.
+- complete(unitID, result) stores the result of a unit. takeResults(unitIDs) returns the results of the units that are done,
+by unit id, and removes them from the queue. discard(unitID) removes a unit whose result is not needed anymore.
+Other implementations (e.g. on a message broker, for workers on other machines) only need these methods.
+"""
+class WorkQueue:
+    def submit(self, payload):
+        raise NotImplementedError
+
+    def claim(self, workerID):
+        raise NotImplementedError
+
+    def renewLeases(self, workerID):
+        raise NotImplementedError
+
+    def complete(self, unitID, result):
+        raise NotImplementedError
+
+    def takeResults(self, unitIDs):
+        raise NotImplementedError
+
+    def discard(self, unitID):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+"""
+This class is a work queue in a single SQLite file, so the run and its workers only need to share a file system. It needs no other service.
+SQLite's locking (and its WAL mode) needs a local file system, so the processes must run on the same machine: the queue is not safe on NFS
+or other network file systems, where two workers can claim the same unit or the file can get corrupted.
+Claims are made in an immediate transaction, so a unit is never claimed by two workers at the same time.
+A claimed unit has a lease, which its worker renews while it runs. When a lease runs out, the unit goes back to the queue,
+and after maxAttempts claims it is completed with a failure.
+"""
+class SQLiteWorkQueue(WorkQueue):
+    def __init__(self, path=WORK_QUEUE_PATH, leaseSeconds=WORK_QUEUE_LEASE_SECONDS, maxAttempts=WORK_QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('''CREATE TABLE IF NOT EXISTS workUnits (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                workerID TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                leaseExpiresAt REAL,
+                result TEXT,
+                createdAt REAL NOT NULL
+            )''')
+            connection.execute('CREATE INDEX IF NOT EXISTS workUnitsByStatus ON workUnits (status, id)')
+            self.connection = connection
+
+        return self.connection
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def submit(self, payload):
+        with self.lock:
+            cursor = self.connect().execute(
+                'INSERT INTO workUnits (payload, status, createdAt) VALUES (?, ?, ?)',
+                (json.dumps(payload, ensure_ascii=False, default=str), 'pending', time.time()),
+            )
+
+            return cursor.lastrowid
+
+    def claim(self, workerID):
+        with self.lock:
+            connection = self.connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                failedResult = json.dumps({'status': 'failed', 'error': f'The unit was claimed {self.maxAttempts} times, and its worker stopped every time'})
+                connection.execute("UPDATE workUnits SET status = 'done', result = ? WHERE status = 'claimed' AND leaseExpiresAt < ? AND attempts >= ?", (failedResult, now, self.maxAttempts))
+                connection.execute("UPDATE workUnits SET status = 'pending', workerID = NULL WHERE status = 'claimed' AND leaseExpiresAt < ?", (now,))
+
+                row = connection.execute("SELECT id, payload FROM workUnits WHERE status = 'pending' ORDER BY id LIMIT 1").fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE workUnits SET status = 'claimed', workerID = ?, attempts = attempts + 1, leaseExpiresAt = ? WHERE id = ?",
+                        (workerID, now + self.leaseSeconds, row[0]),
+                    )
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def renewLeases(self, workerID):
+        with self.lock:
+            connection = self.connect()
+            connection.execute("UPDATE workUnits SET leaseExpiresAt = ? WHERE status = 'claimed' AND workerID = ?", (time.time() + self.leaseSeconds, workerID))
+            rows = connection.execute("SELECT id FROM workUnits WHERE status = 'claimed' AND workerID = ?", (workerID,)).fetchall()
+
+        return {row[0] for row in rows}
+
+    def complete(self, unitID, result):
+        with self.lock:
+            self.connect().execute(
+                "UPDATE workUnits SET status = 'done', result = ? WHERE id = ? AND status = 'claimed'",
+                (json.dumps(result, ensure_ascii=False, default=str), unitID),
+            )
+
+    def takeResults(self, unitIDs):
+        results = dict()
+        with self.lock:
+            connection = self.connect()
+            # SQLite limits the number of parameters of a statement.
+            for start in range(0, len(unitIDs), 500):
+                chunk = unitIDs[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                rows = connection.execute(f"SELECT id, result FROM workUnits WHERE status = 'done' AND id IN ({placeholders})", chunk).fetchall()
+                if rows:
+                    connection.executemany('DELETE FROM workUnits WHERE id = ?', [(row[0],) for row in rows])
+                results.update((row[0], json.loads(row[1])) for row in rows)
+
+        return results
+
+    def discard(self, unitID):
+        with self.lock:
+            self.connect().execute('DELETE FROM workUnits WHERE id = ?', (unitID,))
+
+
+# The serializable inputs of a planning task: what it needs to run as the root of its own recursion tree in a worker.
+# The goals and plan fingerprints of its ancestors come along, so the governor still catches planning loops across processes,
+# and so does the time that is left until its deadline, so its graphs give up in time (see deadlines.py).
+def workUnitFor(task):
+    ancestors = []
+    ancestor = task.parentTask
+    while ancestor is not None:
+        ancestors.append({'humanReadableName': ancestor.humanReadableName, 'goal': ancestor.goal, 'planFingerprint': ancestor.planFingerprint})
+        ancestor = ancestor.parentTask
+
+    governor = task.executionContext.governor
+
+    return {
+        'humanReadableName': task.humanReadableName,
+        'systemMessage': task.systemMessage.name,
+        'rulesList': task.rulesList,
+        'state': task.state.toList(),
+        'goal': task.goal,
+        'expectedOutputJSONSchema': task.expectedOutputJSONSchema,
+        'description': task.description,
+        'reasoningType': task.reasoningType,
+        'ancestors': ancestors,
+        'deadlineSeconds': task.executionContext.deadlines.remainingSeconds(task.deadlineAt),
+        'budgets': {
+            'maxDepth': governor.maxDepth,
+            'maxCalls': governor.maxCalls - governor.calls,
+            'maxTokens': governor.maxTokens - governor.tokens,
+            'maxWallClockSeconds': governor.maxWallClockSeconds - governor.elapsedSeconds(),
+        },
+    }
+
+
+"""
+This class sends the sub-plans of a run to a work queue, and hands their results back to their parent tasks.
+A planning subtask (type II) is sent as a work unit (see workUnitFor), and its whole recursion tree runs in a worker.
+When the unit is done, the subtask gets the result, the answer and the state history steps that the worker produced,
+the calls and tokens that the worker spent are added to the run's governor, and the outcome of its plan goes to the run's plan library. Type I tasks and conditional picks stay local,
+since they are a single LLM call, and workers don't send their own sub-plans any further.
+Every unit that the run is waiting for is checked by a single poller, so waiting on many units costs one query per poll.
+"""
+class SubplanOffloader:
+    def __init__(self, workQueue=None, pollSeconds=WORK_QUEUE_POLL_SECONDS):
+        if workQueue is None and WORK_QUEUE_PATH is not None:
+            workQueue = SQLiteWorkQueue(WORK_QUEUE_PATH)
+        self.workQueue = workQueue
+        self.enabled = workQueue is not None
+        self.pollSeconds = pollSeconds
+        self.waitingUnits = dict()
+        self.poller = None
+        self.offloadedTasks = 0
+        self.remoteCalls = 0
+        self.remoteTokens = 0
+        self.remoteFailures = 0
+
+    def shouldOffload(self, task):
+        return self.enabled and task.isPlanningTask() and not task.mustAnswer
+
+    async def runRemotely(self, task):
+        executionContext = task.executionContext
+        with executionContext.tracer.span(f'remote {task.humanReadableName}', 'remote') as span:
+            unitID = await asyncio.to_thread(self.workQueue.submit, workUnitFor(task))
+            span.set(unitID=unitID)
+            self.offloadedTasks += 1
+
+            resultFuture = asyncio.get_running_loop().create_future()
+            self.waitingUnits[unitID] = resultFuture
+            if self.poller is None or self.poller.done():
+                self.poller = asyncio.ensure_future(self.pollResults())
+
+            governor = executionContext.governor
+            remainingSeconds = governor.maxWallClockSeconds - governor.elapsedSeconds()
+            try:
+                # Nothing is charged to the run while it waits, so the wait itself is bounded by the wall-clock budget.
+                result = await asyncio.wait_for(resultFuture, None if math.isinf(remainingSeconds) else max(remainingSeconds, 0.0))
+            except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+                # Even if this task is cancelled again while it waits, the thread still discards the unit.
+                await asyncio.to_thread(self.workQueue.discard, unitID)
+                if isinstance(error, asyncio.TimeoutError):
+                    governor.checkBudgets()
+                raise
+            finally:
+                self.waitingUnits.pop(unitID, None)
+
+            self.remoteCalls += result.get('calls', 0)
+            self.remoteTokens += result.get('tokens', 0)
+            governor.recordRemoteCalls(result.get('calls', 0), result.get('tokens', 0))
+            span.set(status=result['status'], calls=result.get('calls', 0))
+
+        # The plan that the unit ran is learned from here, since the worker doesn't record it in its own plan library.
+        if result.get('planOutcome') is not None:
+            task.recordRemotePlanOutcome(result['planOutcome'])
+        if result['status'] == 'aborted':
+            raise ExecutionAborted(result['reason'], result['details'])
+        if result['status'] != 'finished':
+            self.remoteFailures += 1
+            raise RemoteTaskError(f'The sub-plan of task "{task.humanReadableName}" failed in a worker: {result.get("error")}')
+
+        task.completeWith(result['result'], result['answer'], result['steps'])
+
+    async def pollResults(self):
+        while self.waitingUnits:
+            await asyncio.sleep(self.pollSeconds)
+            results = await asyncio.to_thread(self.workQueue.takeResults, list(self.waitingUnits))
+            for unitID, result in results.items():
+                resultFuture = self.waitingUnits.pop(unitID, None)
+                if resultFuture is not None and not resultFuture.done():
+                    resultFuture.set_result(result)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'offloadedTasks': self.offloadedTasks,
+            'remoteCalls': self.remoteCalls,
+            'remoteTokens': self.remoteTokens,
+            'remoteFailures': self.remoteFailures,
+        }
@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import time
+
+import gpt_api_calls
+from checkpoint import Checkpoint
+from enums import SystemMessage
+from execution_context import ExecutionContext
+from governor import ExecutionGovernor, ExecutionAborted
+from state_history import StateHistory
+from tasks import PlanningTask
+from tracing import Tracer
+from work_queue import SQLiteWorkQueue, SubplanOffloader, WORK_QUEUE_PATH, WORK_QUEUE_POLL_SECONDS
+
+"""
+Runs the sub-plans of a run that were sent to a work queue (see work_queue.py).
+
+Usage: python worker.py [--queue path] [--processes 1] [--concurrency 4] [--idle-exit-seconds N]
+
+Every worker process takes work units from the queue, and runs up to `concurrency` of them at the same time on its event loop.
+Workers must run on the machine of the queue file, since SQLite is not safe on network file systems (see SQLiteWorkQueue). Start them before (or while) the run sends its sub-plans,
+with the same LLM backend and response cache settings as the run.
+"""
+
+# How many work units a worker process runs at the same time.
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 4))
+
+
+"""
+This class stands in for the ancestors of a work unit's task, which stay in the process that sent the unit.
+It has what the task and the governor read from an ancestor: its name, goal, plan fingerprint, depth and path.
+"""
+class RemoteAncestor:
+    def __init__(self, humanReadableName, goal, planFingerprint, parentTask):
+        self.humanReadableName = humanReadableName
+        self.goal = goal
+        self.planFingerprint = planFingerprint
+        self.parentTask = parentTask
+        self.depth = parentTask.depth + 1 if parentTask is not None else 0
+        self.path = Checkpoint.taskPath(self)
+        self.latestOutput = None
+
+
+def createUnitTask(payload, runID):
+    parentTask = None
+    for ancestor in reversed(payload['ancestors']):
+        parentTask = RemoteAncestor(ancestor['humanReadableName'], ancestor['goal'], ancestor['planFingerprint'], parentTask)
+
+    budgets = payload['budgets']
+    governor = ExecutionGovernor(maxDepth=budgets['maxDepth'], maxCalls=budgets['maxCalls'], maxTokens=budgets['maxTokens'], maxWallClockSeconds=budgets['maxWallClockSeconds'])
+    # The unit runs as the root of its own tree: it is not checkpointed or traced, and it doesn't send its own sub-plans any further.
+    executionContext = ExecutionContext(
+        governor=governor,
+        checkpoint=Checkpoint(path=None),
+        tracer=Tracer(enabled=False),
+        runID=runID,
+        offloader=SubplanOffloader(workQueue=None),
+    )
+    # The task works on a view of the state it was sent with, so the steps it adds can be sent back on their own.
+    state = StateHistory(payload['state']).fork()
+    inputTuple = (payload['rulesList'], state, payload['goal'], payload['expectedOutputJSONSchema'], payload['description'], payload['reasoningType'], parentTask)
+    task = PlanningTask(payload['humanReadableName'], SystemMessage[payload['systemMessage']], inputTuple, executionContext=executionContext)
+    task.isRemoteUnit = True
+    if payload.get('deadlineSeconds') is not None:
+        task.deadlineAt = time.monotonic() + payload['deadlineSeconds']
+
+    return task
+
+
+async def runWorkUnit(unitID, payload):
+    task = None
+    try:
+        task = createUnitTask(payload, runID=unitID)
+        await task.run()
+    except ExecutionAborted as error:
+        result = {'status': 'aborted', 'reason': error.reason, 'details': error.details}
+    except Exception as error:
+        result = {'status': 'failed', 'error': f'{type(error).__name__}: {error}'}
+    else:
+        result = {'status': 'finished', 'result': task.result, 'answer': task.answer, 'steps': task.state.newSteps()}
+
+    if task is not None:
+        governorStats = task.executionContext.governor.stats()
+        result.update(calls=governorStats['calls'], tokens=governorStats['tokens'], planOutcome=task.planOutcome)
+
+    return result
+
+
+# A unit that the run discarded (e.g. its graph was cancelled, or reached its deadline) is not needed anymore, so it is stopped.
+async def renewLeases(workQueue, workerID, runningUnits):
+    while True:
+        await asyncio.sleep(workQueue.leaseSeconds / 3)
+        # Units that are claimed while the leases are renewed are not checked until the next renewal.
+        checkedUnits = list(runningUnits.items())
+        claimedUnitIDs = await asyncio.to_thread(workQueue.renewLeases, workerID)
+        for runningUnit, unitID in checkedUnits:
+            if unitID not in claimedUnitIDs:
+                runningUnit.cancel()
+
+
+async def runAndComplete(workQueue, unitID, payload):
+    result = await runWorkUnit(unitID, payload)
+    await asyncio.to_thread(workQueue.complete, unitID, result)
+
+
+# Takes units from the queue for as long as there are some, and stops after idleExitSeconds without any (never, by default).
+async def runWorker(workQueue, workerID, concurrency=WORKER_CONCURRENCY, idleExitSeconds=None, pollSeconds=WORK_QUEUE_POLL_SECONDS):
+    # The running units, and their ids.
+    runningUnits = dict()
+    leaseRenewal = asyncio.ensure_future(renewLeases(workQueue, workerID, runningUnits))
+    idleSince = time.monotonic()
+    completedUnits = 0
+    try:
+        while True:
+            if len(runningUnits) < concurrency:
+                claimedUnit = await asyncio.to_thread(workQueue.claim, workerID)
+                if claimedUnit is not None:
+                    runningUnits[asyncio.ensure_future(runAndComplete(workQueue, *claimedUnit))] = claimedUnit[0]
+                    continue
+
+            if runningUnits:
+                finishedUnits, _ = await asyncio.wait(runningUnits, timeout=pollSeconds, return_when=asyncio.FIRST_COMPLETED)
+                for finishedUnit in finishedUnits:
+                    del runningUnits[finishedUnit]
+                    if not finishedUnit.cancelled():
+                        finishedUnit.result()
+                completedUnits += len(finishedUnits)
+                idleSince = time.monotonic()
+            elif idleExitSeconds is not None and time.monotonic() - idleSince >= idleExitSeconds:
+                break
+            else:
+                await asyncio.sleep(pollSeconds)
+    finally:
+        leaseRenewal.cancel()
+        await gpt_api_calls.closeClient()
+
+    return completedUnits
+
+
+def runWorkerProcess(queuePath, concurrency, idleExitSeconds):
+    workerID = f'{socket.gethostname()}:{os.getpid()}'
+    workQueue = SQLiteWorkQueue(queuePath)
+    completedUnits = asyncio.run(runWorker(workQueue, workerID, concurrency, idleExitSeconds))
+    workQueue.close()
+    print(f'~~ WORKER {workerID} completed {completedUnits} work units')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the sub-plans sent to a work queue.')
+    parser.add_argument('--queue', default=WORK_QUEUE_PATH, help='The SQLite work queue file (WORK_QUEUE_PATH by default).')
+    parser.add_argument('--processes', type=int, default=1, help='How many worker processes to start.')
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY, help='How many work units every process runs at the same time.')
+    parser.add_argument('--idle-exit-seconds', type=float, default=None, help='Stop after this long without any work unit.')
+    arguments = parser.parse_args()
+    if arguments.queue is None:
+        parser.error('the work queue must be given with --queue or WORK_QUEUE_PATH')
+
+    workerArguments = (arguments.queue, arguments.concurrency, arguments.idle_exit_seconds)
+    if arguments.processes == 1:
+        runWorkerProcess(*workerArguments)
+        return
+
+    processes = [multiprocessing.Process(target=runWorkerProcess, args=workerArguments) for _ in range(arguments.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()